@@ -0,0 +1,131 @@
+import sys
+import os
+
+# Assuming the script is run from within the root directory of the project
+project_root = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, project_root)
+
+import argparse
+import logging
+import faiss
+import numpy as np
+import pandas as pd
+from similarity_engine.instrumentation import add_instrumentation_arguments, request_trace, run_instrumented
+from inference_similar_songs import (fetch_track_details_batch, find_embeddings_in_local_path,
+                                     load_config, perform_similarity_search_batch, process_audio_to_embeddings)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+numba_logger = logging.getLogger('numba')
+numba_logger.setLevel(logging.WARNING)
+
+MODEL_PATHS = [
+    os.path.join(project_root, "models", "genre.pt"),
+    os.path.join(project_root, "models", "instruments.pt"),
+    os.path.join(project_root, "models", "mood.pt")
+]
+
+
+def list_wav_files(input_dir):
+    return sorted(os.path.join(input_dir, file_) for file_ in os.listdir(input_dir) if file_.lower().endswith(".wav"))
+
+
+def embed_audio_files(audio_file_paths):
+    """
+    Get the query embedding of every audio file, reusing the saved embeddings when available.
+
+    Args:
+    audio_file_paths (list of str): WAV files to embed.
+
+    Returns:
+    list of str: The files that could be embedded.
+    numpy.array: (m, dimension) matrix of their query embeddings.
+    """
+    embedded_files = []
+    embeddings = []
+    for audio_file_path in audio_file_paths:
+        try:
+            embedding = find_embeddings_in_local_path(audio_file_path)
+            if embedding is None:
+                embedding = process_audio_to_embeddings(audio_file_path, MODEL_PATHS)
+        except Exception as e:
+            logger.error(f"Skipping {audio_file_path}, it could not be embedded: {e}")
+            continue
+        embedded_files.append(audio_file_path)
+        embeddings.append(np.asarray(embedding, dtype='float32').reshape(-1))
+
+    if not embeddings:
+        return embedded_files, np.empty((0, 0), dtype='float32')
+    return embedded_files, np.vstack(embeddings)
+
+
+def search_batch(audio_file_paths, config, top_k):
+    """
+    Run one batched similarity search and one metadata lookup for a batch of audio files.
+
+    Returns:
+    pandas.DataFrame: One row per (query file, neighbour) with the rank, distance and track details.
+    """
+    with request_trace("batch", files=len(audio_file_paths)) as trace:
+        embedded_files, embeddings = embed_audio_files(audio_file_paths)
+        trace.fields["embedded_files"] = len(embedded_files)
+        if not embedded_files:
+            return pd.DataFrame()
+
+        if config["faiss"]["index_type"] == "Cosine":
+            faiss.normalize_L2(embeddings)
+
+        indices, distances = perform_similarity_search_batch(embeddings, config, top_k=top_k)
+        details_per_query = fetch_track_details_batch(indices.tolist(), config)
+
+    rows = []
+    for query_file, query_indices, query_distances, details in zip(embedded_files, indices, distances, details_per_query):
+        details = details.set_index('vector_id')
+        for rank, (vector_id, distance) in enumerate(zip(query_indices, query_distances), 1):
+            if vector_id < 0 or vector_id not in details.index:
+                continue
+            row = {"query_file": os.path.basename(query_file), "rank": rank,
+                   "vector_id": int(vector_id), "distance": float(distance)}
+            row.update(details.loc[vector_id].to_dict())
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def write_results(results, output_path):
+    if output_path.endswith(".json"):
+        results.to_json(output_path, orient="records", indent=2)
+    else:
+        results.to_csv(output_path, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find similar tracks for every WAV file of a directory")
+    parser.add_argument("input_dir", type=str, help="Directory containing the WAV files to query")
+    parser.add_argument("output_path", type=str, help="Results file, written as JSON if it ends with .json and as CSV otherwise")
+    parser.add_argument("--top-k", type=int, default=6, help="Number of similar tracks to return per file")
+    parser.add_argument("--batch-size", type=int, default=256, help="Number of files searched together with one index search")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+
+    run_instrumented(lambda: run(args), args.profile, args.metrics_file)
+
+
+def run(args):
+    loaded_config = load_config()
+
+    audio_file_paths = list_wav_files(args.input_dir)
+    logger.info(f"Found {len(audio_file_paths)} WAV files in {args.input_dir}")
+
+    batches = []
+    for start in range(0, len(audio_file_paths), args.batch_size):
+        batches.append(search_batch(audio_file_paths[start:start + args.batch_size], loaded_config, args.top_k))
+
+    results = pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
+    write_results(results, args.output_path)
+    logger.info(f"Wrote {len(results)} results for {results['query_file'].nunique() if not results.empty else 0} files to {args.output_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import os
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+
+# Make the project root importable when the script is run from within this folder
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import faiss
+from similarity_engine.ann_index import INDEX_TYPES, build_index, index_memory_bytes, recall_at_k, set_search_parameters
+from similarity_engine.similarity_search import load_config
+from similarity_engine.vector_database_setup import VectorDatabase
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RESULTS_DIRECTORY = os.path.join(project_root, "benchmarks", "results")
+
+
+def synthetic_corpus(n_vectors, n_queries, dimension, seed=0, chunk_size=50000):
+    """
+    Clustered synthetic embeddings, a closer stand-in for real embeddings than uniform noise.
+
+    Vectors are drawn around n_vectors / 1000 Gaussian centers, chunk by chunk so large
+    corpora do not need temporary copies. Queries come from the same mixture but are not
+    part of the corpus.
+
+    Returns:
+    numpy.array: (n_vectors, dimension) float32 corpus.
+    numpy.array: (n_queries, dimension) float32 queries.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(10, n_vectors // 1000), dimension), dtype=np.float32)
+
+    def draw(count):
+        points = np.empty((count, dimension), dtype=np.float32)
+        for start in range(0, count, chunk_size):
+            stop = min(start + chunk_size, count)
+            points[start:stop] = centers[rng.integers(0, len(centers), stop - start)]
+            points[start:stop] += 0.5 * rng.standard_normal((stop - start, dimension), dtype=np.float32)
+        return points
+
+    return draw(n_vectors), draw(n_queries)
+
+
+def real_corpus(n_queries, seed=0):
+    """
+    The embeddings configured in similarity_engine/config.json, with n_queries of them held out as queries.
+    """
+    vector_db = VectorDatabase(load_config(), load_vectors=True)
+    rng = np.random.default_rng(seed)
+    held_out = np.zeros(len(vector_db.vectors), dtype=bool)
+    held_out[rng.choice(len(vector_db.vectors), size=min(n_queries, len(vector_db.vectors) // 10), replace=False)] = True
+    return np.ascontiguousarray(vector_db.vectors[~held_out]), np.ascontiguousarray(vector_db.vectors[held_out])
+
+
+def measure(index, queries, k, latency_queries):
+    """
+    Search queries with an index.
+
+    Returns:
+    numpy.array: (len(queries), k) indices of the batched search.
+    float: Queries per second of the batched search.
+    float: p50 single query latency in milliseconds.
+    float: p99 single query latency in milliseconds.
+    """
+    start = time.perf_counter()
+    _, indices = index.search(queries, k)
+    qps = len(queries) / (time.perf_counter() - start)
+
+    latencies = []
+    for query in queries[:latency_queries]:
+        start = time.perf_counter()
+        index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return indices, qps, float(np.percentile(latencies, 50)), float(np.percentile(latencies, 99))
+
+
+def sweep(index_type, args):
+    """ Query time parameter settings to measure for an index family, [{}] to keep the defaults. """
+    if index_type.startswith("IVF") and args.nprobe:
+        return [{"nprobe": nprobe} for nprobe in args.nprobe]
+    if index_type == "HNSW" and args.ef_search:
+        return [{"efSearch": ef_search} for ef_search in args.ef_search]
+    return [{}]
+
+
+def benchmark_corpus(corpus_name, vectors, queries, args):
+    """ Build every index type over vectors and measure it against exact FlatL2 search. """
+    rows = []
+    dimension = vectors.shape[1]
+
+    exact = faiss.IndexFlatL2(dimension)
+    exact.add(vectors)
+    _, ground_truth = exact.search(queries, args.k)
+    del exact
+
+    build_params = {key: value for key, value in load_config()["faiss"].items() if key not in ("dimension", "index_type")}
+    for index_type in args.index_types:
+        start = time.perf_counter()
+        index, parameters = build_index(index_type, dimension, vectors, build_params)
+        build_seconds = time.perf_counter() - start
+        memory_mb = index_memory_bytes(index) / 1024 ** 2
+
+        for search_params in sweep(index_type, args):
+            set_search_parameters(index, search_params)
+            indices, qps, p50, p99 = measure(index, queries, args.k, args.latency_queries)
+            used = dict(parameters, **search_params)
+            rows.append({
+                "corpus": corpus_name,
+                "vectors": len(vectors),
+                "dimension": dimension,
+                "index": index_type,
+                "parameters": " ".join(f"{key}={value}" for key, value in used.items()),
+                "build_s": round(build_seconds, 2),
+                "memory_mb": round(memory_mb, 1),
+                f"recall@{args.k}": round(recall_at_k(ground_truth, indices), 4),
+                "qps": round(qps, 1),
+                "p50_ms": round(p50, 3),
+                "p99_ms": round(p99, 3)
+            })
+            logger.info(rows[-1])
+        del index
+    return rows
+
+
+def write_table(rows, output_path):
+    """ Write the results as a markdown table at output_path and as CSV next to it. """
+    results = pd.DataFrame(rows)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    results.to_csv(os.path.splitext(output_path)[0] + ".csv", index=False)
+
+    columns = list(results.columns)
+    lines = ["| " + " | ".join(columns) + " |", "|" + "---|" * len(columns)]
+    lines += ["| " + " | ".join(str(value) for value in row) + " |" for row in results.itertuples(index=False)]
+    with open(output_path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+    print("\n".join(lines))
+    logger.info(f"Benchmark results written to {output_path}")
+
+
+def main():
+    config_dimension = load_config()["faiss"]["dimension"] * 3
+    parser = argparse.ArgumentParser(description="Compare FAISS index families on recall@k against exact search, QPS and latency")
+    parser.add_argument("--source", choices=["synthetic", "real"], default="synthetic",
+                        help="Synthetic clustered corpora or the embeddings configured in similarity_engine/config.json")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000],
+                        help="Synthetic corpus sizes, e.g. 10000 100000 1000000")
+    parser.add_argument("--dimension", type=int, default=config_dimension, help="Dimension of the synthetic vectors")
+    parser.add_argument("--index-types", nargs="+", default=["FlatL2", "IVFFlat", "IVFSQ", "IVFPQ", "HNSW"],
+                        # Cosine is exact search with another metric, its recall against L2 neighbors is meaningless
+                        choices=[index_type for index_type in INDEX_TYPES if index_type != "Cosine"],
+                        help="Index families to compare")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of queries")
+    parser.add_argument("--latency-queries", type=int, default=200, help="Number of single queries timed for p50/p99")
+    parser.add_argument("--k", type=int, default=10, help="Neighbors per query, recall is measured at k")
+    parser.add_argument("--nprobe", type=int, nargs="*", default=None, help="nprobe values to sweep for IVF indexes")
+    parser.add_argument("--ef-search", type=int, nargs="*", default=None, help="efSearch values to sweep for HNSW")
+    parser.add_argument("--threads", type=int, default=None, help="Number of OpenMP threads used by faiss")
+    parser.add_argument("--output", type=str, default=os.path.join(RESULTS_DIRECTORY, "ann_benchmark.md"),
+                        help="Markdown table to write, a CSV with the same name is written next to it")
+    args = parser.parse_args()
+
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+
+    rows = []
+    if args.source == "real":
+        vectors, queries = real_corpus(args.queries)
+        rows += benchmark_corpus("real", vectors, queries, args)
+    else:
+        for size in args.sizes:
+            logger.info(f"Generating a synthetic corpus of {size} x {args.dimension} vectors "
+                        f"({size * args.dimension * 4 / 1024 ** 3:.2f} GiB)")
+            vectors, queries = synthetic_corpus(size, args.queries, args.dimension)
+            rows += benchmark_corpus("synthetic", vectors, queries, args)
+            del vectors, queries
+
+    write_table(rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
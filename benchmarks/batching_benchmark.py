@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+import argparse
+import logging
+import tempfile
+import threading
+import numpy as np
+
+# Make the project root importable when the script is run from within this folder
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import torch
+from benchmarks.ann_benchmark import RESULTS_DIRECTORY, write_table
+from benchmarks.pipeline_benchmark import load_models, synthetic_clip
+from similarity_engine.instrumentation import get_metrics
+from utils.audio_utils import compute_model_inputs, embed_model_inputs, input_parameters, load_audio
+from utils.batching import BatchingScheduler
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+
+def load_test(embed, requests, clients):
+    """
+    Send requests from concurrent clients, every client embedding one request after the other.
+
+    Args:
+    embed (callable): Embeds the model inputs of one request.
+    requests (list of dict): Model inputs of every request.
+    clients (int): Number of concurrent clients.
+
+    Returns:
+    float: Requests per second.
+    numpy.array: Latency of every request in milliseconds.
+    """
+    latencies = [[] for _ in range(clients)]
+
+    def client(number):
+        for inputs in requests[number::clients]:
+            start = time.perf_counter()
+            embed(inputs)
+            latencies[number].append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return len(requests) / elapsed, np.concatenate([np.asarray(samples) for samples in latencies])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the micro-batching scheduler against per-request CNN forward passes")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 32], help="Concurrent client counts to measure")
+    parser.add_argument("--requests", type=int, default=256, help="Requests sent per measurement")
+    parser.add_argument("--max-delay-ms", type=float, nargs="+", default=[2, 5, 10], help="Max delays of the scheduler to measure")
+    parser.add_argument("--max-batch-size", type=int, default=64, help="Most segments per batched forward pass")
+    parser.add_argument("--clip-seconds", type=float, default=30, help="Length of the synthetic clips")
+    parser.add_argument("--models-dir", type=str, default=None,
+                        help="Folder with genre.pt, instruments.pt and mood.pt, synthetic models of the same shape if not given")
+    parser.add_argument("--threads", type=int, default=None, help="Number of torch threads")
+    parser.add_argument("--output", type=str, default=os.path.join(RESULTS_DIRECTORY, "batching_benchmark.md"),
+                        help="Markdown table to write, a CSV with the same name is written next to it")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        models = load_models(args.models_dir, work_dir)
+
+    # Spectrograms are computed once up front, batching only changes the forward passes
+    clips = [synthetic_clip(args.clip_seconds, 22050, seed) for seed in range(8)]
+    clip_inputs = [compute_model_inputs(models, lambda clip=clip: load_audio(clip)) for clip in clips]
+    requests = [clip_inputs[number % len(clip_inputs)] for number in range(args.requests)]
+    # Unbatched, every request runs one forward pass per model over its own segments
+    unbatched_segments = float(np.mean([len(inputs[input_parameters(model_["properties"])])
+                                        for inputs in requests for model_ in models.values()]))
+
+    # Warm-up, the first forward passes pay one-off costs
+    embed_model_inputs(models, requests[0])
+
+    rows = []
+    configurations = [("unbatched", None)] + [(f"batched {delay:g}ms", delay) for delay in args.max_delay_ms]
+    for clients in args.clients:
+        for name, delay in configurations:
+            scheduler = None
+            if delay is None:
+                embed = lambda inputs: embed_model_inputs(models, inputs)
+            else:
+                scheduler = BatchingScheduler(max_batch_size=args.max_batch_size, max_delay=delay / 1000)
+                embed = lambda inputs, scheduler=scheduler: scheduler.embed_model_inputs(models, inputs)
+            get_metrics().clear()
+            throughput, latencies = load_test(embed, requests, clients)
+            if scheduler is not None:
+                scheduler.close()
+
+            metrics = get_metrics()
+            batches = sum(metrics.counter_value("songs_batches_total", model=model) for model in models)
+            segments = sum(metrics.counter_value("songs_batched_segments_total", model=model) for model in models)
+            rows.append({
+                "clients": clients,
+                "mode": name,
+                "requests_per_s": round(throughput, 1),
+                "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+                "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+                "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+                "mean_batch_segments": round(segments / batches, 1) if batches else round(unbatched_segments, 1)
+            })
+            logger.info(rows[-1])
+
+    logger.info(f"Measured with {torch.get_num_threads()} torch threads on {os.cpu_count()} CPU(s)")
+    write_table(rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import io
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import logging
+import platform
+import subprocess
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Make the project root importable when the script is run from within this folder
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import faiss
+import soundfile as sf
+import torch
+from deep_audio_features.models.cnn import CNN1
+from similarity_engine.metadata_store import create_metadata_indexes, fetch_track_details_by_vector_ids, get_engine
+from utils.audio_utils import compute_model_inputs, forward_features, input_parameters, load_audio, segment_signal
+from utils.model_registry import ModelRegistry
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+RESULTS_DIRECTORY = os.path.join(project_root, "benchmarks", "results")
+
+MODEL_NAMES = {"genre": "genre.pt", "instrument": "instruments.pt", "emotion": "mood.pt"}
+
+
+def synthetic_clip(seconds, sample_rate, seed):
+    """ Bytes of a mono 16-bit WAV with a few harmonics and noise, a fixed stand-in for a song. """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    signal = sum(0.2 / (h + 1) * np.sin(2 * np.pi * (110 + 20 * seed) * (h + 1) * t) for h in range(4))
+    signal = signal + 0.05 * rng.standard_normal(t.size)
+    buffer = io.BytesIO()
+    sf.write(buffer, signal.astype('float32'), sample_rate, format='WAV', subtype='PCM_16')
+    return buffer.getvalue()
+
+
+def save_synthetic_model(path, seed):
+    """
+    Save a randomly initialized CNN1 in the format load_cnn reads.
+
+    It has the architecture and spectrogram parameters of the deep_audio_features defaults,
+    so its cost matches a trained model of the same shape.
+    """
+    torch.manual_seed(seed)
+    model = CNN1(height=51, width=128, classes_mapping={0: "a", 1: "b"}, output_dim=2, spec_size=(128, 51))
+    params = {"height": 51, "width": 128, "classes_mapping": {0: "a", 1: "b"}, "output_dim": 2, "zero_pad": False,
+              "spec_size": (128, 51), "fuse": False, "type": "classifier", "max_sequence_length": 200,
+              "state_dict": model.state_dict(), "hop_length": 0.05, "window_length": 0.05}
+    with open(path, "wb") as file:
+        pickle.dump(params, file)
+
+
+def load_models(models_dir, work_dir):
+    """ The three models from models_dir, or synthetic ones written to work_dir if it is None. """
+    if models_dir is None:
+        models_dir = work_dir
+        for seed, file_name in enumerate(MODEL_NAMES.values()):
+            save_synthetic_model(os.path.join(models_dir, file_name), seed)
+    # A private registry, so the model load is not shared with anything else in the process
+    registry = ModelRegistry()
+    return registry.load_models({name: os.path.join(models_dir, file_name) for name, file_name in MODEL_NAMES.items()})
+
+
+def synthetic_metadata_database(work_dir, n_vectors):
+    """ SQLite database with the four metadata tables and their indexes, one track per vector. """
+    db_config = {"url": f"sqlite:///{os.path.join(work_dir, 'metadata.db')}"}
+    engine = get_engine(db_config)
+    track_ids = np.arange(n_vectors) * 2 + 2
+    pd.DataFrame({"track_id": track_ids, "title": [f"Track {i}" for i in track_ids], "date_created": "2008-11-26 01:48:12",
+                  "genre_top": "Rock"}).to_sql("tracks", engine, index=False)
+    pd.DataFrame({"track_id": track_ids, "name": "Artist"}).to_sql("artists", engine, index=False)
+    pd.DataFrame({"track_id": track_ids, "title": "Album"}).to_sql("albums", engine, index=False)
+    pd.DataFrame({"vector_id": np.arange(n_vectors), "track_id": track_ids}).to_sql("vector_metadata", engine, index=False)
+    create_metadata_indexes(engine)
+    return db_config
+
+
+def time_stage(timings, stage, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    timings.setdefault(stage, []).append((time.perf_counter() - start) * 1000)
+    return result
+
+
+def run_query(audio_bytes, models, index, db_config, cached_db_config, top_k, timings):
+    """ One query through every stage of the pipeline, the time of each stage is appended to timings. """
+    start = time.perf_counter()
+    signal, fs = time_stage(timings, "decode", load_audio, audio_bytes)
+    time_stage(timings, "segmentation", segment_signal, signal, fs)
+    inputs = time_stage(timings, "spectrogram", compute_model_inputs, models, lambda: (signal, fs))
+
+    embeddings = []
+    for name, model_ in models.items():
+        properties = model_["properties"]
+        embeddings.append(time_stage(timings, f"cnn_forward_{name}", forward_features,
+                                     inputs[input_parameters(properties)], properties).reshape(-1))
+    embedding = time_stage(timings, "concatenation", np.concatenate, embeddings)
+
+    query = np.ascontiguousarray(embedding, dtype='float32').reshape(1, -1)
+    _, indices = time_stage(timings, "faiss_search", index.search, query, top_k)
+    vector_ids = indices.flatten().tolist()
+    time_stage(timings, "metadata_fetch", fetch_track_details_by_vector_ids, vector_ids, db_config)
+    time_stage(timings, "metadata_fetch_cached", fetch_track_details_by_vector_ids, vector_ids, cached_db_config)
+    timings.setdefault("total", []).append((time.perf_counter() - start) * 1000)
+
+
+def summarize(samples):
+    samples = np.asarray(samples)
+    return {"mean_ms": round(float(samples.mean()), 4), "p50_ms": round(float(np.percentile(samples, 50)), 4),
+            "p95_ms": round(float(np.percentile(samples, 95)), 4), "min_ms": round(float(samples.min()), 4)}
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=project_root, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit or None, "python": platform.python_version(), "platform": platform.platform(),
+            "torch": torch.__version__, "faiss": faiss.__version__, "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads()}
+
+
+def compare(results, baseline_path, threshold):
+    """ Log every stage whose p50 got slower than threshold times the p50 of the baseline results. """
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    regressions = 0
+    for clip, stages in results["clips"].items():
+        for stage, stats in stages.items():
+            reference = baseline.get("clips", {}).get(clip, {}).get(stage)
+            if not reference or reference["p50_ms"] <= 0:
+                continue
+            ratio = stats["p50_ms"] / reference["p50_ms"]
+            if ratio > threshold:
+                regressions += 1
+                logger.warning(f"Regression on {clip}/{stage}: p50 {reference['p50_ms']:.3f}ms -> {stats['p50_ms']:.3f}ms ({ratio:.2f}x)")
+    logger.info(f"{regressions} stage(s) slower than {threshold:.2f}x the baseline {baseline_path}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every stage of the inference pipeline on synthetic clips and a synthetic index")
+    parser.add_argument("--durations", type=float, nargs="+", default=[25, 30, 60],
+                        help="Lengths of the synthetic clips in seconds, above 20 so every clip has its three segments")
+    parser.add_argument("--sample-rate", type=int, default=44100, help="Sampling rate of the synthetic clips")
+    parser.add_argument("--repeats", type=int, default=10, help="Timed queries per clip, after one warm-up query")
+    parser.add_argument("--index-size", type=int, default=8000, help="Number of vectors of the synthetic FlatL2 index")
+    parser.add_argument("--top-k", type=int, default=6, help="Neighbors fetched per query, as in the demo")
+    parser.add_argument("--models-dir", type=str, default=None,
+                        help="Folder with genre.pt, instruments.pt and mood.pt, synthetic models of the same shape if not given")
+    parser.add_argument("--threads", type=int, default=None, help="Number of torch and faiss threads")
+    parser.add_argument("--output", type=str, default=os.path.join(RESULTS_DIRECTORY, "pipeline_benchmark.json"), help="JSON file to write")
+    parser.add_argument("--baseline", type=str, default=None, help="Earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+        faiss.omp_set_num_threads(args.threads)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        models = load_models(args.models_dir, work_dir)
+        clips = {f"{duration:g}s": synthetic_clip(duration, args.sample_rate, seed)
+                 for seed, duration in enumerate(args.durations)}
+
+        # The synthetic index has the dimension of the real concatenated embedding
+        signal, fs = load_audio(next(iter(clips.values())))
+        inputs = compute_model_inputs(models, lambda: (signal, fs))
+        dimension = sum(forward_features(inputs[input_parameters(model_["properties"])], model_["properties"]).size
+                        for model_ in models.values())
+        index = faiss.IndexFlatL2(dimension)
+        index.add(np.random.default_rng(0).standard_normal((args.index_size, dimension), dtype=np.float32))
+
+        db_config = synthetic_metadata_database(work_dir, args.index_size)
+        cached_db_config = dict(db_config, cache_metadata=True)
+
+        results = {"environment": environment(),
+                   "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+                   "index_dimension": dimension,
+                   "clips": {}}
+        for clip, audio_bytes in clips.items():
+            # Warm-up query, the first forward pass and the first metadata query pay one-off costs
+            run_query(audio_bytes, models, index, db_config, cached_db_config, args.top_k, {})
+            timings = {}
+            for _ in range(args.repeats):
+                run_query(audio_bytes, models, index, db_config, cached_db_config, args.top_k, timings)
+            results["clips"][clip] = {stage: summarize(samples) for stage, samples in timings.items()}
+            logger.info(f"{clip}: " + ", ".join(f"{stage} {stats['p50_ms']:.2f}ms" for stage, stats in results["clips"][clip].items()))
+
+        get_engine(db_config).dispose()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=4)
+    logger.info(f"Benchmark results written to {args.output}")
+
+    # Non-zero exit status on regressions, so the comparison can gate a commit
+    if args.baseline and compare(results, args.baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
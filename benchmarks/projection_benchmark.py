@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import argparse
+import logging
+
+# Make the project root importable when the script is run from within this folder
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import faiss
+from benchmarks.ann_benchmark import RESULTS_DIRECTORY, real_corpus, synthetic_corpus, write_table
+from benchmarks.ann_benchmark import measure as measure_index
+from similarity_engine.ann_index import INDEX_TYPES, build_index, index_memory_bytes, recall_at_k
+from similarity_engine.projection import PROJECTION_TYPES, apply_projection, projected_index, train_projection
+from similarity_engine.similarity_search import load_config
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def benchmark_projections(corpus_name, vectors, queries, args):
+    """ Build the index over vectors reduced by every projection and dimension, and measure it against exact search of the unprojected vectors. """
+    rows = []
+    dimension = vectors.shape[1]
+
+    exact = faiss.IndexFlatL2(dimension)
+    exact.add(vectors)
+    _, ground_truth = exact.search(queries, args.k)
+    del exact
+
+    build_params = {key: value for key, value in load_config()["faiss"].items()
+                    if key not in ("dimension", "index_type", "projection", "projection_dimension")}
+    configurations = [("none", dimension)] + [(projection_type, target) for projection_type in args.projections
+                                              for target in args.dimensions if target < dimension]
+    for projection_type, target in configurations:
+        start = time.perf_counter()
+        if projection_type == "none":
+            projection, explained = None, 1.0
+            index, _ = build_index(args.index_type, dimension, vectors, build_params)
+            searched = index
+        else:
+            projection, info = train_projection(projection_type, vectors, target, build_params)
+            explained = info["explained_variance"]
+            index, _ = build_index(args.index_type, target, apply_projection(projection, vectors), build_params)
+            searched = projected_index(projection, index)
+        build_seconds = time.perf_counter() - start
+
+        indices, qps, p50, p99 = measure_index(searched, queries, args.k, args.latency_queries)
+        rows.append({
+            "corpus": corpus_name,
+            "vectors": len(vectors),
+            "index": args.index_type,
+            "projection": projection_type,
+            "dimension": target,
+            "explained_variance": round(explained, 4),
+            "build_s": round(build_seconds, 2),
+            "bytes_per_vector": round(index_memory_bytes(index) / len(vectors), 1),
+            f"recall@{args.k}": round(recall_at_k(ground_truth, indices), 4),
+            "qps": round(qps, 1),
+            "p50_ms": round(p50, 3),
+            "p99_ms": round(p99, 3)
+        })
+        logger.info(rows[-1])
+        del index, searched
+    return rows
+
+
+def main():
+    config_dimension = load_config()["faiss"]["dimension"] * 3
+    parser = argparse.ArgumentParser(description="Compare PCA/OPQ projected indexes with the unprojected index on recall@k against exact search and latency")
+    parser.add_argument("--source", choices=["synthetic", "real"], default="synthetic",
+                        help="Synthetic clustered corpora or the embeddings configured in similarity_engine/config.json")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="Synthetic corpus sizes")
+    parser.add_argument("--dimension", type=int, default=config_dimension, help="Dimension of the synthetic vectors")
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[128, 256, 512, 1024], help="Projected dimensions to measure")
+    parser.add_argument("--projections", nargs="+", default=PROJECTION_TYPES, choices=PROJECTION_TYPES, help="Projections to compare")
+    parser.add_argument("--index-type", default="FlatL2", choices=[index_type for index_type in INDEX_TYPES if index_type != "Cosine"],
+                        help="Index family built over the (projected) vectors")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of queries")
+    parser.add_argument("--latency-queries", type=int, default=200, help="Number of single queries timed for p50/p99")
+    parser.add_argument("--k", type=int, default=10, help="Neighbors per query, recall is measured at k")
+    parser.add_argument("--output", type=str, default=os.path.join(RESULTS_DIRECTORY, "projection_benchmark.md"),
+                        help="Markdown table to write, a CSV with the same name is written next to it")
+    args = parser.parse_args()
+
+    rows = []
+    if args.source == "real":
+        vectors, queries = real_corpus(args.queries)
+        rows += benchmark_projections("real", vectors, queries, args)
+    else:
+        for size in args.sizes:
+            logger.info(f"Generating a synthetic corpus of {size} x {args.dimension} vectors")
+            vectors, queries = synthetic_corpus(size, args.queries, args.dimension)
+            rows += benchmark_projections("synthetic", vectors, queries, args)
+            del vectors, queries
+
+    write_table(rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import argparse
+import logging
+import tempfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Make the project root importable when the script is run from within this folder
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import faiss
+from benchmarks.ann_benchmark import RESULTS_DIRECTORY, synthetic_corpus, write_table
+from similarity_engine.ann_index import build_index, recall_at_k
+from similarity_engine.sharding import ShardSearchCoordinator, shard_of, shard_path
+from similarity_engine.similarity_search import load_config
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def build_shards(index_type, vectors, n_shards, work_dir, params):
+    """ Build and save n_shards indexes over vectors partitioned by id, as VectorDatabase does. """
+    ids = np.arange(len(vectors), dtype=np.int64)
+    shards = shard_of(ids, n_shards)
+    index_path = os.path.join(work_dir, f"{index_type}_{n_shards}.index")
+    paths = []
+    for shard in range(n_shards):
+        rows = np.flatnonzero(shards == shard)
+        index, _ = build_index(index_type, vectors.shape[1], np.ascontiguousarray(vectors[rows]), params, ids=ids[rows])
+        paths.append(shard_path(index_path, shard))
+        faiss.write_index(index, paths[-1])
+        del index
+    return paths
+
+
+def measure(coordinator, queries, k, latency_queries, clients):
+    """
+    Search queries through a coordinator.
+
+    Returns:
+    numpy.array: (len(queries), k) ids of the batched search.
+    float: Queries per second of one batched search.
+    float: Queries per second of single-query searches sent by concurrent clients.
+    float: p50 single query latency in milliseconds.
+    float: p99 single query latency in milliseconds.
+    """
+    start = time.perf_counter()
+    _, indices = coordinator.search(queries, k)
+    batch_qps = len(queries) / (time.perf_counter() - start)
+
+    def single(query):
+        start = time.perf_counter()
+        coordinator.search(query.reshape(1, -1), k)
+        return (time.perf_counter() - start) * 1000
+
+    single_queries = queries[:latency_queries]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = list(executor.map(single, single_queries))
+    concurrent_qps = len(single_queries) / (time.perf_counter() - start)
+    return indices, batch_qps, concurrent_qps, float(np.percentile(latencies, 50)), float(np.percentile(latencies, 99))
+
+
+def main():
+    config_dimension = load_config()["faiss"]["dimension"] * 3
+    parser = argparse.ArgumentParser(description="Measure the throughput of scatter-gather search over index shards held by worker processes")
+    parser.add_argument("--size", type=int, default=200000, help="Number of synthetic vectors")
+    parser.add_argument("--dimension", type=int, default=config_dimension, help="Dimension of the synthetic vectors")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8], help="Shard counts to measure")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes per run, one per shard if not given")
+    parser.add_argument("--index-type", type=str, default="FlatL2", help="Index family of every shard")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of queries of the batched search")
+    parser.add_argument("--latency-queries", type=int, default=500, help="Number of single queries sent by the concurrent clients")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent clients sending single queries")
+    parser.add_argument("--k", type=int, default=10, help="Neighbors per query")
+    parser.add_argument("--output", type=str, default=os.path.join(RESULTS_DIRECTORY, "shard_benchmark.md"),
+                        help="Markdown table to write, a CSV with the same name is written next to it")
+    args = parser.parse_args()
+
+    logger.info(f"Generating a synthetic corpus of {args.size} x {args.dimension} vectors")
+    vectors, queries = synthetic_corpus(args.size, args.queries, args.dimension)
+
+    # Exact results of a single index, every shard count must return the same neighbors
+    exact = faiss.IndexFlatL2(args.dimension)
+    exact.add(vectors)
+    _, ground_truth = exact.search(queries, args.k)
+    del exact
+
+    build_params = {key: value for key, value in load_config()["faiss"].items() if key not in ("dimension", "index_type")}
+    rows = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for n_shards in args.shards:
+            paths = build_shards(args.index_type, vectors, n_shards, work_dir, build_params)
+            workers = min(args.workers or n_shards, n_shards)
+            coordinator = ShardSearchCoordinator(paths, workers=workers, search_params=build_params,
+                                                 dimension=args.dimension, ntotal=len(vectors))
+            try:
+                # Warm-up search, the workers load their shards before answering the first request
+                coordinator.search(queries[:1], args.k)
+                indices, batch_qps, concurrent_qps, p50, p99 = measure(coordinator, queries, args.k,
+                                                                       args.latency_queries, args.clients)
+            finally:
+                coordinator.close()
+            rows.append({
+                "vectors": len(vectors),
+                "dimension": args.dimension,
+                "index": args.index_type,
+                "shards": n_shards,
+                "workers": workers,
+                f"recall@{args.k}": round(recall_at_k(ground_truth, indices), 4),
+                "batch_qps": round(batch_qps, 1),
+                "concurrent_qps": round(concurrent_qps, 1),
+                "p50_ms": round(p50, 3),
+                "p99_ms": round(p99, 3)
+            })
+            logger.info(rows[-1])
+            for path in paths:
+                os.remove(path)
+
+    rows = [dict(row, speedup=round(row["concurrent_qps"] / rows[0]["concurrent_qps"], 2)) for row in rows]
+    logger.info(f"Measured on {os.cpu_count()} CPU(s), shards only scale while there are cores for their workers")
+    write_table(rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+
+# Make the project root importable when the script is run from within this folder
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import faiss
+from benchmarks.ann_benchmark import RESULTS_DIRECTORY, measure, real_corpus, synthetic_corpus, write_table
+from similarity_engine.ann_index import STORAGE_INDEX_TYPES, STORAGE_TYPES, build_index, index_memory_bytes, recall_at_k
+from similarity_engine.embedding_store import STORE_DTYPES
+from similarity_engine.instrumentation import resident_memory_bytes
+from similarity_engine.similarity_search import load_config
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def benchmark_storage(corpus_name, vectors, queries, args):
+    """ Build every index type with every storage over vectors and measure it against exact float32 search. """
+    rows = []
+    dimension = vectors.shape[1]
+
+    exact = faiss.IndexFlatL2(dimension)
+    exact.add(vectors)
+    _, ground_truth = exact.search(queries, args.k)
+    del exact
+
+    build_params = {key: value for key, value in load_config()["faiss"].items() if key not in ("dimension", "index_type")}
+    for index_type in args.index_types:
+        for storage in args.storages:
+            rss_before = resident_memory_bytes()
+            start = time.perf_counter()
+            index, parameters = build_index(index_type, dimension, vectors, dict(build_params, storage=storage))
+            build_seconds = time.perf_counter() - start
+            rss_after = resident_memory_bytes()
+            indices, qps, p50, p99 = measure(index, queries, args.k, args.latency_queries)
+            rows.append({
+                "corpus": corpus_name,
+                "vectors": len(vectors),
+                "dimension": dimension,
+                "index": index_type,
+                "storage": storage,
+                "build_s": round(build_seconds, 2),
+                "index_bytes_per_vector": round(index_memory_bytes(index) / len(vectors), 1),
+                "store_bytes_per_vector": dimension * np.dtype(STORE_DTYPES[storage]).itemsize,
+                "rss_mb": round(rss_after / 1024 ** 2, 1),
+                "build_rss_delta_mb": round((rss_after - rss_before) / 1024 ** 2, 1),
+                f"recall@{args.k}": round(recall_at_k(ground_truth, indices), 4),
+                "qps": round(qps, 1),
+                "p50_ms": round(p50, 3),
+                "p99_ms": round(p99, 3)
+            })
+            logger.info(rows[-1])
+            del index
+    return rows
+
+
+def main():
+    config_dimension = load_config()["faiss"]["dimension"] * 3
+    parser = argparse.ArgumentParser(description="Compare float32, float16 and int8 vector storage on memory, recall@k against exact float32 search and latency")
+    parser.add_argument("--source", choices=["synthetic", "real"], default="synthetic",
+                        help="Synthetic clustered corpora or the embeddings configured in similarity_engine/config.json")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="Synthetic corpus sizes")
+    parser.add_argument("--dimension", type=int, default=config_dimension, help="Dimension of the synthetic vectors")
+    parser.add_argument("--index-types", nargs="+", default=["FlatL2", "HNSW"], choices=[index_type for index_type in STORAGE_INDEX_TYPES if index_type != "Cosine"],
+                        help="Index families to compare")
+    parser.add_argument("--storages", nargs="+", default=list(STORAGE_TYPES), choices=list(STORAGE_TYPES), help="Storage modes to compare")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of queries")
+    parser.add_argument("--latency-queries", type=int, default=200, help="Number of single queries timed for p50/p99")
+    parser.add_argument("--k", type=int, default=10, help="Neighbors per query, recall is measured at k")
+    parser.add_argument("--output", type=str, default=os.path.join(RESULTS_DIRECTORY, "storage_benchmark.md"),
+                        help="Markdown table to write, a CSV with the same name is written next to it")
+    args = parser.parse_args()
+
+    rows = []
+    if args.source == "real":
+        vectors, queries = real_corpus(args.queries)
+        rows += benchmark_storage("real", vectors, queries, args)
+    else:
+        for size in args.sizes:
+            logger.info(f"Generating a synthetic corpus of {size} x {args.dimension} vectors")
+            vectors, queries = synthetic_corpus(size, args.queries, args.dimension)
+            rows += benchmark_storage("synthetic", vectors, queries, args)
+            del vectors, queries
+
+    write_table(rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,25 @@
 import os
+import json
+import time
+import hashlib
+import logging
 import shutil
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path, PurePath
 
 import librosa
 import matplotlib.pyplot as plt
 import numpy as np
+import soundfile as sf
+from tqdm import tqdm
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Manifest of get_wav_data, written in the destination folder
+CONVERSION_MANIFEST = "conversion_manifest.jsonl"
 
 
 def unzip_data(zip_file: str, destination_path: str):
@@ -21,83 +35,240 @@ def unzip_data(zip_file: str, destination_path: str):
     shutil.unpack_archive(zip_file, destination_path, "zip")
 
 
-def get_wav_data(source_folder: str, destination_folder: str, sample_rate: int):
+def file_checksum(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a file, read in chunks.
+
+    Args:
+        path (str): File to hash.
+        chunk_size (int): Bytes read at a time.
+
+    Returns:
+        str: Hex digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(manifest_path: str) -> dict:
+    """Read a conversion manifest, the last record of every source file wins.
+
+    Args:
+        manifest_path (str): JSON lines manifest, one record per attempted file.
+
+    Returns:
+        dict: Source path -> its latest record.
+    """
+    records = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run
+                    continue
+                records[record["source"]] = record
+    return records
+
+
+def is_converted(record: dict, source_file: str, destination_file: str) -> bool:
+    """Whether a manifest record shows the source was converted and neither file changed since.
+
+    Args:
+        record (dict): Latest manifest record of the source, or None.
+        source_file (str): MP3 file.
+        destination_file (str): WAV file it is converted to.
+    """
+    if record is None or record.get("status") != "ok" or not os.path.exists(destination_file):
+        return False
+    source_stat = os.stat(source_file)
+    return (record["size"] == source_stat.st_size and record["mtime_ns"] == source_stat.st_mtime_ns
+            and record["output"] == destination_file and record["output_size"] == os.path.getsize(destination_file))
+
+
+def convert_to_wav(source_file: str, destination_file: str, sample_rate: int) -> dict:
+    """Convert one audio file to a mono WAV with ffmpeg.
+
+    The WAV is written to a temporary file that replaces destination_file once complete, so an
+    interrupted conversion never leaves a truncated WAV behind.
+
+    Args:
+        source_file (str): MP3 file.
+        destination_file (str): WAV file to write.
+        sample_rate (int): The sample frequency of the WAV.
+
+    Returns:
+        dict: Manifest record of the conversion, with status "ok" or "failed".
+    """
+    source_stat = os.stat(source_file)
+    record = {"source": source_file, "size": source_stat.st_size, "mtime_ns": source_stat.st_mtime_ns,
+              "output": destination_file}
+    temp_file = f"{destination_file}.part"
+    result = subprocess.run(
+        ["ffmpeg", "-y", "-i", source_file, "-ac", "1", "-ar", str(sample_rate), "-loglevel", "error", "-f", "wav", temp_file],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    if result.returncode != 0 or not os.path.exists(temp_file):
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        record.update(status="failed", error=result.stderr.strip()[-500:] or f"ffmpeg exited with {result.returncode}")
+        return record
+    os.replace(temp_file, destination_file)
+    record.update(status="ok", output_size=os.path.getsize(destination_file), sha256=file_checksum(destination_file))
+    return record
+
+
+def get_wav_data(source_folder: str, destination_folder: str, sample_rate: int, workers: int = None,
+                 manifest_path: str = None) -> dict:
     """Convert audio data of the source folder to wav format with sample rate 44,1kHz.
     Additionally convert form stereo to mono.
 
+    Files are converted by a pool of ffmpeg processes. Every conversion is appended to a manifest
+    (source path, size, mtime, output checksum) as soon as it finishes, so an interrupted run
+    resumes where it stopped and files already converted are skipped on later runs. Files
+    that fail are recorded in the manifest with the ffmpeg error and retried on the next run,
+    they do not abort the others.
+
     Args:
         source_folder (str): Source folder of MP3 data.
         destination_folder (str): The directory we want the train and test sets to be saved.
         sample_rate (int): The sample frequency to use when converting MP3 to WAV.
+        workers (int): Number of conversions run at the same time, the number of CPUs by default.
+        manifest_path (str): Manifest file, conversion_manifest.jsonl in destination_folder by default.
+
+    Returns:
+        dict: Number of files converted, skipped and failed.
     """
     if not os.path.exists(destination_folder):
         os.makedirs(destination_folder)
+    manifest_path = manifest_path or os.path.join(destination_folder, CONVERSION_MANIFEST)
+    workers = workers or os.cpu_count() or 1
+
+    jobs = []
+    for folder in sorted(os.listdir(source_folder)):
+        if os.path.isdir(os.path.join(source_folder, folder)):
+            for file in sorted(os.listdir(os.path.join(source_folder, folder))):
+                source_file = str(Path(*PurePath(os.path.join(source_folder, folder, file)).parts))
+                destination_file = str(Path(*PurePath(os.path.join(destination_folder, file[:-4] + ".wav")).parts))
+                jobs.append((source_file, destination_file))
 
-    folders = os.listdir(source_folder)
-    for folder in folders:
-        if os.path.isdir(os.path.abspath(source_folder + folder)):
-            files = os.listdir(source_folder + folder)
-            for file in files:
-                source_file = list(
-                    PurePath(os.path.join(source_folder, folder, file)).parts
-                )
-                destiantion_file = list(
-                    PurePath(os.path.join(destination_folder, file[:-4] + ".wav")).parts
-                )
-
-                source_file = Path(*source_file)
-                destiantion_file = Path(*destiantion_file)
-                subprocess.call(
-                    [
-                        "ffmpeg",
-                        "-i",
-                        source_file,
-                        "-ac",
-                        "1",
-                        destiantion_file,
-                        "-ar",
-                        str(sample_rate),
-                        "-loglevel",
-                        "error",
-                    ]
-                )
-
-
-def segment_audio(source_folder: str, destination_folder: str):
-    """Segment every audio file in the directory into 10 second segments. Additionally the parent
-    file is deleted along with segments that are less than 2 seconds long.
+    manifest = load_manifest(manifest_path)
+    pending = [(source, destination) for source, destination in jobs
+               if not is_converted(manifest.get(source), source, destination)]
+    summary = {"converted": 0, "skipped": len(jobs) - len(pending), "failed": 0}
+    logger.info(f"{len(jobs)} files found, {summary['skipped']} already converted, converting {len(pending)} with {workers} workers")
+
+    # ffmpeg does the work in its own process, the threads only start it and hash its output
+    source_bytes = 0
+    start = time.perf_counter()
+    with open(manifest_path, "a") as manifest_file, ThreadPoolExecutor(max_workers=workers) as executor, \
+            tqdm(total=len(pending), unit="file") as progress:
+        futures = [executor.submit(convert_to_wav, source, destination, sample_rate) for source, destination in pending]
+        for future in as_completed(futures):
+            record = future.result()
+            manifest_file.write(json.dumps(record) + "\n")
+            manifest_file.flush()
+            if record["status"] == "ok":
+                summary["converted"] += 1
+                source_bytes += record["size"]
+            else:
+                summary["failed"] += 1
+                logger.warning(f"Could not convert {record['source']}: {record['error']}")
+            progress.update(1)
+            progress.set_postfix(failed=summary["failed"], mb_per_s=round(source_bytes / 1024 ** 2 / max(time.perf_counter() - start, 1e-9), 1))
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"Converted {summary['converted']} files ({summary['failed']} failed, {summary['skipped']} skipped) in "
+                f"{elapsed:.1f}s, {summary['converted'] / max(elapsed, 1e-9):.1f} files/s, "
+                f"{source_bytes / 1024 ** 2 / max(elapsed, 1e-9):.1f} MB/s of MP3. Manifest: {manifest_path}")
+    return summary
+
+
+def segment_wav(source_file: str, destination_folder: str, segment_seconds: float = 10,
+                min_seconds: float = 2) -> int:
+    """Cut a WAV file into consecutive segments of segment_seconds, named <name>_<i>.wav.
+
+    Segment boundaries are computed from the frame count and sample rate of the WAV header,
+    the file is then read once, segment after segment, and every segment is written with the
+    sample format of the source. Segments of min_seconds or less (the tail of the file) are
+    not written at all.
+
+    Args:
+        source_file (str): WAV file to cut.
+        destination_folder (str): Folder where the segments are stored.
+        segment_seconds (float): Length of every segment.
+        min_seconds (float): Segments of at most this length are skipped.
+
+    Returns:
+        int: Number of segments written.
+    """
+    name = os.path.splitext(os.path.basename(source_file))[0]
+    written = 0
+    with sf.SoundFile(source_file) as wav:
+        segment_frames = int(segment_seconds * wav.samplerate)
+        for number, start in enumerate(range(0, wav.frames, segment_frames)):
+            frames = min(segment_frames, wav.frames - start)
+            if frames / wav.samplerate <= min_seconds:
+                break
+            # Integer PCM is read as int32 so it is written back bit for bit
+            data = wav.read(frames, dtype="float64" if wav.subtype in ("FLOAT", "DOUBLE") else "int32", always_2d=True)
+            sf.write(os.path.join(destination_folder, f"{name}_{number}.wav"), data, wav.samplerate,
+                     subtype=wav.subtype, format="WAV")
+            written += 1
+    return written
+
+
+def _segment_wav_job(job):
+    source_file, destination_folder, segment_seconds, min_seconds = job
+    try:
+        return source_file, segment_wav(source_file, destination_folder, segment_seconds, min_seconds), None
+    except Exception as e:
+        return source_file, 0, str(e)
+
+
+def segment_audio(source_folder: str, destination_folder: str, workers: int = None, segment_seconds: float = 10,
+                  min_seconds: float = 2) -> dict:
+    """Segment every audio file in the directory into 10 second segments. Segments that are
+    2 seconds long or less are skipped.
+
+    Files are segmented by a pool of worker processes, each file in a single pass (see segment_wav).
 
     Args:
         source_folder (str): Folder containing audio files.
         destination_folder (str): Folder where the segmented files will be stored.
+        workers (int): Number of worker processes, the number of CPUs by default.
+        segment_seconds (float): Length of every segment.
+        min_seconds (float): Segments of at most this length are skipped.
+
+    Returns:
+        dict: Number of files segmented and failed, and of segments written.
     """
     if not os.path.exists(destination_folder):
         os.makedirs(destination_folder)
-    # make segmention files and delete parent
-    wav_files = os.listdir(source_folder)
-    for wav in wav_files:
-        if wav.endswith(".wav"):
-            subprocess.call(
-                [
-                    "ffmpeg",
-                    "-i",
-                    source_folder + wav,
-                    "-f",
-                    "segment",
-                    "-segment_time",
-                    "10",
-                    f"{destination_folder}{wav[:-4]}_%0d.wav",
-                    "-loglevel",
-                    "error",
-                ]
-            )
-
-    # delete segments less than 2 seconds
-    wav_files = os.listdir(destination_folder)
-    for wav in wav_files:
-        duration = librosa.get_duration(path=destination_folder + wav)
-        if duration <= 2:
-            os.remove(destination_folder + wav)
+    workers = workers or os.cpu_count() or 1
+    jobs = [(os.path.join(source_folder, wav), destination_folder, segment_seconds, min_seconds)
+            for wav in sorted(os.listdir(source_folder)) if wav.endswith(".wav")]
+
+    summary = {"files": 0, "failed": 0, "segments": 0}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor, tqdm(total=len(jobs), unit="file") as progress:
+        # Chunks amortize the inter-process overhead over many short files
+        for source_file, segments, error in executor.map(_segment_wav_job, jobs, chunksize=max(1, min(64, len(jobs) // (workers * 4)))):
+            if error is None:
+                summary["files"] += 1
+                summary["segments"] += segments
+            else:
+                summary["failed"] += 1
+                logger.warning(f"Could not segment {source_file}: {error}")
+            progress.update(1)
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"Wrote {summary['segments']} segments of {summary['files']} files ({summary['failed']} failed) "
+                f"in {elapsed:.1f}s with {workers} workers")
+    return summary
 
 
 def get_spect(file_path: str, destination: str):
@@ -0,0 +1,298 @@
+import os
+import sys
+import time
+import queue
+import argparse
+import logging
+import threading
+
+# Make the project root importable when the script is run directly
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import librosa
+import numpy as np
+from tqdm import tqdm
+from similarity_engine.embedding_store import MODALITIES, EmbeddingStore, open_embedding_stores
+from utils.audio_utils import SEGMENT_DURATION, compute_model_inputs, forward_features, input_parameters
+from utils.model_registry import get_model_registry
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+# Model of every modality of the embedding store
+MODEL_PATHS = {
+    "genre": os.path.join(project_root, "models", "genre.pt"),
+    "instrument": os.path.join(project_root, "models", "instruments.pt"),
+    "emotion": os.path.join(project_root, "models", "mood.pt")
+}
+
+# Tracks need two full segments and a remainder longer than this, like the segments kept by segment_audio
+MIN_TAIL_SECONDS = 2
+
+# Marks the end of the stream in the queues
+_END = object()
+
+
+def find_audio_files(source_folder: str, extensions=(".mp3",)) -> list:
+    """List the audio files under source_folder (e.g. the fma_small/<000-155>/ folders), sorted by track_id.
+
+    Args:
+        source_folder (str): Folder searched recursively.
+        extensions (tuple): File extensions to ingest.
+
+    Returns:
+        list: (track_id, path) of every file named <track_id>.<extension>.
+    """
+    files = []
+    for folder, _, names in os.walk(source_folder):
+        for name in names:
+            stem, extension = os.path.splitext(name)
+            if extension.lower() not in extensions:
+                continue
+            try:
+                files.append((int(stem), os.path.join(folder, name)))
+            except ValueError:
+                logger.warning(f"Skipping {name}, its name is not a track_id.")
+    return sorted(files)
+
+
+def decode_track(path: str, sample_rate: int):
+    """Decode an audio file once into the mono signal get_wav_data would have written.
+
+    Args:
+        path (str): Audio file, MP3 or anything else librosa reads.
+        sample_rate (int): Sampling rate of the signal, the one used for the WAV conversion.
+
+    Returns:
+        numpy.array: The mono signal.
+        int: Its sampling rate.
+    """
+    signal, fs = librosa.load(path, sr=sample_rate, mono=True)
+    return signal, fs
+
+
+def open_or_create_stores(store_folder: str, dimension: int) -> dict:
+    """The EmbeddingStore of every modality under store_folder, created empty if missing."""
+    stores = open_embedding_stores(store_folder)
+    for modality in MODALITIES:
+        if modality not in stores:
+            stores[modality] = EmbeddingStore.create(os.path.join(store_folder, modality), dimension)
+        elif stores[modality].dimension != dimension:
+            raise ValueError(f"The {modality} store has dimension {stores[modality].dimension}, the models produce {dimension}.")
+    return stores
+
+
+class IngestionPipeline:
+    """
+    Streams audio files into the embedding stores, without writing WAVs, segments or .npy files.
+
+    Three stages are connected by bounded queues, so decoding and inference overlap and memory
+    stays bounded however large the catalog is:
+
+    1. decode_workers threads decode every file once and compute the spectrogram of each of its
+       segments in memory (decoding and the spectrograms release the GIL in libsndfile, soxr and numpy).
+    2. One inference thread stacks the segments of up to batch_size tracks and runs a single
+       forward pass per model.
+    3. The calling thread appends the concatenated segment embeddings of every modality to its store.
+
+    Tracks already in every store are skipped, so an interrupted ingestion resumes by track_id.
+    """
+
+    def __init__(self, models: dict, store_folder: str, sample_rate: int = 44100, decode_workers: int = None,
+                 batch_size: int = 16, queue_size: int = 64):
+        """
+        Args:
+            models (dict): {modality: {"properties": properties}} for every modality of MODALITIES.
+            store_folder (str): Folder of the embedding stores, one sub folder per modality.
+            sample_rate (int): Sampling rate the audio is decoded at.
+            decode_workers (int): Number of decode threads, the number of CPUs by default.
+            batch_size (int): Tracks forwarded together through each model.
+            queue_size (int): Capacity of each queue between the stages, in tracks.
+        """
+        self.models = {modality: models[modality] for modality in MODALITIES}
+        self.store_folder = store_folder
+        self.sample_rate = sample_rate
+        self.decode_workers = decode_workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.failures = []
+        self._failures_lock = threading.Lock()
+
+    def _fail(self, track_id, path, error):
+        with self._failures_lock:
+            self.failures.append({"track_id": track_id, "path": path, "error": str(error) or repr(error)})
+        logger.warning(f"Skipping track {track_id} ({path}): {str(error) or repr(error)}")
+
+    def iter_segment_inputs(self, files):
+        """Decode files one after the other and yield (track_id, model inputs of its segments)."""
+        for track_id, path in files:
+            try:
+                signal, fs = decode_track(path, self.sample_rate)
+                if len(signal) <= (2 * SEGMENT_DURATION + MIN_TAIL_SECONDS) * fs:
+                    raise ValueError(f"{len(signal) / fs:.1f}s is too short for three segments")
+                yield track_id, compute_model_inputs(self.models, lambda: (signal, fs))
+            except Exception as e:
+                self._fail(track_id, path, e)
+
+    def embed_batch(self, batch):
+        """
+        Forward the segments of a batch of tracks through every model.
+
+        Args:
+            batch (list): (track_id, inputs) of every track, as yielded by iter_segment_inputs.
+
+        Returns:
+            numpy.array: The track_ids.
+            dict: modality -> (len(batch), n_segments * embedding_dimension) embeddings.
+        """
+        track_ids = np.array([track_id for track_id, _ in batch], dtype=np.int64)
+        embeddings = {}
+        for modality, model_ in self.models.items():
+            properties = model_["properties"]
+            key = input_parameters(properties)
+            segments = np.concatenate([inputs[key] for _, inputs in batch])
+            # Segments of a track are consecutive rows, so they are concatenated in segment order
+            embeddings[modality] = forward_features(segments, properties).reshape(len(batch), -1)
+        return track_ids, embeddings
+
+    def run(self, files):
+        """
+        Ingest files into the embedding stores.
+
+        Args:
+            files (list): (track_id, path) of every file, see find_audio_files.
+
+        Returns:
+            dict: Number of tracks found, skipped because already stored, ingested and failed.
+        """
+        decoded = queue.Queue(maxsize=self.queue_size)
+        embedded = queue.Queue(maxsize=max(1, self.queue_size // self.batch_size))
+        files = list(files)
+        stores = None
+        done = set()
+        if any(EmbeddingStore.exists(os.path.join(self.store_folder, modality)) for modality in MODALITIES):
+            existing = open_embedding_stores(self.store_folder)
+            if len(existing) == len(MODALITIES):
+                done = set(np.asarray(existing[MODALITIES[0]].track_ids).tolist())
+                for modality in MODALITIES[1:]:
+                    done.intersection_update(np.asarray(existing[modality].track_ids).tolist())
+        pending = [(track_id, path) for track_id, path in files if track_id not in done]
+        summary = {"found": len(files), "skipped": len(files) - len(pending), "ingested": 0, "failed": 0}
+        logger.info(f"{len(files)} tracks found, {summary['skipped']} already stored, ingesting {len(pending)}")
+        if not pending:
+            return summary
+
+        # Every decode worker takes the next file from a shared iterator
+        pending_iterator = iter(pending)
+        pending_lock = threading.Lock()
+
+        def next_files():
+            while True:
+                with pending_lock:
+                    item = next(pending_iterator, None)
+                if item is None:
+                    return
+                yield item
+
+        def decode_worker():
+            try:
+                for item in self.iter_segment_inputs(next_files()):
+                    decoded.put(item)
+            finally:
+                decoded.put(_END)
+
+        def inference_worker():
+            finished_decoders = 0
+            batch = []
+            try:
+                while finished_decoders < self.decode_workers:
+                    item = decoded.get()
+                    if item is _END:
+                        finished_decoders += 1
+                    else:
+                        batch.append(item)
+                    # Forward full batches, or whatever is ready when the decoders fall behind
+                    if batch and (len(batch) >= self.batch_size or decoded.empty() or finished_decoders == self.decode_workers):
+                        try:
+                            embedded.put(self.embed_batch(batch))
+                        except Exception as e:
+                            for track_id, _ in batch:
+                                self._fail(track_id, None, e)
+                        batch = []
+            finally:
+                embedded.put(_END)
+
+        threads = [threading.Thread(target=decode_worker, name=f"ingest-decode-{number}", daemon=True)
+                   for number in range(self.decode_workers)]
+        threads.append(threading.Thread(target=inference_worker, name="ingest-inference", daemon=True))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        # The writer runs in the calling thread, it owns the stores
+        with tqdm(total=len(pending), unit="track") as progress:
+            while True:
+                item = embedded.get()
+                if item is _END:
+                    break
+                track_ids, embeddings = item
+                if stores is None:
+                    stores = open_or_create_stores(self.store_folder, next(iter(embeddings.values())).shape[1])
+                for modality in MODALITIES:
+                    stores[modality].append(track_ids, embeddings[modality])
+                summary["ingested"] += len(track_ids)
+                progress.update(len(track_ids))
+        for thread in threads:
+            thread.join()
+
+        summary["failed"] = len(self.failures)
+        elapsed = time.perf_counter() - start
+        logger.info(f"Ingested {summary['ingested']} tracks ({summary['failed']} failed) in {elapsed:.1f}s, "
+                    f"{summary['ingested'] / max(elapsed, 1e-9):.1f} tracks/s, into {self.store_folder}")
+        return summary
+
+
+def ingest_audio(source_folder: str, store_folder: str, model_paths: dict = None, sample_rate: int = 44100,
+                 decode_workers: int = None, batch_size: int = 16, queue_size: int = 64,
+                 extensions=(".mp3",)) -> dict:
+    """Embed every audio file of source_folder straight into the embedding stores of store_folder.
+
+    Args:
+        source_folder (str): Folder of the MP3 files, searched recursively.
+        store_folder (str): Folder of the embedding stores, e.g. concatenated_embeddings/store/.
+        model_paths (dict): Model of every modality, the models/ folder of the project by default.
+        sample_rate (int): Sampling rate the audio is decoded at.
+        decode_workers (int): Number of decode threads, the number of CPUs by default.
+        batch_size (int): Tracks forwarded together through each model.
+        queue_size (int): Capacity of each queue between the stages, in tracks.
+        extensions (tuple): File extensions to ingest.
+
+    Returns:
+        dict: Number of tracks found, skipped, ingested and failed.
+    """
+    models = get_model_registry().load_models(model_paths or MODEL_PATHS)
+    pipeline = IngestionPipeline(models, store_folder, sample_rate, decode_workers, batch_size, queue_size)
+    return pipeline.run(find_audio_files(source_folder, extensions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed MP3 files straight into the embedding stores, without intermediate files")
+    parser.add_argument("source_folder", type=str, help="Folder of the MP3 files, e.g. data/fma_small/")
+    parser.add_argument("store_folder", type=str, help="Folder of the embedding stores, e.g. concatenated_embeddings/store/")
+    parser.add_argument("--sample-rate", type=int, default=44100, help="Sampling rate the audio is decoded at")
+    parser.add_argument("--workers", type=int, default=None, help="Decode threads, the number of CPUs by default")
+    parser.add_argument("--batch-size", type=int, default=16, help="Tracks forwarded together through each model")
+    parser.add_argument("--queue-size", type=int, default=64, help="Tracks buffered between the stages")
+    parser.add_argument("--extensions", nargs="+", default=[".mp3"], help="File extensions to ingest")
+    args = parser.parse_args()
+
+    summary = ingest_audio(args.source_folder, args.store_folder, sample_rate=args.sample_rate, decode_workers=args.workers,
+                           batch_size=args.batch_size, queue_size=args.queue_size, extensions=tuple(args.extensions))
+    logger.info(summary)
+
+
+if __name__ == "__main__":
+    main()
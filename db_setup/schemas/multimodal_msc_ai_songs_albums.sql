@@ -36,7 +36,8 @@ CREATE TABLE `albums` (
   `tags` text,
   `title` text,
   `tracks` bigint DEFAULT NULL,
-  `type` text
+  `type` text,
+  KEY `ix_albums_track_id` (`track_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
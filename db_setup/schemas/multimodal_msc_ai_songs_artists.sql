@@ -40,7 +40,8 @@ CREATE TABLE `artists` (
   `related_projects` text,
   `tags` text,
   `website` text,
-  `wikipedia_page` text
+  `wikipedia_page` text,
+  KEY `ix_artists_track_id` (`track_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
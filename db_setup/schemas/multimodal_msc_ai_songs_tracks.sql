@@ -43,7 +43,8 @@ CREATE TABLE `tracks` (
   `number` bigint DEFAULT NULL,
   `publisher` text,
   `tags` text,
-  `title` text
+  `title` text,
+  KEY `ix_tracks_track_id` (`track_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
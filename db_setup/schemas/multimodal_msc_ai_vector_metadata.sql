@@ -4,5 +4,7 @@ CREATE TABLE `vector_metadata` (
   `track_id` int DEFAULT NULL,
   `vector_dimensions` int DEFAULT NULL,
   `faiss_index` varchar(255) DEFAULT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  KEY `ix_vector_metadata_vector_id` (`vector_id`),
+  KEY `ix_vector_metadata_track_id` (`track_id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=8192 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
\ No newline at end of file
@@ -1,5 +1,20 @@
+import os
+import sys
+import time
+import argparse
+import logging
 import pandas as pd
-from sqlalchemy import create_engine
+
+# Make the project root importable when the script is run from within this folder
+project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, project_root)
+
+from similarity_engine.metadata_store import create_metadata_indexes
+from sqlalchemy import create_engine, text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 # Replace 'your_username', 'your_password', and 'your_database' with your MySQL user, password, and database
 username = 'your_username'
@@ -10,21 +25,100 @@ port = '3306' # Default MySQL port
 # Considering you have named the schema as the name bellow
 database = 'multimodal_msc_ai_songs'
 
-# Create the connection engine
-engine = create_engine(f"mysql+mysqldb://{username}:{password}@{host}:{port}/{database}")
+# Folder of the parsed CSV files, next to this script by default
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TABLES = {
+    'tracks': 'tracks_parsed.csv',
+    'albums': 'albums_parsed.csv',
+    'artists': 'artists_parsed.csv'
+}
+
+def load_data_infile(engine, table_name, csv_path, dataframe):
+    """
+    Bulk load a CSV into an existing MySQL table with LOAD DATA LOCAL INFILE.
+
+    Empty fields are loaded as NULL, the same way pandas reads them.
+    """
+    columns = list(dataframe.columns)
+    variables = ', '.join(f'@c{i}' for i in range(len(columns)))
+    assignments = ', '.join(f'`{column}` = NULLIF(@c{i}, \'\')' for i, column in enumerate(columns))
+    statement = (f"LOAD DATA LOCAL INFILE '{os.path.abspath(csv_path).replace(os.sep, '/')}' INTO TABLE `{table_name}` "
+                 "CHARACTER SET utf8mb4 FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' "
+                 f"LINES TERMINATED BY '\\n' IGNORE 1 LINES ({variables}) SET {assignments}")
+    with engine.begin() as connection:
+        connection.execute(text(statement))
+
+
+def load_table(engine, table_name, csv_path, chunksize=5000, use_load_data=True):
+    """
+    Replace table_name with the contents of csv_path.
+
+    The table is created from the column types pandas infers for the whole file, then the rows
+    are bulk loaded with LOAD DATA on MySQL, falling back to chunked batched INSERTs (always
+    used on other databases) inside a single transaction. Each chunk is sent as one executemany,
+    which mysqlclient rewrites into multi-row INSERT statements.
+
+    Returns:
+    float: Loading throughput in rows per second.
+    """
+    start = time.perf_counter()
+
+    # Load the CSV with UTF-8 encoding
+    dataframe = pd.read_csv(csv_path, encoding='utf-8')
+
+    # Create the (empty) table with the schema inferred from the whole file
+    dataframe.head(0).to_sql(table_name, con=engine, if_exists='replace', index=False)
+
+    loaded = False
+    if use_load_data and engine.dialect.name == 'mysql':
+        try:
+            load_data_infile(engine, table_name, csv_path, dataframe)
+            loaded = True
+        except Exception as e:
+            logger.warning(f"LOAD DATA failed for {table_name} ({e}), falling back to chunked INSERTs.")
+
+    if not loaded:
+        with engine.begin() as connection:
+            dataframe.to_sql(table_name, con=connection, if_exists='append', index=False, chunksize=chunksize)
+
+    elapsed = time.perf_counter() - start
+    rows_per_second = len(dataframe) / elapsed if elapsed > 0 else float('inf')
+    logger.info(f"Loaded {len(dataframe)} rows into {table_name} in {elapsed:.2f}s ({rows_per_second:,.0f} rows/sec).")
+    return rows_per_second
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load the parsed FMA metadata CSVs into the database")
+    parser.add_argument("--url", type=str, default=None,
+                        help="SQLAlchemy URL of the database, e.g. sqlite:///songs.db (defaults to the MySQL credentials in this script)")
+    parser.add_argument("--data-dir", type=str, default=DATA_DIR, help="Folder containing the parsed CSV files")
+    parser.add_argument("--chunksize", type=int, default=5000, help="Rows per batched INSERT")
+    parser.add_argument("--no-load-data", action="store_true", help="Do not use LOAD DATA LOCAL INFILE on MySQL")
+    args = parser.parse_args()
+
+    # Create the connection engine
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        engine = create_engine(f"mysql+mysqldb://{username}:{password}@{host}:{port}/{database}",
+                               connect_args={"local_infile": 1})
 
-# Load the tracks CSV with UTF-8 encoding
-tracks = pd.read_csv('./tracks_parsed.csv', encoding='utf-8')
+    start = time.perf_counter()
+    total_rows = 0
+    for table_name, file_name in TABLES.items():
+        csv_path = os.path.join(args.data_dir, file_name)
+        load_table(engine, table_name, csv_path, chunksize=args.chunksize, use_load_data=not args.no_load_data)
+        with engine.connect() as connection:
+            total_rows += connection.execute(text(f"SELECT COUNT(*) FROM {table_name}")).scalar()
 
-# Load the CSV with UTF-8 encoding
-albums = pd.read_csv('./albums_parsed.csv', encoding='utf-8')
+    # Indexes are created once the data is in, which is much cheaper than maintaining them per row
+    create_metadata_indexes(engine)
 
-# Load the CSV with UTF-8 encoding
-artists = pd.read_csv('./artists_parsed.csv', encoding='utf-8')
+    elapsed = time.perf_counter() - start
+    logger.info(f"Data has been successfully loaded into the database: {total_rows} rows in {elapsed:.2f}s "
+                f"({total_rows / elapsed:,.0f} rows/sec overall).")
 
-# Write the dataframes to SQL
-tracks.to_sql('tracks', con=engine, if_exists='replace', index=False)
-albums.to_sql('albums', con=engine, if_exists='replace', index=False)
-artists.to_sql('artists', con=engine, if_exists='replace', index=False)
 
-print("Data has been successfully loaded into the database.")
+if __name__ == "__main__":
+    main()
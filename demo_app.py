@@ -1,6 +1,12 @@
 import streamlit as st
 import os
+import json
+import urllib.request
+import pandas as pd
 from inference_similar_songs import process_audio_to_embeddings, perform_similarity_search, fetch_track_details, load_config, find_embeddings_in_local_path
+from utils.model_registry import get_model_registry
+from utils.query_cache import get_query_cache
+from similarity_engine.instrumentation import request_trace, start_metrics_server
 import warnings
 import logging
 
@@ -22,6 +28,9 @@ SONGS_DIR = os.path.abspath(os.path.join(PROJECT_ROOT, '..', 'songs'))
 # Ensure the directory exists
 os.makedirs(WAV_FILES_DIR, exist_ok=True)
 
+# With SONGS_SEARCH_SERVICE_URL set (e.g. http://127.0.0.1:8080), the app is a thin client of search_service.py
+SEARCH_SERVICE_URL = os.environ.get("SONGS_SEARCH_SERVICE_URL")
+
 st.title('Audio Similarity Finder')
 st.write("Upload a WAV file to find similar tracks based on audio features.")
 
@@ -33,6 +42,29 @@ models_path = [
     os.path.join(PROJECT_ROOT, "models", "mood.pt")
 ]
 
+@st.cache_resource
+def load_models():
+    # Load the models once and keep them resident across Streamlit reruns
+    return get_model_registry().load_models(dict(zip(["genre", "instrument", "emotion"], models_path)))
+
+def search_service_similar(audio_bytes, top_k=6):
+    # Upload the audio to the search service, which keeps the models, index and metadata warm
+    request = urllib.request.Request(f"{SEARCH_SERVICE_URL.rstrip('/')}/similar/audio?top_k={top_k}", data=audio_bytes,
+                                     headers={"Content-Type": "audio/wav"}, method="POST")
+    with urllib.request.urlopen(request, timeout=120) as response:
+        return pd.DataFrame(json.loads(response.read())["results"])
+
+if SEARCH_SERVICE_URL is None:
+    load_models()
+
+@st.cache_resource
+def metrics_server():
+    # Prometheus metrics of the app at :$SONGS_METRICS_PORT/metrics, started once per process
+    port = os.environ.get("SONGS_METRICS_PORT")
+    return start_metrics_server(int(port)) if port else None
+
+metrics_server()
+
 if uploaded_file is not None:
     # Save the uploaded WAV file to the test_wav_files directory
     file_path = os.path.join(WAV_FILES_DIR, uploaded_file.name)
@@ -43,22 +75,30 @@ if uploaded_file is not None:
     # Display the uploaded audio file to allow playback
     st.audio(file_path, format='audio/wav', start_time=0)
 
-    # Process the audio file to get embeddings
-    #embeddings = find_embeddings_in_local_path(file_path)
-    embeddings = find_embeddings_in_local_path(file_path)
+    if SEARCH_SERVICE_URL is not None:
+        track_details = search_service_similar(uploaded_file.getvalue())
+        vector_ids = track_details['track_id'].tolist() if not track_details.empty else []
+    else:
+        # Every stage of the request is timed and logged as one structured line
+        with request_trace("upload", file=uploaded_file.name):
+            # Process the audio file to get embeddings
+            #embeddings = find_embeddings_in_local_path(file_path)
+            embeddings = find_embeddings_in_local_path(file_path)
+
+            if embeddings is None:
+                # Embed the uploaded bytes directly, without reading the saved file back
+                embeddings = process_audio_to_embeddings(uploaded_file.getvalue(), models_path)
 
-    if embeddings is None:
-        embeddings = process_audio_to_embeddings(file_path, models_path)
+            loaded_config = load_config()
 
-    loaded_config = load_config()
+            # Perform similarity search
+            top_neighbors_indices, _ = perform_similarity_search(embeddings, loaded_config, query_cache=get_query_cache())
+            vector_ids = top_neighbors_indices.flatten().tolist()
 
-    # Perform similarity search
-    top_neighbors_indices, _ = perform_similarity_search(embeddings, loaded_config)
-    vector_ids = top_neighbors_indices.flatten().tolist()
+            # Fetch track details
+            track_details = fetch_track_details(vector_ids, loaded_config) if vector_ids else None
 
-    # Fetch track details
     if vector_ids:
-        track_details = fetch_track_details(vector_ids, loaded_config)
 
         # Extract the file name from the path
         file_name = os.path.basename(file_path)
@@ -1,31 +1,22 @@
 import sys
 import os
+import argparse
 
 # Assuming the script is run from within the root directory of the project
 project_root = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, project_root)
 
-from utils.audio_utils import process_file, process_file_custom
-
-
-from pydub import AudioSegment
-import os
-import numpy as np
-from deep_audio_features.bin import basic_test as btest
-from deep_audio_features.models.cnn import load_cnn
-from similarity_engine.similarity_search import SimilaritySearch, load_config
-from utils.audio_utils import process_file
-from utils import find_search_query_from_saved_embeddings
-from sqlalchemy import create_engine
-import pandas as pd
 import logging
+import numpy as np
 import faiss
-
-
-
-import torch
-
-
+from similarity_engine.instrumentation import add_instrumentation_arguments, request_trace, run_instrumented
+from similarity_engine.metadata_store import fetch_track_details_by_vector_ids
+from similarity_engine.similarity_search import get_similarity_search, load_config
+from utils.audio_utils import ROOT_DIRECTORY, process_file_custom, read_audio_bytes
+from utils.feature_cache import hash_audio
+from utils.model_registry import get_model_registry
+from utils.query_cache import get_query_cache, query_embedding_key, query_results_key
+from utils import find_search_query_from_saved_embeddings
 
 # Configure logging
 numba_logger = logging.getLogger('numba')
@@ -37,66 +28,86 @@ def fetch_track_details(vector_ids, config):
     """
     Fetch track details for given vector IDs from the database and print them.
 
+    The shared, pooled engine of the database is used, and the in-process metadata
+    cache when "cache_metadata" is enabled in the database configuration.
+
     Args:
-    vector_ids (list of int): List of vector IDs from the similarity search.
+    vector_ids (list of int): List of vector IDs from the similarity search (track_ids for indexes keyed by track_id).
     config (dict): Database configuration details.
 
     Returns:
-    None: This function prints the query results.
-    """
-    # Create database engine
-    db_config = config['database']
-    engine = create_engine(f"mysql+mysqldb://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['database']}")
-
-    # Create placeholders for each vector ID
-    placeholders = ', '.join(['%s'] * len(vector_ids))
-
-    # Define the SQL query with placeholders
-    query = f"""
-    SELECT t.track_id, t.title, a.name as artist, YEAR(t.date_created) as released, al.title as album, t.genre_top as genre
-    FROM tracks t
-    INNER JOIN vector_metadata vm ON t.track_id = vm.track_id
-    INNER JOIN artists a ON t.track_id = a.track_id
-    INNER JOIN albums al ON t.track_id = al.track_id
-    WHERE vm.vector_id IN ({placeholders});
+    pandas.DataFrame: Track details of the found vector IDs, in the order of vector_ids.
     """
-
-    # Execute the query
-    results = pd.read_sql_query(query, engine, params=tuple(vector_ids))
+    # Indexes keyed by track_id are looked up without the vector_metadata join
+    engine = get_similarity_search(config)
+    results = fetch_track_details_by_vector_ids(vector_ids, config['database'], engine.id_column,
+                                                engine.index_signature).drop(columns=['vector_id'])
 
     # Check if results are empty
     if results.empty:
         print("No tracks found for the given vector IDs.")
-        return
+        return results
 
     # Print results in a formatted manner
     print("Track Details:\n")
     print(results.to_string(index=False))
 
-    # Close the connection
-    engine.dispose()
-
     return results
 
-def process_audio_to_embeddings(audio_file_path, model_paths):
+def fetch_track_details_batch(vector_ids_per_query, config):
+    """
+    Fetch track details for the results of many similarity searches with a single metadata lookup.
+
+    Args:
+    vector_ids_per_query (list of list of int): Vector IDs returned for every query, in rank order.
+    config (dict): Database configuration details.
+
+    Returns:
+    list of pandas.DataFrame: Track details of every query, one row per found vector ID in rank order.
+    """
+    all_vector_ids = [vector_id for vector_ids in vector_ids_per_query for vector_id in vector_ids]
+    engine = get_similarity_search(config)
+    details = fetch_track_details_by_vector_ids(all_vector_ids, config['database'], engine.id_column,
+                                                engine.index_signature).drop_duplicates('vector_id').set_index('vector_id')
+
+    details_per_query = []
+    for vector_ids in vector_ids_per_query:
+        found = [int(vector_id) for vector_id in vector_ids if int(vector_id) in details.index]
+        details_per_query.append(details.loc[found].reset_index())
+
+    return details_per_query
+
+def process_audio_to_embeddings(audio_file_path, model_paths, query_cache=None, batcher=None):
     """
     Process an audio file to generate concatenated embeddings.
 
+    The models are taken from the shared model registry, so each one is only
+    loaded from disk the first time it is used in the process. Embeddings are
+    cached by the content of the audio and the versions of the models, so the
+    same audio is only processed once, whatever its file name.
+
     Args:
-    audio_file_path (str): Path to the audio file.
-    model_path (str): Path to the machine learning model used for processing.
+    audio_file_path (str | bytes): Path to the audio file or the bytes of a WAV file.
+    model_paths (list of str): Paths to the machine learning models used for processing.
+    query_cache (QueryCache): Query cache to use, the shared one of the process if None.
+    batcher (BatchingScheduler): Micro-batches the forward passes with the ones of concurrent requests if given.
 
     Returns:
     numpy.array: Concatenated embeddings from the processed audio file.
     """
+    models = get_model_registry().load_models({model_path: os.path.join(ROOT_DIRECTORY, model_path) for model_path in model_paths})
+
+    if query_cache is None:
+        query_cache = get_query_cache()
+    audio_bytes = read_audio_bytes(audio_file_path)
+    cache_key = query_embedding_key(hash_audio(audio_bytes), [model_["properties"]["version"] for model_ in models.values()])
+
+    concatenated_inference_embedding = query_cache.get_embedding(cache_key)
+    if concatenated_inference_embedding is None:
+        # The audio is decoded once and shared by all models
+        concatenated_inference_embedding = process_file_custom(audio_bytes, models, batcher=batcher)
+        query_cache.put_embedding(cache_key, concatenated_inference_embedding)
 
-    embeddings_from_inference = []
-    for model in model_paths:
-        # Generate embeddings from the audio file
-        embeddings = process_file(audio_file_path, model)
-        embeddings_from_inference.append(embeddings)
-    concatenated_inference_embedding = np.concatenate(embeddings_from_inference, axis=None)
-    
     return concatenated_inference_embedding
 
 def find_embeddings_in_local_path(audio_file_path: str):
@@ -124,19 +135,46 @@ def load_embeddings(file_path):
     """
     return np.load(file_path).astype('float32')
 
-def perform_similarity_search(embedding, config):
+def perform_similarity_search(embedding, config, top_k=6, query_cache=None):
     """
-    Initialize the similarity search engine and find top similar items.
+    Find top similar items using the resident similarity search engine.
 
     Args:
     embedding (numpy.array): Query embedding for similarity search.
     config (dict): Configuration for the similarity search engine.
+    top_k (int): The number of similar items to return.
+    query_cache (QueryCache): If given, results are cached per embedding, top_k and version of the index.
 
     Returns:
     tuple: Indices and distances of top similar items.
     """
-    v_db = SimilaritySearch(config)
-    return v_db.find_similar_embeddings(embedding, top_k=6)
+    v_db = get_similarity_search(config)
+    if query_cache is None:
+        return v_db.find_similar_embeddings(embedding, top_k=top_k)
+
+    # Make sure the signature is the one of the index the search will run against
+    v_db.refresh_index()
+    cache_key = query_results_key(embedding, v_db.index_signature, top_k)
+    results = query_cache.get_results(cache_key)
+    if results is None:
+        results = v_db.find_similar_embeddings(embedding, top_k=top_k)
+        query_cache.put_results(cache_key, *results)
+    return results
+
+def perform_similarity_search_batch(embeddings, config, top_k=6):
+    """
+    Find top similar items for many query embeddings with a single index search.
+
+    Args:
+    embeddings (numpy.array): (m, dimension) matrix of query embeddings.
+    config (dict): Configuration for the similarity search engine.
+    top_k (int): The number of similar items to return per query.
+
+    Returns:
+    tuple: (m, top_k) indices and distances of top similar items.
+    """
+    v_db = get_similarity_search(config)
+    return v_db.find_similar_embeddings_batch(embeddings, top_k=top_k)
 
 def main():
 
@@ -153,84 +191,37 @@ def main():
         "emotion": "./models/mood.pt"
     }
 
-    models = {
-        "genre": {
-            "properties": {
-                "model": None,
-                "hop_length": None,
-                "window_length": None,
-                "max_seq_length": None,
-                "zero_pad": None,
-                "spec_size": None,
-                "fuse": None
-            }
-        },
-        "instrument": { 
-            "properties": {
-                "model": None,
-                "hop_length": None,
-                "window_length": None,
-                "max_seq_length": None,
-                "zero_pad": None,
-                "spec_size": None,
-                "fuse": None
-            }
-        },
-        "emotion": { 
-            "properties": {
-                "model": None,
-                "hop_length": None,
-                "window_length": None,
-                "max_seq_length": None,
-                "zero_pad": None,
-                "spec_size": None,
-                "fuse": None
-            }
-        }
-    }
-
-    # LAYERS_DROPPED = 1
-
-    # device = "cuda" if torch.cuda.is_available() else "cpu"
+    # Models are loaded once per process and shared through the model registry
+    # models = get_model_registry().load_models(model_paths)
 
-    # for key, model_path in model_paths.items():
-    #     model, hop_length, window_length = load_cnn(model_path)
-    #     model = model.to(device)
-    #     models[key]["properties"]["model"] = model
-    #     models[key]["properties"]["hop_length"] = hop_length
-    #     models[key]["properties"]["window_length"] = window_length
-    #     models[key]["properties"]["max_seq_length"] = model.max_sequence_length
-    #     models[key]["properties"]["zero_pad"] = model.zero_pad
-    #     models[key]["properties"]["fuse"] = model.fuse
-    
-    
-    
-    
     # Process and save embeddings
     # test_query = process_audio_to_embeddings_model(audio_file_path, models=models)
 
     # test_query = load_embeddings(save_path)
 
-    test_query = find_embeddings_in_local_path(audio_file_path)
+    # Every stage of the query is timed and logged as one structured line
+    with request_trace("inference", file=audio_file_path):
+        test_query = find_embeddings_in_local_path(audio_file_path)
 
-    if loaded_config["faiss"]["index_type"] == "Cosine":
-        faiss.normalize_L2(test_query)
+        if loaded_config["faiss"]["index_type"] == "Cosine":
+            faiss.normalize_L2(test_query)
 
-    # Load precomputed embeddings for testing
-    # test_query_embedding = "./test_wav_files/test_query.npy"
-    # loaded_embedding = load_embeddings(test_q368y)
+        # Load precomputed embeddings for testing
+        # test_query_embedding = "./test_wav_files/test_query.npy"
+        # loaded_embedding = load_embeddings(test_q368y)
 
-    #np.save("./test_wav_files/"+ "test_query_574_IVFF.npy", test_query)
-    
-    # Perform similarity search and print results
-    top_neighbors_indices, _ = perform_similarity_search(test_query, loaded_config)
+        #np.save("./test_wav_files/"+ "test_query_574_IVFF.npy", test_query)
+        
+        # Perform similarity search and print results
+        top_neighbors_indices, _ = perform_similarity_search(test_query, loaded_config)
 
-    # Assuming top_neighbors_indices returns a list of indices
-    vector_ids = top_neighbors_indices.flatten().tolist()
+        # Assuming top_neighbors_indices returns a list of indices
+        vector_ids = top_neighbors_indices.flatten().tolist()
 
-    # Fetch and display track details from the database
-    _ = fetch_track_details(vector_ids, loaded_config)
+        # Fetch and display track details from the database
+        _ = fetch_track_details(vector_ids, loaded_config)
     
 
 if __name__ == '__main__':
-    main()
+    args = add_instrumentation_arguments(argparse.ArgumentParser(description="Find similar tracks for a WAV file")).parse_args()
+    run_instrumented(main, args.profile, args.metrics_file)
@@ -0,0 +1,336 @@
+import sys
+import os
+
+# Assuming the script is run from within the root directory of the project
+project_root = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, project_root)
+
+import json
+import asyncio
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+import faiss
+import numpy as np
+from similarity_engine.instrumentation import count, get_metrics, request_trace
+from similarity_engine.metadata_store import get_track_metadata_cache
+from similarity_engine.similarity_search import get_similarity_search, load_config
+from inference_similar_songs import fetch_track_details_batch, process_audio_to_embeddings
+from utils.batching import BatchingScheduler
+from utils.model_registry import get_model_registry
+from utils.utils import find_saved_embedding
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+numba_logger = logging.getLogger('numba')
+numba_logger.setLevel(logging.WARNING)
+
+MODEL_PATHS = [
+    os.path.join(project_root, "models", "genre.pt"),
+    os.path.join(project_root, "models", "instruments.pt"),
+    os.path.join(project_root, "models", "mood.pt")
+]
+
+MAX_TOP_K = 100
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class SearchService:
+    """
+    Similarity search over HTTP, served by one asyncio event loop.
+
+    Models, index and metadata are loaded once at startup and stay resident. The event loop
+    only parses requests and writes responses, embedding, index search and metadata lookups
+    run in a pool of max_concurrency threads (torch and faiss release the GIL). At most
+    max_pending requests wait for a thread, further ones are rejected right away with
+    503 and a Retry-After header instead of piling up.
+
+    Endpoints:
+    POST /similar/audio?top_k=6         Body: the bytes of a WAV file.
+    GET  /similar/track/<track_id>?top_k=6
+    POST /search/vector                 Body: {"vectors": [[...], ...], "top_k": 6}, or "vector" for one query.
+    GET  /health
+    GET  /metrics                       Prometheus text format.
+    """
+
+    def __init__(self, config, model_paths=MODEL_PATHS, max_concurrency=None, max_pending=64,
+                 max_body_bytes=50 * 1024 ** 2, request_timeout=60.0, top_k=6, batcher=None):
+        self.config = config
+        self.model_paths = model_paths
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.max_body_bytes = max_body_bytes
+        self.request_timeout = request_timeout
+        self.top_k = top_k
+        # Micro-batches the CNN forward passes of concurrent uploads, None to run them per request
+        self.batcher = batcher
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="search")
+        self.semaphore = None
+        self.pending = 0
+
+    def warm_up(self):
+        """ Load the models, the index and the metadata cache before the first request. """
+        get_model_registry().load_models({model_path: model_path for model_path in self.model_paths})
+        engine = get_similarity_search(self.config)
+        if engine.vector_db.index is None:
+            raise RuntimeError("The FAISS index could not be loaded, build it with create_vector_database.py first.")
+        if self.config['database'].get('cache_metadata'):
+            get_track_metadata_cache(self.config['database'], engine.id_column, engine.index_signature)
+        logger.info(f"Models, index ({engine.vector_db.index.ntotal} vectors) and metadata loaded.")
+
+    # Blocking work, run in the thread pool
+
+    def search(self, query_vectors, top_k, exclude_ids=None):
+        """
+        Search the index and fetch the track details of the results.
+
+        Args:
+        query_vectors (numpy.array): (m, dimension) query embeddings.
+        top_k (int): Number of results per query.
+        exclude_ids (list of int): Id to leave out of the results of every query, e.g. the query track itself.
+
+        Returns:
+        list of list of dict: The results of every query in rank order, with their rank, distance and track details.
+        """
+        query_vectors = np.ascontiguousarray(query_vectors, dtype='float32')
+        engine = get_similarity_search(self.config)
+        if query_vectors.ndim != 2 or query_vectors.shape[1] != engine.query_dimension:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Query vectors must have dimension {engine.query_dimension}.")
+        if self.config["faiss"]["index_type"] == "Cosine":
+            faiss.normalize_L2(query_vectors)
+
+        # One more neighbor per query, so top_k remain once the query track is removed
+        extra = 1 if exclude_ids is not None else 0
+        indices, distances = engine.find_similar_embeddings_batch(query_vectors, top_k=top_k + extra)
+        details_per_query = fetch_track_details_batch(indices.tolist(), self.config)
+
+        results = []
+        for query, (query_indices, query_distances, details) in enumerate(zip(indices, distances, details_per_query)):
+            details = {row["vector_id"]: row for row in json.loads(details.to_json(orient="records", date_format="iso"))}
+            rows = []
+            for vector_id, distance in zip(query_indices.tolist(), query_distances.tolist()):
+                if vector_id < 0 or vector_id not in details:
+                    continue
+                if exclude_ids is not None and details[vector_id]["track_id"] == exclude_ids[query]:
+                    continue
+                rows.append(dict(details[vector_id], rank=len(rows) + 1, distance=distance))
+            results.append(rows[:top_k])
+        return results
+
+    def similar_to_audio(self, audio_bytes, top_k):
+        with request_trace("service_audio", bytes=len(audio_bytes)):
+            try:
+                embedding = process_audio_to_embeddings(audio_bytes, self.model_paths, batcher=self.batcher)
+            except Exception as e:
+                raise HTTPError(HTTPStatus.UNPROCESSABLE_ENTITY, f"The audio could not be embedded: {e}")
+            return {"results": self.search(np.asarray(embedding).reshape(1, -1), top_k)[0]}
+
+    def similar_to_track(self, track_id, top_k):
+        with request_trace("service_track", track_id=track_id):
+            embedding = self.track_embedding(track_id)
+            if embedding is None:
+                raise HTTPError(HTTPStatus.NOT_FOUND, f"No embedding found for track {track_id}.")
+            return {"track_id": track_id, "results": self.search(embedding.reshape(1, -1), top_k, exclude_ids=[track_id])[0]}
+
+    def search_vectors(self, vectors, top_k):
+        with request_trace("service_vector", queries=len(vectors)):
+            return {"results": self.search(vectors, top_k)}
+
+    def track_embedding(self, track_id):
+        """ Concatenated embedding of an indexed track, from the embedding stores or the per-track files. """
+        return find_saved_embedding(track_id, self.config)
+
+    # Asynchronous side, on the event loop
+
+    async def run_blocking(self, function, *args):
+        """
+        Run function in the thread pool, waiting for a free thread for at most request_timeout.
+
+        Raises:
+        HTTPError: 503 when max_pending requests are already waiting or the wait timed out.
+        """
+        if self.pending >= self.max_pending:
+            count("songs_requests_rejected_total", reason="overloaded")
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Too many pending requests.", {"Retry-After": "1"})
+        self.pending += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.request_timeout)
+        except asyncio.TimeoutError:
+            count("songs_requests_rejected_total", reason="timeout")
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Timed out waiting for a worker.", {"Retry-After": "1"})
+        finally:
+            self.pending -= 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.semaphore.release()
+
+    def parse_top_k(self, value):
+        try:
+            top_k = int(value) if value is not None else self.top_k
+        except (TypeError, ValueError):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "top_k must be an integer.")
+        if not 1 <= top_k <= MAX_TOP_K:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"top_k must be between 1 and {MAX_TOP_K}.")
+        return top_k
+
+    async def route(self, method, target, body):
+        """ Handle one request, returns (status, content type, body bytes). """
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = url.path.rstrip("/")
+
+        if method == "GET" and path == "/health":
+            engine = get_similarity_search(self.config)
+            return HTTPStatus.OK, {"status": "ok", "vectors": engine.vector_db.index.ntotal, "pending": self.pending}
+        if method == "GET" and path == "/metrics":
+            return HTTPStatus.OK, get_metrics().render_prometheus()
+        if method == "POST" and path == "/similar/audio":
+            if not body:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "The body must be the bytes of a WAV file.")
+            return HTTPStatus.OK, await self.run_blocking(self.similar_to_audio, body, self.parse_top_k(query.get("top_k")))
+        if method == "GET" and path.startswith("/similar/track/"):
+            try:
+                track_id = int(path.rsplit("/", 1)[1])
+            except ValueError:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "The track_id must be an integer.")
+            return HTTPStatus.OK, await self.run_blocking(self.similar_to_track, track_id, self.parse_top_k(query.get("top_k")))
+        if method == "POST" and path == "/search/vector":
+            try:
+                payload = json.loads(body)
+                vectors = np.asarray(payload["vectors"] if "vectors" in payload else [payload["vector"]], dtype='float32')
+            except (ValueError, TypeError, KeyError):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, 'The body must be JSON with "vector" or "vectors".')
+            top_k = self.parse_top_k(payload.get("top_k", query.get("top_k")))
+            return HTTPStatus.OK, await self.run_blocking(self.search_vectors, vectors, top_k)
+        if path in ("/health", "/metrics", "/similar/audio", "/search/vector") or path.startswith("/similar/track/"):
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, f"{method} is not allowed on {path}.")
+        raise HTTPError(HTTPStatus.NOT_FOUND, f"No endpoint {path}.")
+
+    async def read_request(self, reader):
+        """ Read one HTTP/1.1 request, returns None when the client closed the connection. """
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "Request headers too large.")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line.")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise HTTPError(HTTPStatus.LENGTH_REQUIRED, "Chunked bodies are not supported, send a Content-Length.")
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length.")
+        if length > self.max_body_bytes:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Bodies are limited to {self.max_body_bytes} bytes.")
+        body = await reader.readexactly(length) if length else b""
+        keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+        return method.upper(), target, body, keep_alive
+
+    @staticmethod
+    async def write_response(writer, status, payload, keep_alive, headers=None):
+        if isinstance(payload, str):
+            body, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, content_type = json.dumps(payload, default=str).encode("utf-8"), "application/json"
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}", f"Content-Type: {content_type}",
+                 f"Content-Length: {len(body)}", f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        keep_alive = True
+        try:
+            while keep_alive:
+                try:
+                    # Idle keep-alive connections are closed after request_timeout
+                    request = await asyncio.wait_for(self.read_request(reader), self.request_timeout)
+                    if request is None:
+                        break
+                    method, target, body, keep_alive = request
+                    status, payload = await self.route(method, target, body)
+                    await self.write_response(writer, status, payload, keep_alive)
+                except HTTPError as e:
+                    # The body of a rejected request may not have been read, do not reuse the connection
+                    keep_alive = keep_alive and e.status < 500 and e.status != HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+                    await self.write_response(writer, e.status, {"error": str(e)}, keep_alive, e.headers)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as e:
+                    logger.exception(f"Request failed: {e}")
+                    keep_alive = False
+                    await self.write_response(writer, HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Internal server error."}, False)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        # The models and the index are loaded before the port is opened
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.warm_up)
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=64 * 1024)
+        logger.info(f"Search service listening on http://{host}:{port} with {self.max_concurrency} workers "
+                    f"and at most {self.max_pending} pending requests")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve similar track searches over HTTP")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                        help="Requests embedded or searched at the same time, the number of CPUs by default")
+    parser.add_argument("--max-pending", type=int, default=64,
+                        help="Requests allowed to wait for a worker, further ones get a 503")
+    parser.add_argument("--max-body-mb", type=float, default=50, help="Largest accepted upload in MiB")
+    parser.add_argument("--request-timeout", type=float, default=60.0,
+                        help="Seconds a request may wait for a worker, and a keep-alive connection may stay idle")
+    parser.add_argument("--top-k", type=int, default=6, help="Number of similar tracks returned when top_k is not given")
+    parser.add_argument("--batch-max-delay-ms", type=float, default=5.0,
+                        help="Longest wait for concurrent uploads to share a CNN forward pass, 0 to disable micro-batching")
+    parser.add_argument("--batch-max-size", type=int, default=64, help="Most segments forwarded in one batched pass")
+    args = parser.parse_args()
+
+    batcher = None
+    if args.batch_max_delay_ms > 0:
+        batcher = BatchingScheduler(max_batch_size=args.batch_max_size, max_delay=args.batch_max_delay_ms / 1000)
+    service = SearchService(load_config(), max_concurrency=args.max_concurrency, max_pending=args.max_pending,
+                            max_body_bytes=int(args.max_body_mb * 1024 ** 2), request_timeout=args.request_timeout,
+                            top_k=args.top_k, batcher=batcher)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        logger.info("Search service stopped.")
+    finally:
+        # Requests still running finish before the batchers they submit to are stopped
+        service.executor.shutdown(wait=True, cancel_futures=True)
+        if batcher is not None:
+            batcher.close()
+
+
+if __name__ == '__main__':
+    main()
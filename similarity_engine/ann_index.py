@@ -0,0 +1,303 @@
+import math
+import logging
+import faiss
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ["FlatL2", "Cosine", "IVFFlat", "IVFPQ", "IVFSQ", "HNSW"]
+
+# faiss warns below 39 training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+
+# Corpus sizes up to which "Auto" keeps exact search, and then HNSW before switching to IVF-PQ
+AUTO_FLAT_MAX_VECTORS = 20000
+AUTO_HNSW_MAX_VECTORS = 1000000
+
+SQ_TYPES = {
+    "8bit": faiss.ScalarQuantizer.QT_8bit,
+    "6bit": faiss.ScalarQuantizer.QT_6bit,
+    "4bit": faiss.ScalarQuantizer.QT_4bit,
+    "fp16": faiss.ScalarQuantizer.QT_fp16
+}
+
+# Storage of the vectors of the index families that keep them uncompressed, as scalar quantizer types
+STORAGE_TYPES = {
+    "float32": None,
+    "float16": "fp16",
+    "int8": "8bit"
+}
+
+# Index families whose vectors can be stored in any of STORAGE_TYPES, IVFPQ and IVFSQ are compressed already
+STORAGE_INDEX_TYPES = ["FlatL2", "Cosine", "IVFFlat", "HNSW"]
+
+
+def choose_index_type(n_vectors):
+    """ Index family used for index_type "Auto", from the size of the corpus. """
+    if n_vectors <= AUTO_FLAT_MAX_VECTORS:
+        return "FlatL2"
+    if n_vectors <= AUTO_HNSW_MAX_VECTORS:
+        return "HNSW"
+    return "IVFPQ"
+
+
+def _largest_divisor(dimension, upper_bound):
+    for candidate in range(min(dimension, upper_bound), 0, -1):
+        if dimension % candidate == 0:
+            return candidate
+    return 1
+
+
+def resolve_index_parameters(index_type, n_vectors, dimension, params=None):
+    """
+    Fill in the parameters of an index family that are not set in params.
+
+    Defaults follow the usual faiss guidelines: nlist ~ 4 * sqrt(n) clusters (with at least
+    39 training points each), nprobe = nlist / 16, 8-bit PQ codes with sub-vectors of at
+    most 64 sub-quantizers, and M = 32 / efSearch = 64 for HNSW.
+
+    Args:
+    index_type (str): One of INDEX_TYPES.
+    n_vectors (int): Number of vectors the index is trained on.
+    dimension (int): Dimension of the vectors.
+    params (dict): Parameters from the "faiss" section of config.json, missing or null values are chosen automatically.
+
+    Returns:
+    dict: The complete parameters of the index family.
+    """
+    params = {key: value for key, value in (params or {}).items() if value is not None}
+    resolved = {}
+
+    if index_type.startswith("IVF"):
+        nlist = params.get("nlist")
+        if nlist is None:
+            nlist = int(4 * math.sqrt(max(n_vectors, 1)))
+            nlist = max(1, min(nlist, n_vectors // MIN_POINTS_PER_CENTROID))
+        resolved["nlist"] = nlist
+        resolved["nprobe"] = min(nlist, params.get("nprobe", max(1, nlist // 16)))
+
+    if index_type == "IVFPQ":
+        resolved["pq_m"] = params.get("pq_m", _largest_divisor(dimension, 64))
+        # Every PQ centroid needs training points, shrink the codebooks of small corpora
+        resolved["pq_nbits"] = params.get("pq_nbits", max(1, min(8, int(math.log2(max(n_vectors // MIN_POINTS_PER_CENTROID, 2))))))
+
+    if index_type == "IVFSQ":
+        resolved["sq_type"] = params.get("sq_type", "8bit")
+
+    if index_type in STORAGE_INDEX_TYPES:
+        resolved["storage"] = params.get("storage", "float32")
+        if resolved["storage"] not in STORAGE_TYPES:
+            raise ValueError(f"Unknown storage {resolved['storage']}, expected one of {list(STORAGE_TYPES)}.")
+
+    if index_type == "HNSW":
+        resolved["M"] = params.get("M", 32)
+        resolved["efConstruction"] = params.get("efConstruction", 2 * resolved["M"])
+        resolved["efSearch"] = params.get("efSearch", 64)
+
+    return resolved
+
+
+def build_index(index_type, dimension, vectors, params=None, ids=None):
+    """
+    Create, train and fill a FAISS index.
+
+    Args:
+    index_type (str): One of INDEX_TYPES, or "Auto" to choose one from the size of the corpus.
+    dimension (int): Dimension of the vectors.
+    vectors (numpy.array): Contiguous float32 (n, dimension) matrix, normalized in place for "Cosine".
+    params (dict): Index parameters, see resolve_index_parameters.
+    ids (numpy.array): int64 id of every vector (e.g. its track_id), returned by searches instead
+        of the position of the vector. The index then supports removing vectors by id.
+
+    Returns:
+    faiss.Index: The filled index.
+    dict: The parameters it was built with.
+    """
+    n_vectors = len(vectors)
+    if index_type == "Auto":
+        index_type = choose_index_type(n_vectors)
+        logger.info(f"Index type {index_type} chosen for {n_vectors} vectors.")
+    parameters = resolve_index_parameters(index_type, n_vectors, dimension, params)
+
+    # float16 and int8 storage keep the vectors as scalar quantizer codes instead of float32
+    sq_type = STORAGE_TYPES.get(parameters.get("storage"))
+
+    if index_type == "FlatL2":
+        if sq_type is None:
+            index = faiss.IndexFlatL2(dimension)
+        else:
+            index = faiss.IndexScalarQuantizer(dimension, SQ_TYPES[sq_type], faiss.METRIC_L2)
+    elif index_type == "Cosine":
+        # Use IndexFlatIP for cosine similarity, which uses normalized vectors
+        if sq_type is None:
+            index = faiss.index_factory(dimension, "Flat", faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexScalarQuantizer(dimension, SQ_TYPES[sq_type], faiss.METRIC_INNER_PRODUCT)
+        faiss.normalize_L2(vectors)
+    elif index_type == "IVFFlat":
+        quantizer = faiss.IndexFlatL2(dimension)
+        if sq_type is None:
+            index = faiss.IndexIVFFlat(quantizer, dimension, parameters["nlist"], faiss.METRIC_L2)
+        else:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, parameters["nlist"], SQ_TYPES[sq_type], faiss.METRIC_L2)
+    elif index_type == "IVFPQ":
+        quantizer = faiss.IndexFlatL2(dimension)
+        index = faiss.IndexIVFPQ(quantizer, dimension, parameters["nlist"], parameters["pq_m"], parameters["pq_nbits"])
+    elif index_type == "IVFSQ":
+        quantizer = faiss.IndexFlatL2(dimension)
+        index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, parameters["nlist"],
+                                              SQ_TYPES[parameters["sq_type"]], faiss.METRIC_L2)
+    elif index_type == "HNSW":
+        if sq_type is None:
+            index = faiss.IndexHNSWFlat(dimension, parameters["M"])
+        else:
+            index = faiss.IndexHNSWSQ(dimension, SQ_TYPES[sq_type], parameters["M"])
+        index.hnsw.efConstruction = parameters["efConstruction"]
+    else:
+        raise ValueError(f"Unknown index type {index_type}, expected one of {INDEX_TYPES} or Auto.")
+
+    if not index.is_trained:
+        index.train(vectors)
+    if ids is None:
+        index.add(vectors)
+    else:
+        index = with_ids(index)
+        index.add_with_ids(vectors, np.ascontiguousarray(ids, dtype=np.int64))
+    set_search_parameters(index, parameters)
+    logger.info(f"{index_type} index built over {n_vectors} vectors with parameters {parameters}")
+    return index, parameters
+
+
+def with_ids(index):
+    """
+    Make an empty index store arbitrary int64 ids.
+
+    IVF indexes keep the ids in their inverted lists natively. Other indexes are wrapped in an
+    IndexIDMap2, whose id map also allows reconstructing a vector from its id.
+    """
+    if faiss.try_extract_index_ivf(index) is not None:
+        return index
+    return faiss.IndexIDMap2(index)
+
+
+def index_ids(index):
+    """ int64 ids of every vector stored in an index, in no particular order. """
+    if hasattr(index, "shards"):
+        ids = [index_ids(shard) for shard in index.shards]
+        return np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        return index_ids(index.index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.vector_to_array(index.id_map).astype(np.int64)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        invlists = ivf.invlists
+        lists = [faiss.rev_swig_ptr(invlists.get_ids(list_no), invlists.list_size(list_no)).copy()
+                 for list_no in range(invlists.nlist) if invlists.list_size(list_no)]
+        return np.concatenate(lists).astype(np.int64) if lists else np.empty(0, dtype=np.int64)
+    return np.arange(index.ntotal, dtype=np.int64)
+
+
+def base_index(index):
+    """ The index wrapped by IndexIDMap/IndexIDMap2 and IndexPreTransform (projection) wrappers, or index itself. """
+    index = faiss.downcast_index(index)
+    while isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2, faiss.IndexPreTransform)):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def supports_removal(index):
+    """ Whether vectors can be removed from index, HNSW graphs cannot drop nodes. """
+    if hasattr(index, "shards"):
+        return all(supports_removal(shard) for shard in index.shards)
+    return not isinstance(base_index(index), faiss.IndexHNSW)
+
+
+def set_search_parameters(index, params):
+    """
+    Apply the query time parameters (nprobe for IVF indexes, efSearch for HNSW) to an index.
+
+    Parameters that do not apply to the index are ignored, so the same "faiss" section of
+    config.json can be used with every index type.
+    """
+    params = params or {}
+    if hasattr(index, "shards"):
+        for shard in index.shards:
+            set_search_parameters(shard, params)
+        return index
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and params.get("nprobe") is not None:
+        ivf.nprobe = int(params["nprobe"])
+    hnsw = getattr(base_index(index), "hnsw", None)
+    if hnsw is not None and params.get("efSearch") is not None:
+        hnsw.efSearch = int(params["efSearch"])
+    return index
+
+
+def index_memory_bytes(index):
+    """
+    Estimate of the resident memory of an index, computed from its structure without copying it.
+
+    Counts the vector codes (code size * ntotal) plus the per-family overhead: the ids of IVF
+    lists and IndexIDMap wrappers (8 bytes per vector, twice for the reverse map of IndexIDMap2),
+    the links of HNSW graphs, coarse quantizers, product quantizer codebooks and precomputed tables,
+    and projections.
+    """
+    if hasattr(index, "shards"):
+        return sum(index_memory_bytes(shard) for shard in index.shards)
+    index = faiss.downcast_index(index)
+    ntotal = int(index.ntotal)
+    if isinstance(index, faiss.IndexPreTransform):
+        transforms = [faiss.downcast_VectorTransform(index.chain.at(i)) for i in range(index.chain.size())]
+        # A, b of the linear transforms (and the training statistics PCA keeps), normalizations keep no state
+        size = sum(4 * (transform.A.size() + transform.b.size()) for transform in transforms
+                   if isinstance(transform, faiss.LinearTransform))
+        size += sum(4 * (transform.PCAMat.size() + transform.eigenvalues.size() + transform.mean.size())
+                    for transform in transforms if isinstance(transform, faiss.PCAMatrix))
+        return size + index_memory_bytes(index.index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        ids_per_vector = 16 if isinstance(index, faiss.IndexIDMap2) else 8
+        return ids_per_vector * ntotal + index_memory_bytes(index.index)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf = faiss.downcast_index(ivf)
+        size = (int(ivf.code_size) + 8) * ntotal + index_memory_bytes(ivf.quantizer)
+        if isinstance(ivf, faiss.IndexIVFPQ):
+            size += 4 * (ivf.pq.centroids.size() + ivf.precomputed_table.size())
+        return size
+    if isinstance(index, faiss.IndexHNSW):
+        hnsw = index.hnsw
+        links = 4 * (hnsw.neighbors.size() + hnsw.levels.size()) + 8 * hnsw.offsets.size()
+        return links + index_memory_bytes(index.storage)
+    size = int(index.sa_code_size()) * ntotal
+    if isinstance(index, faiss.IndexPQ):
+        size += 4 * index.pq.centroids.size()
+    return size
+
+
+def exact_neighbors(queries, vectors, k, metric_type=faiss.METRIC_L2):
+    """
+    Exact top-k neighbors of queries among float32 vectors, without building an index.
+
+    Returns:
+    numpy.array: (len(queries), k) positions of the neighbors in vectors.
+    """
+    _, indices = faiss.knn(np.ascontiguousarray(queries, dtype='float32'), np.ascontiguousarray(vectors, dtype='float32'),
+                           k, metric=metric_type)
+    return indices
+
+
+def recall_at_k(ground_truth, indices):
+    """
+    Mean fraction of the exact top-k neighbors found by an approximate search.
+
+    Args:
+    ground_truth (numpy.array): (m, k) indices returned by exact search.
+    indices (numpy.array): (m, k) indices returned by the index under test.
+    """
+    k = ground_truth.shape[1]
+    hits = sum(len(np.intersect1d(truth, found[:k])) for truth, found in zip(ground_truth, indices))
+    return hits / float(ground_truth.size)
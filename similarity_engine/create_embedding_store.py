@@ -0,0 +1,46 @@
+import os
+import sys
+
+# Make the project root importable when the script is run from within this folder
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from similarity_engine.create_vector_database import load_config
+import shutil
+from similarity_engine.embedding_store import MODALITIES, STORE_DTYPES, EmbeddingStore, compress_store, convert_embedding_folder
+from similarity_engine.vector_database_setup import VectorDatabase
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    config = load_config()
+
+    store_folder = VectorDatabase.get_full_path(config['paths']['embedding_store_folder'])
+    # float32, float16 or int8 (8-bit scalar quantized) rows
+    dtype = STORE_DTYPES[config.get('embedding_store', {}).get('storage', 'float32')]
+
+    # Convert the per-track .npy folders of every modality into one store each
+    for modality in MODALITIES:
+        store_path = os.path.join(store_folder, modality)
+        embeddings_folder = VectorDatabase.get_full_path(config['paths']['embeddings_folder'][f"{modality}_classification_embeddings"])
+        if os.path.isdir(embeddings_folder):
+            convert_embedding_folder(embeddings_folder, store_path, config['faiss']['dimension'], dtype=dtype)
+        elif EmbeddingStore.exists(store_path) and EmbeddingStore(store_path).dtype.name != dtype:
+            # Stores filled by core/ingest.py have no per-track folder, they are converted to the new storage in place
+            compress_store(EmbeddingStore(store_path), f"{store_path}.tmp", dtype)
+            shutil.rmtree(store_path)
+            os.replace(f"{store_path}.tmp", store_path)
+        elif EmbeddingStore.exists(store_path):
+            logger.info(f"No folder {embeddings_folder}, keeping the {modality} store as it is.")
+        else:
+            logger.warning(f"Folder {embeddings_folder} not found, skipping {modality} embeddings.")
+
+    logger.info(f"Embedding stores created under {store_folder}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,15 @@
 import os
+import sys
 import json
-from vector_database_setup import VectorDatabase 
+import argparse
+
+# Make the project root importable when the script is run from within this folder
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from similarity_engine.instrumentation import add_instrumentation_arguments, request_trace, run_instrumented
+from similarity_engine.projection import DEFAULT_EXPLAINED_VARIANCE, PROJECTION_TYPES
+from similarity_engine.vector_database_setup import VectorDatabase
 import logging
 
 # Configure logging
@@ -16,20 +25,46 @@ def load_config(config_path=None):
         return json.load(file)
 
 
-def main():
+def main(recall_k=10, recall_queries=1000, projection=None, projection_dimension=None):
     config = load_config()
+    # --projection and --projection-dimension take precedence over the "faiss" section
+    if projection is not None:
+        config['faiss']['projection'] = None if projection == "none" else projection
+    if projection_dimension is not None:
+        config['faiss']['projection_dimension'] = projection_dimension
+
+    # Loading, index building, metadata insertion and saving are logged as one structured line
+    with request_trace("index_build", index_type=config['faiss']['index_type']) as trace:
+        vector_db = VectorDatabase(config, create_index=True, load_vectors=True)
+        trace.fields["vectors"] = len(vector_db.vectors)
 
-    vector_db = VectorDatabase(config, create_index=True, load_vectors=True)
+        # Bytes per vector, resident memory and recall against exact float32 search of the storage in use
+        report = vector_db.storage_report(k=recall_k, n_queries=recall_queries)
+        vector_db.index_info["storage_report"] = report
+        trace.fields.update(report)
+        logger.info(f"Index storage {report['storage']}: {report['bytes_per_vector']} bytes per vector "
+                    f"(float32: {report['float32_bytes_per_vector']}), process RSS {report['rss_bytes'] / 1024 ** 2:.1f} MB"
+                    + (f", recall@{recall_k} {report[f'recall@{recall_k}']}" if f"recall@{recall_k}" in report else ""))
 
-    # Insert metadata about the vectors
-    # NOTE: track_ids must correspond one by one to the vectors guys :D
-    vector_db.insert_metadata()
+        # Insert metadata about the vectors
+        # NOTE: track_ids must correspond one by one to the vectors guys :D
+        vector_db.insert_metadata()
 
-    # Save the index to the specified path in the config json
-    vector_db.save_index()
+        # Save the index to the specified path in the config json
+        vector_db.save_index()
 
     logger.info(f"Index creation and metadata insertion completed successfully.")
 
 
 if __name__ == "__main__":
-    main()
+    parser = add_instrumentation_arguments(argparse.ArgumentParser(description="Build the FAISS index and insert the vector metadata"))
+    parser.add_argument("--recall-k", type=int, default=10,
+                        help="Neighbors the recall against exact float32 search is measured at, 0 to skip it")
+    parser.add_argument("--recall-queries", type=int, default=1000, help="Queries sampled from the corpus to measure the recall")
+    parser.add_argument("--projection", choices=PROJECTION_TYPES + ["none"], default=None,
+                        help="Reduce the vectors with a PCA or OPQ projection trained on the corpus, \"projection\" of config.json by default")
+    parser.add_argument("--projection-dimension", type=int, default=None,
+                        help=f"Dimension of the projected vectors, the one keeping {DEFAULT_EXPLAINED_VARIANCE * 100:g}%% of the variance if not set")
+    args = parser.parse_args()
+    run_instrumented(lambda: main(args.recall_k, args.recall_queries, args.projection, args.projection_dimension),
+                     args.profile, args.metrics_file)
@@ -0,0 +1,419 @@
+import os
+import json
+import shutil
+import threading
+import numpy as np
+import logging
+from tqdm import tqdm
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Modalities kept in the store, in the order they are concatenated into the index
+MODALITIES = ["genre", "instrument", "emotion"]
+
+# numpy dtype of the rows of every storage mode, "int8" rows are 8-bit scalar quantized codes
+STORE_DTYPES = {
+    "float32": "float32",
+    "float16": "float16",
+    "int8": "uint8"
+}
+
+
+class EmbeddingStore:
+    """
+    Single on-disk store of the embeddings of one modality.
+
+    The store is a folder holding a contiguous (count, dimension) matrix of vectors,
+    the track_id of every row and a small JSON header. Both arrays are memory-mapped
+    with np.memmap, so reading a vector is a page-cache read of one row instead of an
+    open/read/close of a per-track .npy file. Rows are only ever appended, and the
+    header is replaced atomically after the data is on disk, so readers never see a
+    partially written row.
+
+    Rows are float32, float16, or 8-bit codes of a per-dimension scalar quantizer whose
+    ranges are kept in the header (the layout of faiss' QT_8bit). Readers always get
+    float32 vectors back, see read.
+    """
+
+    VECTORS_FILE = "vectors.bin"
+    TRACK_IDS_FILE = "track_ids.bin"
+    HEADER_FILE = "store.json"
+    TRACK_ID_DTYPE = np.int64
+
+    def __init__(self, path):
+        """ Open an existing store located in the folder path. """
+        self.path = path
+        self._lock = threading.Lock()
+        self.refresh()
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(os.path.join(path, cls.HEADER_FILE))
+
+    @classmethod
+    def create(cls, path, dimension, dtype="float32", overwrite=False, ranges=None):
+        """
+        Create an empty store in the folder path.
+
+        Args:
+        path (str): Folder of the store, created if it does not exist.
+        dimension (int): Dimension of every vector in the store.
+        dtype (str): numpy dtype the vectors are stored with, one of the values of STORE_DTYPES.
+        overwrite (bool): Replace an existing store at path.
+        ranges (tuple of numpy.array): Per-dimension (minimum, maximum) quantized by uint8 stores.
+
+        Returns:
+        EmbeddingStore: The opened, empty store.
+        """
+        dtype = np.dtype(dtype)
+        if dtype.name not in STORE_DTYPES.values():
+            raise ValueError(f"Unsupported store dtype {dtype.name}, expected one of {list(STORE_DTYPES.values())}.")
+        if cls.exists(path) and not overwrite:
+            raise FileExistsError(f"Embedding store {path} already exists.")
+        header = {"dimension": int(dimension), "dtype": dtype.name, "count": 0}
+        if dtype == np.uint8:
+            if ranges is None:
+                raise ValueError("8-bit stores need the (minimum, maximum) range of every dimension.")
+            vmin, vmax = (np.asarray(bound, dtype=np.float32).reshape(-1) for bound in ranges)
+            header["vmin"] = vmin.tolist()
+            header["vdiff"] = (vmax - vmin).tolist()
+        os.makedirs(path, exist_ok=True)
+        open(os.path.join(path, cls.VECTORS_FILE), "wb").close()
+        open(os.path.join(path, cls.TRACK_IDS_FILE), "wb").close()
+        cls._write_header(path, header)
+        return cls(path)
+
+    @classmethod
+    def _write_header(cls, path, header):
+        header_path = os.path.join(path, cls.HEADER_FILE)
+        temp_path = header_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(header, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, header_path)
+
+    def refresh(self):
+        """ (Re)read the header and map the rows it declares. """
+        self._map()
+        self._build_lookup()
+
+    def _map(self):
+        """ Read the header and memory-map the rows it declares, the lookup is left as is. """
+        with open(os.path.join(self.path, self.HEADER_FILE), "r") as file:
+            header = json.load(file)
+        self.dimension = header["dimension"]
+        self.dtype = np.dtype(header["dtype"])
+        self.count = header["count"]
+        if self.dtype == np.uint8:
+            self.vmin = np.asarray(header["vmin"], dtype=np.float32)
+            self.vdiff = np.asarray(header["vdiff"], dtype=np.float32)
+
+        if self.count == 0:
+            # np.memmap cannot map an empty file
+            self.vectors = np.empty((0, self.dimension), dtype=self.dtype)
+            self.track_ids = np.empty((0,), dtype=self.TRACK_ID_DTYPE)
+        else:
+            self.vectors = np.memmap(os.path.join(self.path, self.VECTORS_FILE), dtype=self.dtype,
+                                     mode="r", shape=(self.count, self.dimension))
+            self.track_ids = np.memmap(os.path.join(self.path, self.TRACK_IDS_FILE), dtype=self.TRACK_ID_DTYPE,
+                                       mode="r", shape=(self.count,))
+
+    def _build_lookup(self):
+        """
+        Prepare the track_id -> row lookup.
+
+        Lookups are binary searches over the sorted track_ids. Stores written by the
+        converter are already sorted, so no permutation has to be kept for them.
+        """
+        track_ids = np.asarray(self.track_ids)
+        if track_ids.size < 2 or np.all(track_ids[1:] > track_ids[:-1]):
+            self._order = None
+            self._sorted_ids = track_ids
+        else:
+            self._order = np.argsort(track_ids, kind="stable")
+            self._sorted_ids = track_ids[self._order]
+
+    def _merge_lookup(self, track_ids, first_row):
+        """
+        Add the rows appended from first_row on to the lookup, without sorting the whole store again.
+
+        The new ids are sorted among themselves and inserted at their np.searchsorted positions,
+        so an append costs O(n log n + count) instead of a full argsort.
+        """
+        rows = first_row + np.arange(len(track_ids), dtype=np.int64)
+        in_order = np.all(track_ids[1:] > track_ids[:-1])
+        if self._order is None and in_order and (first_row == 0 or track_ids[0] > self._sorted_ids[-1]):
+            # Still sorted, e.g. the converter appending in track_id order
+            self._sorted_ids = np.asarray(self.track_ids)
+            return
+        order = np.argsort(track_ids, kind="stable")
+        track_ids, rows = track_ids[order], rows[order]
+        previous_rows = np.arange(first_row, dtype=np.int64) if self._order is None else self._order
+        positions = np.searchsorted(self._sorted_ids, track_ids)
+        self._sorted_ids = np.insert(np.asarray(self._sorted_ids), positions, track_ids)
+        self._order = np.insert(previous_rows, positions, rows)
+
+    def header(self, count=None):
+        """ Header describing the store with count rows, the current count if None. """
+        header = {"dimension": self.dimension, "dtype": self.dtype.name, "count": self.count if count is None else int(count)}
+        if self.dtype == np.uint8:
+            header["vmin"] = self.vmin.tolist()
+            header["vdiff"] = self.vdiff.tolist()
+        return header
+
+    @property
+    def bytes_per_vector(self):
+        """ Bytes of one stored vector, its track_id excluded. """
+        return self.dimension * self.dtype.itemsize
+
+    def encode(self, vectors):
+        """ Rows of the store for float32 vectors, 8-bit codes are clipped to the quantizer ranges. """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dtype != np.uint8:
+            return np.ascontiguousarray(vectors, dtype=self.dtype)
+        # Constant dimensions have a zero range, all their values decode to vmin
+        scale = np.where(self.vdiff > 0, 255.0 / np.maximum(self.vdiff, 1e-30), 0.0).astype(np.float32)
+        return np.clip(np.floor((vectors - self.vmin) * scale), 0, 255).astype(np.uint8)
+
+    def decode(self, rows):
+        """ float32 vectors of stored rows. """
+        if self.dtype != np.uint8:
+            return np.asarray(rows, dtype=np.float32)
+        return (np.asarray(rows, dtype=np.float32) + 0.5) * (self.vdiff / 255.0) + self.vmin
+
+    def read(self, rows=None):
+        """
+        Read vectors as float32.
+
+        Args:
+        rows (numpy.array or slice): Row numbers to read, every row if None.
+
+        Returns:
+        numpy.array: (n, dimension) float32 vectors, a view into the mapped file for float32 stores.
+        """
+        return self.decode(self.vectors[slice(None) if rows is None else rows])
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, track_id):
+        return self.row(track_id) is not None
+
+    def rows(self, track_ids):
+        """
+        Resolve track_ids to row numbers.
+
+        Args:
+        track_ids (array-like of int): Track ids to look up.
+
+        Returns:
+        numpy.array: Row of every track_id, -1 for the ones not in the store.
+        """
+        track_ids = np.asarray(track_ids, dtype=self.TRACK_ID_DTYPE).reshape(-1)
+        rows = np.full(track_ids.shape, -1, dtype=np.int64)
+        if self.count == 0 or track_ids.size == 0:
+            return rows
+        positions = np.searchsorted(self._sorted_ids, track_ids)
+        clipped = np.minimum(positions, self.count - 1)
+        found = self._sorted_ids[clipped] == track_ids
+        found_positions = clipped[found]
+        rows[found] = found_positions if self._order is None else self._order[found_positions]
+        return rows
+
+    def row(self, track_id):
+        """ Row of a single track_id, or None if it is not in the store. """
+        row = int(self.rows([track_id])[0])
+        return None if row < 0 else row
+
+    def get(self, track_id):
+        """
+        Return the embedding of track_id, a read-only view into the mapped file for float32 stores.
+
+        Returns:
+        numpy.array: The (dimension,) float32 vector, or None if the track is not stored.
+        """
+        row = self.row(track_id)
+        if row is None:
+            return None
+        return self.read(row)
+
+    def append(self, track_ids, vectors):
+        """
+        Append vectors to the end of the store.
+
+        Track ids that are already stored are skipped, so an interrupted job can simply
+        append its whole batch again.
+
+        Args:
+        track_ids (array-like of int): Track id of every vector.
+        vectors (numpy.array): (n, dimension) float32 vectors to append, encoded into the dtype of the store.
+
+        Returns:
+        int: Number of rows actually appended.
+        """
+        track_ids = np.asarray(track_ids, dtype=self.TRACK_ID_DTYPE).reshape(-1)
+        vectors = np.asarray(vectors).reshape(len(track_ids), -1)
+        if vectors.shape[1] != self.dimension:
+            raise ValueError(f"Expected vectors of dimension {self.dimension}, got {vectors.shape[1]}.")
+
+        with self._lock:
+            new_ids, first = np.unique(track_ids, return_index=True)
+            keep = np.sort(first[self.rows(new_ids) < 0])
+            if keep.size == 0:
+                return 0
+            if keep.size < len(track_ids):
+                logger.debug(f"Skipping {len(track_ids) - keep.size} track ids already in {self.path}")
+
+            with open(os.path.join(self.path, self.VECTORS_FILE), "r+b") as file:
+                file.seek(self.count * self.dimension * self.dtype.itemsize)
+                file.write(self.encode(vectors[keep]).tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+            with open(os.path.join(self.path, self.TRACK_IDS_FILE), "r+b") as file:
+                file.seek(self.count * np.dtype(self.TRACK_ID_DTYPE).itemsize)
+                file.write(track_ids[keep].tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+
+            previous_count = self.count
+            self._write_header(self.path, self.header(self.count + int(keep.size)))
+            self._map()
+            if self.count == previous_count + keep.size:
+                self._merge_lookup(track_ids[keep], previous_count)
+            else:
+                # Another writer appended too, rebuild the lookup from the file
+                self._build_lookup()
+            return int(keep.size)
+
+
+def convert_embedding_folder(embeddings_folder, store_path, dimension, overwrite=True, dtype="float32"):
+    """
+    Convert a folder of per-track <track_id>.npy embeddings into an EmbeddingStore.
+
+    Files whose embedding does not have the expected dimension are skipped, the same
+    way VectorDatabase.load_vectors skips them. Rows are written sorted by track_id.
+
+    Args:
+    embeddings_folder (str): Folder containing one <track_id>.npy file per track.
+    store_path (str): Folder of the store to create.
+    dimension (int): Expected dimension of every embedding.
+    overwrite (bool): Replace an existing store at store_path.
+    dtype (str): numpy dtype of the store, see STORE_DTYPES.
+
+    Returns:
+    EmbeddingStore: The populated store.
+    """
+    if np.dtype(dtype) == np.uint8:
+        # The quantizer ranges are only known once every embedding has been read
+        temporary_path = f"{store_path}.float32.tmp"
+        try:
+            source = convert_embedding_folder(embeddings_folder, temporary_path, dimension, overwrite=True)
+            return compress_store(source, store_path, dtype, overwrite=overwrite)
+        finally:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+    files = {}
+    for file_ in os.listdir(embeddings_folder):
+        if not file_.endswith(".npy"):
+            continue
+        try:
+            files[int(file_[:-4])] = file_
+        except ValueError:
+            logger.warning(f"Skipping {file_}, its name is not a track_id.")
+
+    store = EmbeddingStore.create(store_path, dimension, dtype=dtype, overwrite=overwrite)
+    track_ids = np.array(sorted(files), dtype=EmbeddingStore.TRACK_ID_DTYPE)
+    if track_ids.size == 0:
+        logger.warning(f"No embeddings found in {embeddings_folder}")
+        return store
+
+    # Write straight into the mapped file, then drop the rows that were skipped
+    vectors_path = os.path.join(store_path, EmbeddingStore.VECTORS_FILE)
+    vectors = np.memmap(vectors_path, dtype=store.dtype, mode="w+", shape=(len(track_ids), dimension))
+    kept_ids = []
+    for track_id in tqdm(track_ids):
+        file_path = os.path.join(embeddings_folder, files[track_id])
+        try:
+            embedding = np.load(file_path).reshape(-1)
+        except Exception as e:
+            logger.error(f"Failed to load {file_path}: {e}")
+            continue
+        if embedding.shape[0] != dimension:
+            continue
+        vectors[len(kept_ids)] = embedding
+        kept_ids.append(track_id)
+    vectors.flush()
+    del vectors
+    os.truncate(vectors_path, len(kept_ids) * dimension * store.dtype.itemsize)
+
+    kept_ids = np.array(kept_ids, dtype=EmbeddingStore.TRACK_ID_DTYPE)
+    with open(os.path.join(store_path, EmbeddingStore.TRACK_IDS_FILE), "wb") as file:
+        file.write(kept_ids.tobytes())
+    EmbeddingStore._write_header(store_path, store.header(kept_ids.size))
+    store.refresh()
+    logger.info(f"Converted {len(store)} embeddings from {embeddings_folder} into {store_path}")
+    return store
+
+
+def compress_store(source, store_path, dtype, overwrite=True, chunk_size=65536):
+    """
+    Copy a store into a new store of another dtype, e.g. a float32 store into a float16 or 8-bit one.
+
+    The ranges of an 8-bit store are the per-dimension minimum and maximum of the source.
+
+    Args:
+    source (EmbeddingStore): Store to copy.
+    store_path (str): Folder of the store to create, different from the folder of source.
+    dtype (str): numpy dtype of the new store, see STORE_DTYPES.
+    overwrite (bool): Replace an existing store at store_path.
+    chunk_size (int): Rows read and written at once.
+
+    Returns:
+    EmbeddingStore: The populated store.
+    """
+    if os.path.abspath(store_path) == os.path.abspath(source.path):
+        raise ValueError("A store cannot be compressed into its own folder.")
+    chunks = [slice(start, min(start + chunk_size, len(source))) for start in range(0, len(source), chunk_size)]
+    ranges = None
+    if np.dtype(dtype) == np.uint8:
+        vmin = np.full(source.dimension, np.inf, dtype=np.float32)
+        vmax = np.full(source.dimension, -np.inf, dtype=np.float32)
+        for chunk in chunks:
+            rows = source.read(chunk)
+            np.minimum(vmin, rows.min(axis=0), out=vmin)
+            np.maximum(vmax, rows.max(axis=0), out=vmax)
+        ranges = (vmin, vmax) if chunks else (np.zeros(source.dimension), np.zeros(source.dimension))
+
+    store = EmbeddingStore.create(store_path, source.dimension, dtype=dtype, overwrite=overwrite, ranges=ranges)
+    if len(source):
+        vectors = np.memmap(os.path.join(store_path, EmbeddingStore.VECTORS_FILE), dtype=store.dtype, mode="w+",
+                            shape=(len(source), source.dimension))
+        for chunk in chunks:
+            vectors[chunk] = store.encode(source.read(chunk))
+        vectors.flush()
+        del vectors
+        with open(os.path.join(store_path, EmbeddingStore.TRACK_IDS_FILE), "wb") as file:
+            file.write(np.asarray(source.track_ids, dtype=EmbeddingStore.TRACK_ID_DTYPE).tobytes())
+        EmbeddingStore._write_header(store_path, store.header(len(source)))
+        store.refresh()
+    logger.info(f"Compressed {len(store)} embeddings of {source.path} from {source.bytes_per_vector} to "
+                f"{store.bytes_per_vector} bytes per vector into {store_path}")
+    return store
+
+
+def open_embedding_stores(store_folder, modalities=MODALITIES):
+    """
+    Open the store of every modality under store_folder.
+
+    Returns:
+    dict: modality -> EmbeddingStore, only for the modalities that have a store.
+    """
+    stores = {}
+    for modality in modalities:
+        path = os.path.join(store_folder, modality)
+        if EmbeddingStore.exists(path):
+            stores[modality] = EmbeddingStore(path)
+    return stores
@@ -0,0 +1,314 @@
+import os
+import sys
+import time
+import json
+import bisect
+import functools
+import cProfile
+import pstats
+import threading
+import contextvars
+import logging
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Type and help text of every metric, in the order they are exposed
+METRICS = {
+    "songs_requests_total": ("counter", "Requests handled, by request type."),
+    "songs_request_errors_total": ("counter", "Requests that raised an error, by request type."),
+    "songs_requests_rejected_total": ("counter", "Requests rejected by the search service to shed load, by reason."),
+    "songs_queries_total": ("counter", "Query vectors searched in the FAISS index."),
+    "songs_cache_hits_total": ("counter", "Cache hits, by cache."),
+    "songs_cache_misses_total": ("counter", "Cache misses, by cache."),
+    "songs_model_loads_total": ("counter", "Models deserialized from disk."),
+    "songs_index_reloads_total": ("counter", "FAISS indexes (re)loaded from disk."),
+    "songs_batches_total": ("counter", "Batched forward passes run by the micro-batching scheduler, by model."),
+    "songs_batched_segments_total": ("counter", "Segments forwarded in batched forward passes, by model."),
+    "songs_request_duration_seconds": ("histogram", "End to end duration of requests, by request type."),
+    "songs_stage_duration_seconds": ("histogram", "Duration of every pipeline stage, by stage."),
+    "songs_search_latency_seconds": ("histogram", "Latency of FAISS index searches."),
+    "songs_embedding_latency_seconds": ("histogram", "Latency of embedding an audio file with every model.")
+}
+
+# Trace of the request being handled by the current thread or task, if any
+_CURRENT_TRACE = contextvars.ContextVar("songs_request_trace", default=None)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and histograms of the process, rendered in the Prometheus text format.
+
+    Metrics are identified by name and labels, e.g. increment("songs_cache_hits_total", cache="features").
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _label_key(labels))
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # One count per bucket plus +Inf, then the sum of the observations
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+
+    def counter_value(self, name, **labels):
+        return self._counters.get((name, _label_key(labels)), 0)
+
+    def render_prometheus(self):
+        """ All metrics in the Prometheus text exposition format (version 0.0.4). """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(counts), total) for key, (counts, total) in self._histograms.items()}
+
+        names = list(METRICS) + sorted({name for name, _ in list(counters) + list(histograms)} - set(METRICS))
+        lines = []
+        for name in names:
+            metric_type, help_text = METRICS.get(name, ("histogram" if any(key[0] == name for key in histograms) else "counter", name))
+            samples = sorted((key for key in (counters if metric_type == "counter" else histograms) if key[0] == name),
+                             key=lambda key: key[1])
+            if not samples:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for key in samples:
+                label_key = key[1]
+                if metric_type == "counter":
+                    lines.append(f"{name}{_format_labels(label_key)} {counters[key]}")
+                    continue
+                counts, total = histograms[key]
+                cumulative = 0
+                for upper_bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if upper_bound == float("inf") else repr(upper_bound)
+                    lines.append(f"{name}_bucket{_format_labels(label_key, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(label_key)} {total}")
+                lines.append(f"{name}_count{_format_labels(label_key)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """ Write the metrics to path atomically, e.g. for the node_exporter textfile collector. """
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            file.write(self.render_prometheus())
+        os.replace(temp_path, path)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+_METRICS = None
+_METRICS_LOCK = threading.Lock()
+
+
+def get_metrics():
+    """ Return the MetricsRegistry shared by the whole process. """
+    global _METRICS
+    with _METRICS_LOCK:
+        if _METRICS is None:
+            _METRICS = MetricsRegistry()
+    return _METRICS
+
+
+class RequestTrace:
+    """ Stages, counters and fields of one request, logged as one structured line when it ends. """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.stages = {}
+        self.counters = {}
+
+    def add_stage(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+def count(name, value=1, **labels):
+    """ Increment a counter of the process, and of the current request under name[_label values]. """
+    get_metrics().increment(name, value, **labels)
+    trace = _CURRENT_TRACE.get()
+    if trace is not None:
+        trace.add_count("_".join([name.replace("songs_", "").replace("_total", "")] + [str(label_value) for _, label_value in sorted(labels.items())]), value)
+
+
+def observe(name, seconds, **labels):
+    get_metrics().observe(name, seconds, **labels)
+
+
+@contextmanager
+def span(stage, histogram=None):
+    """
+    Time a pipeline stage.
+
+    The duration is observed in songs_stage_duration_seconds{stage=...}, in histogram if
+    given, and added to the trace of the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics = get_metrics()
+        metrics.observe("songs_stage_duration_seconds", elapsed, stage=stage)
+        if histogram is not None:
+            metrics.observe(histogram, elapsed)
+        trace = _CURRENT_TRACE.get()
+        if trace is not None:
+            trace.add_stage(stage, elapsed)
+
+
+def timed(stage, histogram=None):
+    """ Decorator timing every call of a function as a span of the given stage. """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage, histogram):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def request_trace(name, **fields):
+    """
+    Trace one request: every span and count inside it is collected and a single structured
+    JSON log line is written when it ends, e.g.
+
+    {"event": "request", "request": "upload", "status": "ok", "duration_ms": 812.4,
+     "stages": {"decode": 20.1, "spectrogram": 95.3, ...}, "counters": {"cache_hits_query_embedding": 0, ...}}
+
+    Args:
+    name (str): Type of the request.
+    fields: Extra fields of the log line, e.g. the file name.
+
+    Yields:
+    RequestTrace: The trace, fields can still be added to trace.fields.
+    """
+    trace = RequestTrace(name, dict(fields))
+    token = _CURRENT_TRACE.set(trace)
+    get_metrics().increment("songs_requests_total", request=name)
+    status = "ok"
+    start = time.perf_counter()
+    try:
+        yield trace
+    except BaseException:
+        status = "error"
+        get_metrics().increment("songs_request_errors_total", request=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        _CURRENT_TRACE.reset(token)
+        get_metrics().observe("songs_request_duration_seconds", elapsed, request=name)
+        record = {"event": "request", "request": name, "status": status, "duration_ms": round(elapsed * 1000, 3),
+                  "stages": {stage: round(seconds * 1000, 3) for stage, seconds in trace.stages.items()},
+                  "counters": trace.counters}
+        record.update(trace.fields)
+        logger.info(json.dumps(record, default=str))
+
+
+def resident_memory_bytes():
+    """ Resident set size of the process, its peak where /proc is not available. """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_metrics().render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to be logged
+        pass
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """ Serve the metrics of the process at http://host:port/metrics from a daemon thread. """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Prometheus metrics served at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def add_instrumentation_arguments(parser):
+    """ Add the --profile and --metrics-file options to the argument parser of a script. """
+    parser.add_argument("--profile", nargs="?", const="profile.prof", default=None, metavar="PATH",
+                        help="Profile the run with cProfile and write the stats to PATH (profile.prof by default)")
+    parser.add_argument("--metrics-file", type=str, default=None, metavar="PATH",
+                        help="Write the metrics of the run to PATH in the Prometheus text format")
+    return parser
+
+
+def run_instrumented(function, profile_path=None, metrics_file=None):
+    """
+    Run function, under cProfile if profile_path is given, and write the metrics afterwards if metrics_file is given.
+
+    The profile can be inspected with `python -m pstats PATH` or snakeviz; the 20 most expensive
+    calls by cumulative time are also logged.
+    """
+    try:
+        if not profile_path:
+            return function()
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function)
+        finally:
+            profiler.dump_stats(profile_path)
+            stats = pstats.Stats(profiler)
+            logger.info(f"cProfile stats written to {profile_path}, top calls by cumulative time:")
+            stats.sort_stats("cumulative").print_stats(20)
+    finally:
+        if metrics_file:
+            get_metrics().write_prometheus(metrics_file)
+            logger.info(f"Metrics written to {metrics_file}")
@@ -0,0 +1,237 @@
+import threading
+import logging
+import pandas as pd
+from similarity_engine.instrumentation import count, timed
+from sqlalchemy import Index, MetaData, Table, bindparam, create_engine, inspect, text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TRACK_DETAILS_COLUMNS = ['vector_id', 'track_id', 'title', 'artist', 'released', 'album', 'genre']
+
+# Portable between MySQL and SQLite, the release year is derived from date_created in pandas
+TRACK_DETAILS_QUERY = """
+    SELECT vm.vector_id, t.track_id, t.title, a.name as artist, t.date_created as released, al.title as album, t.genre_top as genre
+    FROM tracks t
+    INNER JOIN vector_metadata vm ON t.track_id = vm.track_id
+    INNER JOIN artists a ON t.track_id = a.track_id
+    INNER JOIN albums al ON t.track_id = al.track_id
+    """
+
+TRACK_DETAILS_BY_VECTOR_IDS = text(TRACK_DETAILS_QUERY + "WHERE vm.vector_id IN :vector_ids").bindparams(
+    bindparam("vector_ids", expanding=True))
+
+# Indexes keyed by track_id return track_ids directly, so the vector_metadata join is not needed
+TRACK_DETAILS_BY_TRACK_QUERY = """
+    SELECT t.track_id as vector_id, t.track_id, t.title, a.name as artist, t.date_created as released, al.title as album, t.genre_top as genre
+    FROM tracks t
+    INNER JOIN artists a ON t.track_id = a.track_id
+    INNER JOIN albums al ON t.track_id = al.track_id
+    """
+
+TRACK_DETAILS_BY_TRACK_IDS = text(TRACK_DETAILS_BY_TRACK_QUERY + "WHERE t.track_id IN :vector_ids").bindparams(
+    bindparam("vector_ids", expanding=True))
+
+# Columns the track details JOIN filters and joins on, indexed after every bulk load
+METADATA_INDEXES = {
+    "tracks": ["track_id"],
+    "artists": ["track_id"],
+    "albums": ["track_id"],
+    "vector_metadata": ["vector_id", "track_id"]
+}
+
+# One pooled engine per database URL, shared by the whole process
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def database_url(db_config):
+    """
+    SQLAlchemy URL of the configured database.
+
+    An explicit "url" (e.g. "sqlite:///songs.db" for a local stand-in) takes precedence over
+    the MySQL user/password/host/port/database settings.
+    """
+    if db_config.get('url'):
+        return db_config['url']
+    return f"mysql+mysqldb://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['database']}"
+
+
+def get_engine(db_config):
+    """
+    Return the pooled engine of the configured database, created on first use.
+
+    Connections are checked out from the pool instead of being opened per query, and are
+    pinged before use so connections dropped by the server are replaced transparently.
+    """
+    url = database_url(db_config)
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(url)
+        if engine is None:
+            if url.startswith("sqlite"):
+                engine = create_engine(url)
+            else:
+                engine = create_engine(url, pool_size=db_config.get('pool_size', 5), max_overflow=db_config.get('max_overflow', 10),
+                                       pool_pre_ping=True, pool_recycle=3600)
+            _ENGINES[url] = engine
+    return engine
+
+
+def create_metadata_indexes(engine, tables=None):
+    """
+    Create the join/filter indexes of the metadata tables that exist and miss them.
+
+    Tables written with DataFrame.to_sql(if_exists='replace') lose their indexes, so this
+    has to run after every (re)load.
+
+    Args:
+    engine (sqlalchemy.engine.Engine): Engine of the metadata database.
+    tables (list of str): Tables to index, every table of METADATA_INDEXES if None.
+    """
+    existing_tables = set(inspect(engine).get_table_names())
+    metadata = MetaData()
+    for table_name in tables or METADATA_INDEXES:
+        if table_name not in existing_tables:
+            continue
+        table = Table(table_name, metadata, autoload_with=engine)
+        for column in METADATA_INDEXES[table_name]:
+            Index(f"ix_{table_name}_{column}", table.c[column]).create(engine, checkfirst=True)
+        logger.info(f"Indexes on {table_name}({', '.join(METADATA_INDEXES[table_name])}) are in place.")
+
+
+def _finalize_track_details(results):
+    results['released'] = pd.to_datetime(results['released'], errors='coerce').dt.year.astype('Int64')
+    return results.drop_duplicates('vector_id')
+
+
+def query_track_details(engine, vector_ids=None, id_column="vector_id"):
+    """
+    Run the JOIN of the track details.
+
+    Args:
+    engine (sqlalchemy.engine.Engine): Engine of the metadata database.
+    vector_ids (list of int): Vector IDs to fetch, every vector if None.
+    id_column (str): "vector_id" if the ids are positions in the index, mapped to tracks through
+        vector_metadata, or "track_id" if the index stores track_ids (vector_id is then the track_id).
+
+    Returns:
+    pandas.DataFrame: One row per vector ID with the TRACK_DETAILS_COLUMNS.
+    """
+    by_track_id = id_column == "track_id"
+    with engine.connect() as connection:
+        if vector_ids is None:
+            results = pd.read_sql_query(text(TRACK_DETAILS_BY_TRACK_QUERY if by_track_id else TRACK_DETAILS_QUERY), connection)
+        else:
+            results = pd.read_sql_query(TRACK_DETAILS_BY_TRACK_IDS if by_track_id else TRACK_DETAILS_BY_VECTOR_IDS, connection,
+                                        params={"vector_ids": [int(vector_id) for vector_id in vector_ids]})
+    return _finalize_track_details(results)
+
+
+class TrackMetadataCache:
+    """
+    In-process copy of the prejoined track details, indexed by vector_id.
+
+    The whole JOIN is loaded once into a columnar pandas table, so lookups are index
+    reads that skip the database. Vector IDs missing from the table (e.g. inserted after
+    the last refresh) are fetched from the database and added to it.
+
+    The table is tied to the index it was loaded for: rebuilding a positional index renumbers
+    vector_metadata, so the table is reloaded whenever the index signature changes.
+    """
+
+    def __init__(self, db_config, preload=True, id_column="vector_id", index_signature=None):
+        self.engine = get_engine(db_config)
+        self.id_column = id_column
+        self.index_signature = index_signature
+        self.table = pd.DataFrame(columns=TRACK_DETAILS_COLUMNS).set_index('vector_id')
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        if preload:
+            self.refresh()
+
+    def refresh(self, index_signature=None):
+        """ Reload the whole prejoined table, e.g. after new vectors were inserted or the index was rebuilt. """
+        table = query_track_details(self.engine, id_column=self.id_column).set_index('vector_id').sort_index()
+        # Swap the reference so concurrent lookups keep reading a consistent table
+        with self._lock:
+            self.table = table
+            if index_signature is not None:
+                self.index_signature = index_signature
+        logger.info(f"Track metadata cache loaded with {len(table)} vectors.")
+
+    def ensure_index(self, index_signature):
+        """ Reload the table if it was loaded for another index than the one with index_signature. """
+        if index_signature is None or index_signature == self.index_signature:
+            return False
+        with self._refresh_lock:
+            # Another thread may have reloaded while we were waiting for the lock
+            if index_signature == self.index_signature:
+                return False
+            self.refresh(index_signature)
+            return True
+
+    def lookup(self, vector_ids):
+        """
+        Return the track details of vector_ids.
+
+        Args:
+        vector_ids (list of int): Vector IDs to look up.
+
+        Returns:
+        pandas.DataFrame: One row per found vector ID, in the order of vector_ids.
+        """
+        vector_ids = [int(vector_id) for vector_id in vector_ids if int(vector_id) >= 0]
+        table = self.table
+        missing = [vector_id for vector_id in set(vector_ids) if vector_id not in table.index]
+        count("songs_cache_misses_total" if missing else "songs_cache_hits_total", cache="metadata")
+        if missing:
+            fetched = query_track_details(self.engine, missing, self.id_column)
+            if not fetched.empty:
+                with self._lock:
+                    self.table = table = pd.concat([self.table, fetched.set_index('vector_id')]).sort_index()
+
+        found = [vector_id for vector_id in vector_ids if vector_id in table.index]
+        return table.loc[found].reset_index()
+
+
+# One metadata cache per database URL, shared by the whole process
+_METADATA_CACHES = {}
+_METADATA_CACHES_LOCK = threading.Lock()
+
+
+def get_track_metadata_cache(db_config, id_column="vector_id", index_signature=None):
+    """
+    Return the shared TrackMetadataCache of the configured database and id column, loaded on first use.
+
+    With index_signature (SimilaritySearch.index_signature), the table is reloaded if it was loaded for another index.
+    """
+    key = (database_url(db_config), id_column)
+    with _METADATA_CACHES_LOCK:
+        cache = _METADATA_CACHES.get(key)
+        if cache is None:
+            cache = TrackMetadataCache(db_config, id_column=id_column, index_signature=index_signature)
+            _METADATA_CACHES[key] = cache
+    cache.ensure_index(index_signature)
+    return cache
+
+
+@timed("metadata_fetch")
+def fetch_track_details_by_vector_ids(vector_ids, db_config, id_column="vector_id", index_signature=None):
+    """
+    Fetch the track details of vector_ids through the metadata cache when enabled
+    ("cache_metadata" in the database config), or with one pooled database query.
+
+    id_column is "track_id" when the ids come from an index keyed by track_id, see query_track_details.
+    index_signature is the signature of the index the ids come from, the cache is reloaded when it changes.
+
+    Returns:
+    pandas.DataFrame: One row per found vector ID with the TRACK_DETAILS_COLUMNS, in the order of vector_ids.
+    """
+    vector_ids = [int(vector_id) for vector_id in vector_ids if int(vector_id) >= 0]
+    if db_config.get('cache_metadata'):
+        return get_track_metadata_cache(db_config, id_column, index_signature).lookup(vector_ids)
+    if not vector_ids:
+        return pd.DataFrame(columns=TRACK_DETAILS_COLUMNS)
+    details = query_track_details(get_engine(db_config), sorted(set(vector_ids)), id_column).set_index('vector_id')
+    return details.loc[[vector_id for vector_id in vector_ids if vector_id in details.index]].reset_index()
@@ -0,0 +1,143 @@
+import math
+import logging
+import faiss
+import numpy as np
+from similarity_engine.ann_index import MIN_POINTS_PER_CENTROID, _largest_divisor
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROJECTION_TYPES = ["PCA", "OPQ"]
+
+# Vectors sampled from the corpus to train the projection and to measure its explained variance
+PROJECTION_TRAINING_SIZE = 100000
+VARIANCE_SAMPLE_SIZE = 10000
+
+# Fraction of the variance kept when no projection_dimension is configured
+DEFAULT_EXPLAINED_VARIANCE = 0.95
+
+
+def _sample(vectors, size, seed=0):
+    if len(vectors) <= size:
+        return np.ascontiguousarray(vectors, dtype='float32')
+    rows = np.sort(np.random.default_rng(seed).choice(len(vectors), size=size, replace=False))
+    return np.ascontiguousarray(vectors[rows], dtype='float32')
+
+
+def variance_spectrum(vectors, seed=0):
+    """
+    Cumulative fraction of the variance of vectors explained by their first principal components.
+
+    Returns:
+    numpy.array: (dimension,) explained variance of the first 1, 2, ... components.
+    """
+    sample = _sample(vectors, VARIANCE_SAMPLE_SIZE, seed).astype(np.float64)
+    sample -= sample.mean(axis=0)
+    eigenvalues = np.linalg.eigvalsh(sample.T @ sample)[::-1].clip(min=0)
+    return np.cumsum(eigenvalues) / max(eigenvalues.sum(), 1e-30)
+
+
+def explained_variance(projection, vectors, seed=0):
+    """ Fraction of the variance of vectors kept by a projection, measured on a sample. """
+    sample = _sample(vectors, VARIANCE_SAMPLE_SIZE, seed)
+    total = sample.var(axis=0, dtype=np.float64).sum()
+    kept = projection.apply(sample).var(axis=0, dtype=np.float64).sum()
+    return float(kept / max(total, 1e-30))
+
+
+def train_projection(projection_type, vectors, dimension=None, params=None, seed=0):
+    """
+    Train a dimensionality reduction of the corpus.
+
+    PCA keeps the directions of largest variance. OPQ learns a rotation (and reduction) that
+    balances the variance across pq_m sub-vectors, the best input for product quantization.
+
+    Args:
+    projection_type (str): One of PROJECTION_TYPES.
+    vectors (numpy.array): (n, input_dimension) float32 corpus, PROJECTION_TRAINING_SIZE of them are trained on.
+    dimension (int): Dimension of the projected vectors, the smallest one keeping
+        DEFAULT_EXPLAINED_VARIANCE of the variance if None.
+    params (dict): Parameters from the "faiss" section of config.json, OPQ uses pq_m sub-vectors when it divides dimension.
+    seed (int): Seed of the training sample.
+
+    Returns:
+    faiss.VectorTransform: The trained projection.
+    dict: Its description, saved with the index.
+    """
+    params = {key: value for key, value in (params or {}).items() if value is not None}
+    input_dimension = vectors.shape[1]
+    spectrum = variance_spectrum(vectors, seed)
+    if dimension is None:
+        dimension = int(np.searchsorted(spectrum, DEFAULT_EXPLAINED_VARIANCE) + 1)
+    dimension = max(1, min(int(dimension), input_dimension))
+
+    training = _sample(vectors, PROJECTION_TRAINING_SIZE, seed)
+    info = {"type": projection_type, "input_dimension": input_dimension, "dimension": dimension,
+            "training_vectors": len(training)}
+    if projection_type == "PCA":
+        projection = faiss.PCAMatrix(input_dimension, dimension)
+    elif projection_type == "OPQ":
+        m = params.get("pq_m")
+        if m is None or dimension % m:
+            m = _largest_divisor(dimension, 64)
+        projection = faiss.OPQMatrix(input_dimension, m, dimension)
+        # Codebooks of small corpora are shrunk like the ones of IVFPQ, every centroid needs training points
+        nbits = max(1, min(8, int(math.log2(max(len(training) // MIN_POINTS_PER_CENTROID, 2)))))
+        product_quantizer = faiss.ProductQuantizer(dimension, m, nbits)
+        projection.pq = product_quantizer
+        projection.train(training)
+        projection.pq = None
+        info["pq_m"] = m
+    else:
+        raise ValueError(f"Unknown projection {projection_type}, expected one of {PROJECTION_TYPES}.")
+
+    if not projection.is_trained:
+        projection.train(training)
+    info["explained_variance"] = round(explained_variance(projection, vectors, seed), 4)
+    # The best any projection to this dimension can keep, the principal components
+    info["pca_explained_variance"] = round(float(spectrum[dimension - 1]), 4)
+    logger.info(f"{projection_type} projection {input_dimension} -> {dimension} trained on {len(training)} vectors, "
+                f"explained variance {info['explained_variance']:.4f} (PCA bound {info['pca_explained_variance']:.4f})")
+    return projection, info
+
+
+def apply_projection(projection, vectors, chunk_size=65536):
+    """
+    Project vectors chunk by chunk, without a temporary copy of the whole corpus.
+
+    Returns:
+    numpy.array: (n, projection.d_out) float32 projected vectors.
+    """
+    vectors = np.asarray(vectors, dtype='float32')
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    projected = np.empty((len(vectors), projection.d_out), dtype='float32')
+    for start in range(0, len(vectors), chunk_size):
+        projected[start:start + chunk_size] = projection.apply(np.ascontiguousarray(vectors[start:start + chunk_size]))
+    return projected
+
+
+def projected_index(projection, index):
+    """
+    Put a projection in front of an index built over projected vectors.
+
+    The result is a faiss.IndexPreTransform: searches and add_with_ids take the unprojected
+    vectors, and it is written and read as one file, so the projection always travels with
+    the vectors it produced. Inner product indexes re-normalize the projected vectors.
+    """
+    wrapped = faiss.IndexPreTransform(index)
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        wrapped.prepend_transform(faiss.NormalizationTransform(projection.d_out, 2.0))
+    wrapped.prepend_transform(projection)
+    return wrapped
+
+
+def index_projection(index):
+    """ The projection in front of an index made by projected_index, None for any other index. """
+    if hasattr(index, "shards"):
+        return index_projection(index.shards[0]) if index.shards else None
+    index = faiss.downcast_index(index) if isinstance(index, faiss.Index) else index
+    if isinstance(index, faiss.IndexPreTransform) and index.chain.size():
+        return index.chain.at(0)
+    return None
@@ -0,0 +1,269 @@
+import os
+import time
+import atexit
+import itertools
+import threading
+import logging
+import multiprocessing
+from concurrent.futures import Future
+import faiss
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Start method of the shard workers, spawn does not inherit the OpenMP/torch state of the parent
+WORKER_START_METHOD = "spawn"
+
+# Seconds a replaced coordinator keeps serving after its last search, for callers that still hold it
+RETIRE_GRACE_SECONDS = 5.0
+
+
+def shard_of(ids, n_shards):
+    """ Shard of every id, vectors are partitioned by track_id modulo the number of shards. """
+    return np.asarray(ids, dtype=np.int64) % n_shards
+
+
+def shard_path(index_path, shard):
+    return f"{index_path}.shard{shard}"
+
+
+def merge_topk(distances, indices, top_k, metric_type=faiss.METRIC_L2):
+    """
+    Merge the per-shard top-k results into the global top-k.
+
+    Args:
+    distances (list of numpy.array): (m, k) distances returned by every shard.
+    indices (list of numpy.array): (m, k) ids returned by every shard, -1 for missing results.
+    top_k (int): Number of results to keep per query.
+    metric_type (int): faiss metric of the shards, larger is better for METRIC_INNER_PRODUCT.
+
+    Returns:
+    numpy.array: (m, top_k) distances of the global top-k.
+    numpy.array: (m, top_k) ids of the global top-k, -1 padded.
+    """
+    distances = np.hstack(distances)
+    indices = np.hstack(indices)
+    larger_is_better = metric_type == faiss.METRIC_INNER_PRODUCT
+    # Missing results go last whatever distance faiss padded them with
+    keys = np.where(indices < 0, np.inf, -distances if larger_is_better else distances)
+    order = np.argsort(keys, axis=1, kind="stable")[:, :top_k]
+    merged_distances = np.take_along_axis(distances, order, axis=1)
+    merged_indices = np.take_along_axis(indices, order, axis=1)
+    if merged_indices.shape[1] < top_k:
+        padding = top_k - merged_indices.shape[1]
+        merged_distances = np.pad(merged_distances, ((0, 0), (0, padding)), constant_values=np.inf)
+        merged_indices = np.pad(merged_indices, ((0, 0), (0, padding)), constant_values=-1)
+    return merged_distances, merged_indices
+
+
+class ShardedIndex:
+    """
+    In-process collection of index shards, partitioned by id with shard_of.
+
+    It exposes the parts of the faiss.Index interface the vector database uses (search,
+    add_with_ids, remove_ids, ntotal, d, metric_type), so it can be built, updated and
+    saved like a single index.
+    """
+
+    def __init__(self, shards):
+        self.shards = list(shards)
+
+    @property
+    def ntotal(self):
+        return sum(shard.ntotal for shard in self.shards)
+
+    @property
+    def d(self):
+        return self.shards[0].d
+
+    @property
+    def metric_type(self):
+        return self.shards[0].metric_type
+
+    def search(self, queries, top_k):
+        results = [shard.search(queries, top_k) for shard in self.shards]
+        return merge_topk([result[0] for result in results], [result[1] for result in results], top_k, self.metric_type)
+
+    def add_with_ids(self, vectors, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        shards = shard_of(ids, len(self.shards))
+        for shard, index in enumerate(self.shards):
+            rows = np.flatnonzero(shards == shard)
+            if len(rows):
+                index.add_with_ids(np.ascontiguousarray(vectors[rows]), ids[rows])
+
+    def remove_ids(self, selector):
+        return sum(int(shard.remove_ids(selector)) for shard in self.shards)
+
+
+def _load_shards(paths, search_params):
+    # Imported here, spawned workers only need faiss and the index helpers
+    from similarity_engine.ann_index import set_search_parameters
+    return [set_search_parameters(faiss.read_index(path), search_params) for path in paths]
+
+
+def _shard_worker(connection, paths, search_params, omp_threads):
+    """ Worker process: loads its shards and answers search requests until told to stop. """
+    faiss.omp_set_num_threads(omp_threads)
+    shards = ShardedIndex(_load_shards(paths, search_params))
+    while True:
+        try:
+            request_id, operation, payload = connection.recv()
+        except EOFError:
+            break
+        if operation == "stop":
+            break
+        try:
+            if operation == "search":
+                queries, top_k = payload
+                result = shards.search(queries, top_k)
+            elif operation == "reload":
+                shards = ShardedIndex(_load_shards(paths, search_params))
+                result = shards.ntotal
+            else:
+                raise ValueError(f"Unknown operation {operation}")
+            connection.send((request_id, True, result))
+        except Exception as e:
+            connection.send((request_id, False, repr(e)))
+    connection.close()
+
+
+class _WorkerHandle:
+    """ Connection to one worker process, requests are pipelined and matched to futures by id. """
+
+    def __init__(self, context, paths, search_params, omp_threads):
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=_shard_worker, args=(worker_connection, paths, search_params, omp_threads),
+                                       daemon=True)
+        self.process.start()
+        worker_connection.close()
+        self.pending = {}
+        self.send_lock = threading.Lock()
+        # Guards pending and exited, the receiver never waits on a send blocked by a full pipe
+        self.pending_lock = threading.Lock()
+        self.exited = False
+        self.ids = itertools.count()
+        self.receiver = threading.Thread(target=self._receive, daemon=True)
+        self.receiver.start()
+
+    def request(self, operation, payload=None):
+        if not self.process.is_alive():
+            raise RuntimeError("Shard worker exited")
+        future = Future()
+        with self.send_lock:
+            request_id = next(self.ids)
+            with self.pending_lock:
+                if self.exited:
+                    raise RuntimeError("Shard worker exited")
+                self.pending[request_id] = future
+            self.connection.send((request_id, operation, payload))
+        return future
+
+    def _receive(self):
+        while True:
+            try:
+                request_id, ok, result = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            with self.pending_lock:
+                future = self.pending.pop(request_id)
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(f"Shard worker failed: {result}"))
+        # The worker is gone, fail whatever is still waiting and refuse new requests
+        with self.pending_lock:
+            self.exited = True
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError("Shard worker exited"))
+
+    def stop(self):
+        try:
+            with self.send_lock:
+                self.connection.send((None, "stop", None))
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+
+
+class ShardSearchCoordinator:
+    """
+    Scatter-gather search over index shards held by local worker processes.
+
+    Every worker loads a subset of the shard files (standing in for one node of a cluster),
+    a search is sent to all workers in parallel and their top-k results are merged into the
+    global top-k. Concurrent searches are pipelined to the workers. It exposes search, ntotal,
+    d and metric_type, so SimilaritySearch uses it like a single index.
+    """
+
+    def __init__(self, paths, workers=None, search_params=None, metric_type=faiss.METRIC_L2, dimension=None, ntotal=None):
+        self.paths = list(paths)
+        workers = min(workers or len(self.paths), len(self.paths))
+        self.metric_type = metric_type
+        self.d = dimension
+        self._ntotal = ntotal
+        context = multiprocessing.get_context(WORKER_START_METHOD)
+        # Share the cores between the workers instead of every worker using all of them
+        omp_threads = max(1, (os.cpu_count() or 1) // workers)
+        self.workers = [_WorkerHandle(context, self.paths[worker::workers], search_params or {}, omp_threads)
+                        for worker in range(workers)]
+        self._closed = False
+        # Searches in flight, a replaced coordinator is only closed once they are done
+        self._in_flight = 0
+        self._last_search = time.monotonic()
+        self._idle = threading.Condition()
+        atexit.register(self.close)
+        logger.info(f"Shard coordinator started {workers} worker(s) for {len(self.paths)} shards.")
+
+    @property
+    def ntotal(self):
+        return self._ntotal
+
+    def search(self, queries, top_k):
+        queries = np.ascontiguousarray(queries, dtype='float32')
+        with self._idle:
+            self._in_flight += 1
+        try:
+            futures = [worker.request("search", (queries, top_k)) for worker in self.workers]
+            results = [future.result() for future in futures]
+        finally:
+            with self._idle:
+                self._in_flight -= 1
+                self._last_search = time.monotonic()
+                self._idle.notify_all()
+        return merge_topk([result[0] for result in results], [result[1] for result in results], top_k, self.metric_type)
+
+    def reload(self):
+        """ Make every worker re-read its shard files. """
+        for future in [worker.request("reload") for worker in self.workers]:
+            future.result()
+
+    def close_when_idle(self, grace=RETIRE_GRACE_SECONDS):
+        """
+        Close the coordinator from a background thread once no search is in flight and none
+        started for grace seconds, so searches of threads still holding it finish normally.
+        """
+        def retire():
+            with self._idle:
+                while self._in_flight or time.monotonic() - self._last_search < grace:
+                    # Searches in flight notify when they finish, otherwise wait out the rest of the grace period
+                    self._idle.wait(timeout=None if self._in_flight else grace - (time.monotonic() - self._last_search))
+            self.close()
+            logger.info("Replaced shard coordinator closed.")
+
+        threading.Thread(target=retire, name="shard-coordinator-retire", daemon=True).start()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # Replaced coordinators are not kept alive by the exit hook until the process ends
+        atexit.unregister(self.close)
+        for worker in self.workers:
+            worker.stop()
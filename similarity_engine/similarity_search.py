@@ -1,4 +1,7 @@
 import os
+import threading
+import numpy as np
+from similarity_engine.instrumentation import count, span
 from similarity_engine.vector_database_setup import VectorDatabase
 import json
 import logging
@@ -15,10 +18,100 @@ def load_config(config_path=None):
         return json.load(file)
 
 
+# Long-lived search engines, one per index file, shared by every caller in the process
+_SEARCH_ENGINES = {}
+_SEARCH_ENGINES_LOCK = threading.Lock()
+
+
+def get_similarity_search(config):
+    """
+    Return the shared SimilaritySearch for the index configured in config.
+
+    The engine is created on first use and reused afterwards, so the FAISS index
+    is read from disk once per process instead of once per query.
+
+    Args:
+    config (dict): Configuration for the similarity search engine.
+
+    Returns:
+    SimilaritySearch: The resident search engine for config['paths']['index_path'].
+    """
+    index_path = os.path.abspath(VectorDatabase.get_full_path(config['paths']['index_path']))
+    with _SEARCH_ENGINES_LOCK:
+        engine = _SEARCH_ENGINES.get(index_path)
+        if engine is None:
+            engine = SimilaritySearch(config)
+            _SEARCH_ENGINES[index_path] = engine
+    return engine
+
+
 class SimilaritySearch:
     def __init__(self, config):
         """ Initialize by loading the FAISS index from the index path in config. """
         self.vector_db = VectorDatabase(config, create_index=False, load_vectors=False)
+        self.index_path = self.vector_db.get_full_path(config['paths']['index_path'])
+        self._index_signature = None
+        self._reload_lock = threading.Lock()
+        self.refresh_index()
+
+    def _file_signature(self):
+        """
+        Cheap fingerprint of the index: (inode, size, mtime) of the index file and of its
+        description, which is rewritten last when the index is saved.
+        """
+        signature = []
+        for path in (self.index_path, self.vector_db.index_info_path(self.index_path)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                signature.append(None)
+                continue
+            signature.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return None if signature == [None, None] else tuple(signature)
+
+    @property
+    def index_signature(self):
+        """ Signature of the index file the resident index was loaded from. """
+        return self._index_signature
+
+    @property
+    def id_column(self):
+        """ "track_id" if searches return track_ids, "vector_id" if they return positions mapped through vector_metadata. """
+        return self.vector_db.index_info.get("id_column", "vector_id")
+
+    @property
+    def query_dimension(self):
+        """ Dimension of the query vectors, the concatenated embeddings before any projection. """
+        return self.vector_db.index.d
+
+    def refresh_index(self, force=False):
+        """
+        Load the index if it is not resident yet or if the file on disk changed.
+
+        The file is only stat'ed here, a full read happens only when its inode, size
+        or modification time differ from the copy we already hold in memory.
+
+        Args:
+        force (bool): Reload the index even if the file signature did not change.
+
+        Returns:
+        bool: True if the index was (re)loaded from disk.
+        """
+        signature = self._file_signature()
+        if not force and self.vector_db.index is not None and signature == self._index_signature:
+            return False
+
+        with self._reload_lock:
+            # Another thread may have reloaded while we were waiting for the lock
+            if not force and self.vector_db.index is not None and signature == self._index_signature:
+                return False
+            with span("index_load"):
+                # Sharded indexes are searched by the shard worker processes when "shard_workers" is set
+                self.vector_db.load_index(use_workers=True)
+            count("songs_index_reloads_total")
+            if self.vector_db.index is not None:
+                self._index_signature = signature
+            return True
 
     def find_similar_embeddings(self, query_vector, top_k=5):
         """
@@ -32,18 +125,36 @@ class SimilaritySearch:
         numpy.array: Indices of the top_k nearest vectors in the database.
         numpy.array: Distances to the top_k nearest vectors.
         """
+        return self.find_similar_embeddings_batch(query_vector, top_k=top_k)
+
+    def find_similar_embeddings_batch(self, query_vectors, top_k=5):
+        """
+        Find the top_k most similar embeddings for every row of query_vectors with one index search.
+
+        Args:
+        query_vectors (numpy.array): (m, dimension) matrix of query vectors, a single (dimension,) vector is also accepted.
+        top_k (int): The number of nearest neighbors to return per query.
+
+        Returns:
+        numpy.array: (m, top_k) indices of the nearest vectors in the database, -1 where fewer than top_k exist.
+        numpy.array: (m, top_k) distances to the nearest vectors.
+        """
 
-        self.vector_db.load_index()
+        self.refresh_index()
 
         if self.vector_db.index is None:
             raise ValueError(
                 "FAISS index is not loaded. Please ensure the index is properly loaded."
             )
 
-        # Guys this is also important, ensure the query vector is in the correct shape (1, dimension)
-        if query_vector.ndim == 1:
-            query_vector = query_vector.reshape(1, -1)
+        # Guys this is also important, ensure the queries are a contiguous float32 (m, dimension) matrix
+        query_vectors = np.ascontiguousarray(query_vectors, dtype='float32')
+        if query_vectors.ndim == 1:
+            query_vectors = query_vectors.reshape(1, -1)
 
         # Perform the search
-        distances, indices = self.vector_db.index.search(query_vector, top_k)
+        count("songs_queries_total", len(query_vectors))
+        # Indexes built with a PCA/OPQ projection project the queries themselves
+        with span("faiss_search", histogram="songs_search_latency_seconds"):
+            distances, indices = self.vector_db.index.search(query_vectors, top_k)
         return indices, distances
@@ -0,0 +1,56 @@
+import os
+import sys
+import argparse
+
+# Make the project root importable when the script is run from within this folder
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import numpy as np
+from similarity_engine.ann_index import index_ids
+from similarity_engine.create_vector_database import load_config
+from similarity_engine.embedding_store import open_embedding_stores
+from similarity_engine.instrumentation import add_instrumentation_arguments, request_trace, run_instrumented
+from similarity_engine.vector_database_setup import VectorDatabase
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def missing_track_ids(vector_db):
+    """ Tracks of the embedding stores that are not in the index yet. """
+    store_folder = vector_db.config['paths'].get('embedding_store_folder')
+    stores = open_embedding_stores(vector_db.get_full_path(store_folder), vector_db.enabled_modalities()) if store_folder else {}
+    if len(stores) != len(vector_db.enabled_modalities()):
+        raise ValueError("Adding every missing track needs the embedding stores, run create_embedding_store.py first.")
+    stored = np.asarray(next(iter(stores.values())).track_ids)
+    return stored[~np.isin(stored, index_ids(vector_db.index))]
+
+
+def main(args):
+    config = load_config()
+    vector_db = VectorDatabase(config)
+    vector_db.load_index()
+    if vector_db.index is None:
+        raise RuntimeError("The FAISS index could not be loaded, build it with create_vector_database.py first.")
+
+    with request_trace(f"index_{args.action}") as trace:
+        if args.action == "add":
+            track_ids = args.track_ids if args.track_ids else missing_track_ids(vector_db)
+            trace.fields["tracks"] = vector_db.add_tracks(track_ids)
+        else:
+            trace.fields["tracks"] = vector_db.remove_tracks(args.track_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add or remove tracks of the FAISS index and vector_metadata in place")
+    parser.add_argument("action", choices=["add", "remove"], help="Add (or replace) or remove tracks")
+    parser.add_argument("track_ids", type=int, nargs="*",
+                        help="Tracks to add or remove, for add every track of the embedding stores missing from the index if none")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+    if args.action == "remove" and not args.track_ids:
+        parser.error("remove needs at least one track_id")
+    run_instrumented(lambda: main(args), args.profile, args.metrics_file)
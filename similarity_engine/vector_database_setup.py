@@ -1,33 +1,57 @@
 import os
+import json
 import pandas as pd
 import faiss
 import numpy as np
 import logging
-from sqlalchemy import create_engine
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from similarity_engine.ann_index import (build_index, exact_neighbors, index_ids, index_memory_bytes, recall_at_k,
+                                         set_search_parameters, supports_removal)
+from similarity_engine.instrumentation import resident_memory_bytes, timed
+from similarity_engine.embedding_store import MODALITIES, open_embedding_stores
+from similarity_engine.metadata_store import create_metadata_indexes, get_engine
+from similarity_engine.projection import apply_projection, index_projection, projected_index, train_projection
+from similarity_engine.sharding import ShardedIndex, ShardSearchCoordinator, shard_of, shard_path
+from sqlalchemy import bindparam, inspect, text
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class VectorDatabase:
+    # Number of tracks each loader thread reads per task
+    LOAD_CHUNK_SIZE = 1024
+
     def __init__(self, config, create_index=False, load_vectors=False):
         self.config = config
         self.combinator = config["combinator"]
         self.vector_files = config['paths']['embeddings_folder']
         self.dimension = config['faiss']['dimension']
         self.index_type = config['faiss']['index_type']
+        # Store track_ids as the ids of the index instead of the positions of the vectors
+        self.id_map = config['faiss'].get('id_map', False)
+        # Number of shards the index is partitioned into by track_id, and of worker processes searching them
+        self.n_shards = max(1, config['faiss'].get('shards') or 1)
+        self.shard_workers = config['faiss'].get('shard_workers') or 0
+        # Optional PCA/OPQ reduction of the vectors before they are indexed, applied to the queries too
+        self.projection_type = config['faiss'].get('projection')
+        self.projection_dimension = config['faiss'].get('projection_dimension')
+        self.load_workers = config.get('loader', {}).get('workers', min(32, (os.cpu_count() or 1) + 4))
         self.engine = self.create_db_engine() if config else None
         self.index = None
-        self.vectors = []
-        self.track_ids = []
-        self.embedding_map = {}
+        self.index_params = {}
+        # Saved next to the index, describes what the ids returned by a search are
+        self.index_info = {"id_column": "vector_id"}
+        self.vectors = np.empty((0, self.dimension * self.dimensionality_calculation()), dtype='float32')
+        self.track_ids = np.empty((0,), dtype=np.int64)
         if load_vectors:
             self.load_vectors()
         if create_index:
             self.create_index()
 
-    def get_full_path(self, relative_path):
+    @staticmethod
+    def get_full_path(relative_path):
         """
         Convert a relative path to an absolute path based on the script's location.
         """
@@ -35,117 +59,473 @@ class VectorDatabase:
         return os.path.join(base_path, relative_path)
 
     def create_db_engine(self):
-        db_config = self.config['database']
-        return create_engine(f"mysql+mysqldb://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['database']}")
+        # Shared with the metadata lookups, so the process keeps a single connection pool
+        return get_engine(self.config['database'])
+
+    def enabled_modalities(self):
+        return [key for key in MODALITIES if self.combinator[key]]
 
+    @timed("load_vectors")
     def load_vectors(self):
-        if not os.path.exists(self.vector_files['genre_classification_embeddings']):
-            logger.error(f"Error: Folder {self.vector_files['genre_classification_embeddings']} not found.")
-            return
+        store_folder = self.config['paths'].get('embedding_store_folder')
+        if store_folder:
+            stores = open_embedding_stores(self.get_full_path(store_folder), self.enabled_modalities())
+            if len(stores) == len(self.enabled_modalities()):
+                self.load_vectors_from_store(stores)
+                return
+            logger.info(f"No embedding store found under {store_folder}, loading the per-track embedding files.")
+
+        modalities = self.enabled_modalities()
+        folders = {key: self.get_full_path(self.vector_files[f"{key}_classification_embeddings"]) for key in modalities}
+        for key, folder in folders.items():
+            if not os.path.isdir(folder):
+                logger.error(f"Error: Folder {folder} not found.")
+                return
         try:
-            # default to genre-classification embeddings in the index
-            map_of_embeddings = {
-                "genre": [],
-                "instrument": [],
-                "emotion": []
-            }
-            for key, _ in map_of_embeddings.items():
-                if self.combinator[key]:
-                    full_folder_path = self.get_full_path(self.vector_files[f"{key}_classification_embeddings"])
-                    file_contents = os.listdir(full_folder_path)
-                    for file_ in tqdm(file_contents):
-                        full_path = os.path.join(full_folder_path, file_)
-                        loaded_embedding = np.load(full_path).astype('float32')
-                        if loaded_embedding.shape[0] == self.dimension:
-                            #logger.debug(f"Embedding shape: {loaded_embedding.shape}")
-                            track_id = int(file_[:-4])
-
-                            if track_id not in self.embedding_map:
-                                self.embedding_map[track_id] = {}
-
-                            self.embedding_map[track_id][key] = loaded_embedding
-
-                            if track_id not in self.track_ids:
-                                self.track_ids.append(track_id)
-                            map_of_embeddings[key].append(loaded_embedding)
-            
-            # Concatenate embeddings by track_id
-            #final_embeddings = []
-            for track_id in self.track_ids:
-                embeddings_to_concat = [self.embedding_map[track_id][key] for key in map_of_embeddings if self.combinator[key] and key in self.embedding_map[track_id]]
-                #logger.debug(f"Embeddings to concat so far: {embeddings_to_concat}")
-                if embeddings_to_concat:
-                    # Ensure all embeddings to concatenate are arrays and concatenation is along axis 1
-                    concatenated_embedding = np.concatenate(embeddings_to_concat, axis=None)
-                    self.vectors.append(concatenated_embedding)
-                    
+            # track_id -> file name of every embedding, per enabled modality
+            files = {key: self.list_embedding_files(folder) for key, folder in folders.items()}
+
+            # Only tracks that have an embedding in every enabled modality can be concatenated
+            common_ids = set(files[modalities[0]])
+            for key in modalities[1:]:
+                common_ids.intersection_update(files[key])
+            track_ids = np.array(sorted(common_ids), dtype=np.int64)
+
+            # One preallocated matrix, every file is written straight into its row
+            vectors = np.empty((len(track_ids), self.dimension * len(modalities)), dtype='float32')
+            valid = np.ones(len(track_ids), dtype=bool)
+
+            def load_rows(rows):
+                for row in rows:
+                    track_id = track_ids[row]
+                    for position, key in enumerate(modalities):
+                        loaded_embedding = np.load(os.path.join(folders[key], files[key][track_id])).reshape(-1)
+                        if loaded_embedding.shape[0] != self.dimension:
+                            valid[row] = False
+                            break
+                        vectors[row, position * self.dimension:(position + 1) * self.dimension] = loaded_embedding
+                return len(rows)
+
+            chunks = [range(start, min(start + self.LOAD_CHUNK_SIZE, len(track_ids)))
+                      for start in range(0, len(track_ids), self.LOAD_CHUNK_SIZE)]
+            with ThreadPoolExecutor(max_workers=self.load_workers) as executor, tqdm(total=len(track_ids)) as progress:
+                for loaded in executor.map(load_rows, chunks):
+                    progress.update(loaded)
+
+            # Drop tracks with a wrongly sized embedding by compacting the matrix in place
+            kept = np.flatnonzero(valid)
+            if kept.size < len(track_ids):
+                logger.warning(f"Skipping {len(track_ids) - kept.size} tracks with embeddings not of dimension {self.dimension}")
+                for start in range(0, kept.size, self.LOAD_CHUNK_SIZE):
+                    kept_rows = kept[start:start + self.LOAD_CHUNK_SIZE]
+                    vectors[start:start + len(kept_rows)] = vectors[kept_rows]
+                vectors = vectors[:kept.size]
+                track_ids = track_ids[kept]
+
+            self.vectors = vectors
+            self.track_ids = track_ids
             logger.info(f"Embeddings successfully concatenated for multiple genres, number of vectors loaded: {len(self.vectors)}")
-            #return np.array(final_embeddings)
         except Exception as e:
             logger.error(f"An error occurred while loading vectors: {e}")
 
+    @staticmethod
+    def list_embedding_files(folder):
+        """ Map the track_id of every <track_id>.npy file in folder to its file name. """
+        files = {}
+        for file_ in os.listdir(folder):
+            if file_.endswith('.npy'):
+                try:
+                    files[int(file_[:-4])] = file_
+                except ValueError:
+                    logger.warning(f"Skipping {file_}, its name is not a track_id.")
+        return files
+
+    def load_vectors_from_store(self, stores):
+        """
+        Load the vectors of the enabled modalities from their memory-mapped EmbeddingStores.
+
+        Only tracks present in every enabled store are kept, their embeddings are decoded to
+        float32 and concatenated in MODALITIES order directly into one matrix.
+
+        Args:
+        stores (dict): modality -> EmbeddingStore, for every enabled modality.
+        """
+        modalities = self.enabled_modalities()
+        for key in modalities:
+            if stores[key].dimension != self.dimension:
+                logger.error(f"Error: {key} store has dimension {stores[key].dimension}, expected {self.dimension}.")
+                return
+
+        # Track ids in the order of the first store, restricted to the ones every store has
+        track_ids = np.asarray(stores[modalities[0]].track_ids)
+        rows = {key: stores[key].rows(track_ids) for key in modalities}
+        present = np.all([rows[key] >= 0 for key in modalities], axis=0)
+        track_ids = track_ids[present]
+
+        vectors = np.empty((len(track_ids), self.dimension * len(modalities)), dtype='float32')
+        for position, key in enumerate(modalities):
+            key_rows = rows[key][present]
+            columns = slice(position * self.dimension, (position + 1) * self.dimension)
+            aligned = np.array_equal(key_rows, np.arange(len(stores[key])))
+            # Chunk by chunk, float16 and 8-bit stores are decoded without a full size temporary
+            for start in range(0, len(track_ids), self.LOAD_CHUNK_SIZE * 64):
+                stop = min(start + self.LOAD_CHUNK_SIZE * 64, len(track_ids))
+                # Rows that already line up with the output are copied from the mapped matrix as is
+                vectors[start:stop, columns] = stores[key].read(slice(start, stop) if aligned else key_rows[start:stop])
+
+        self.vectors = vectors
+        self.track_ids = track_ids
+        logger.info(f"Embeddings loaded from the embedding store, number of vectors loaded: {len(self.vectors)}")
+
+    @timed("build_index")
     def create_index(self):
     # Calculate the effective dimension
         effective_dimension = self.dimension * self.dimensionality_calculation()
         
         # Normalize the vectors to unit length for cosine similarity
-        embeddings_for_index = np.array(self.vectors).astype('float32')
-
-        if self.index_type == 'FlatL2':
-            self.index = faiss.IndexFlatL2(effective_dimension)
-        elif self.index_type == 'IVFFlat':
-            quantizer = faiss.IndexFlatL2(effective_dimension)
-            self.index = faiss.IndexIVFFlat(quantizer, effective_dimension, 100, faiss.METRIC_L2)
-            self.index.train(embeddings_for_index)
-        elif self.index_type == 'Cosine':
-            # Use IndexFlatIP for cosine similarity, which uses normalized vectors
-            norm = np.linalg.norm(embeddings_for_index, axis=1, keepdims=True)
-            index = faiss.index_factory(effective_dimension, "Flat", faiss.METRIC_INNER_PRODUCT)
+        embeddings_for_index = np.ascontiguousarray(self.vectors, dtype='float32')
+        if self.index_type == "Cosine":
+            # Shards and projections are built from copies, normalize the vectors themselves like a single index does
             faiss.normalize_L2(embeddings_for_index)
-            #normalized_embeddings = embeddings_for_index / np.maximum(norm, 1e-6)
-            self.index = index
 
-        logger.info(f"Index type set to: {self.index_type}")
-        logger.info(f"Dimensions of the vectors: {effective_dimension}")
-        logger.info(f"Length of Vectors so far: {len(self.vectors)}")
+        projection, projection_info = None, None
+        index_dimension = effective_dimension
+        if self.projection_type:
+            projection, projection_info = train_projection(self.projection_type, embeddings_for_index,
+                                                           self.projection_dimension, self.index_parameters())
+            embeddings_for_index = apply_projection(projection, embeddings_for_index)
+            index_dimension = projection_info["dimension"]
 
-        # Add vectors to the index
-        self.index.add(embeddings_for_index)  # Add normalized vectors for cosine similarity
-        
+        # nlist, nprobe, M, efSearch... come from the "faiss" section, unset ones are chosen from the corpus size
+        if self.n_shards > 1:
+            self.index, self.index_params = self.create_sharded_index(index_dimension, embeddings_for_index, projection)
+        else:
+            index, self.index_params = build_index(self.index_type, index_dimension, embeddings_for_index,
+                                                   self.index_parameters(), ids=self.track_ids if self.id_map else None)
+            # The projection is part of the index, searched, updated and saved with it
+            self.index = projected_index(projection, index) if projection is not None else index
+        # dimension is the one of the vectors searched and added, before any projection
+        self.index_info = {"id_column": "track_id" if self.id_map else "vector_id", "index_type": self.index_type,
+                           "dimension": effective_dimension, "parameters": self.index_params,
+                           "shards": self.n_shards, "metric_type": int(self.index.metric_type)}
+        if projection_info:
+            self.index_info["projection"] = projection_info
+
+        logger.info(f"Index type set to: {self.index_type}")
+        logger.info(f"Dimensions of the vectors: {effective_dimension}"
+                    + (f", projected to {index_dimension} with {self.projection_type}" if projection_info else ""))
         logger.info(f"Index created and embeddings added. Total embeddings: {len(self.vectors)}")
 
+    def create_sharded_index(self, dimension, vectors, projection=None):
+        """
+        Build one index per shard, every track going to shard track_id % shards.
+
+        Every shard is trained on its own vectors only, and keeps the global ids of its vectors
+        (track_ids, or positions without "id_map"), so the merged results of the shards are
+        the ones a single index would return.
+
+        Args:
+        dimension (int): Dimension of the (projected) vectors.
+        vectors (numpy.array): The vectors to index, already projected if projection is given.
+        projection (faiss.VectorTransform): Projection put in front of every shard, see projected_index.
+
+        Returns:
+        ShardedIndex: The filled shards.
+        dict: The parameters of the first shard, the others are built from the same config.
+        """
+        ids = self.track_ids if self.id_map else np.arange(len(vectors), dtype=np.int64)
+        shards = shard_of(ids, self.n_shards)
+        built = []
+        for shard in range(self.n_shards):
+            rows = np.flatnonzero(shards == shard)
+            index, parameters = build_index(self.index_type, dimension, np.ascontiguousarray(vectors[rows]),
+                                            self.index_parameters(), ids=ids[rows])
+            built.append((projected_index(projection, index) if projection is not None else index, parameters))
+            logger.info(f"Shard {shard + 1}/{self.n_shards} built over {len(rows)} vectors.")
+        return ShardedIndex([index for index, _ in built]), built[0][1]
+
+    def storage_report(self, k=10, n_queries=1000, seed=0):
+        """
+        Memory footprint of the index and the embedding stores, and recall@k of the index against
+        exact float32 search over the loaded vectors, to compare the float16/int8 storage modes.
+
+        Args:
+        k (int): Number of neighbors the recall is measured at, 0 to skip the recall.
+        n_queries (int): Number of queries, sampled from the loaded vectors.
+        seed (int): Seed of the query sample.
+
+        Returns:
+        dict: Storage of the index, its size in bytes and per vector, the size of a float32 vector,
+        the stored bytes per track of the embedding stores, the resident memory of the process and recall@k.
+        """
+        effective_dimension = self.dimension * self.dimensionality_calculation()
+        index_bytes = index_memory_bytes(self.index)
+        report = {
+            "storage": self.index_params.get("storage", "float32"),
+            "index_bytes": index_bytes,
+            "bytes_per_vector": round(index_bytes / max(self.index.ntotal, 1), 1),
+            "float32_bytes_per_vector": effective_dimension * 4
+        }
+        if self.projection is not None:
+            report["projection_dimension"] = self.projection.d_out
+            report["explained_variance"] = self.index_info.get("projection", {}).get("explained_variance")
+        store_folder = self.config['paths'].get('embedding_store_folder')
+        stores = open_embedding_stores(self.get_full_path(store_folder), self.enabled_modalities()) if store_folder else {}
+        if len(stores) == len(self.enabled_modalities()):
+            report["store_bytes_per_vector"] = sum(store.bytes_per_vector for store in stores.values())
+
+        if k and len(self.vectors):
+            rng = np.random.default_rng(seed)
+            rows = np.sort(rng.choice(len(self.vectors), size=min(n_queries, len(self.vectors)), replace=False))
+            queries = np.ascontiguousarray(self.vectors[rows])
+            # Cosine indexes were built from the normalized vectors, the exact inner products are cosines too
+            ground_truth = exact_neighbors(queries, self.vectors, k, self.index.metric_type)
+            if self.id_map:
+                ground_truth = np.where(ground_truth >= 0, self.track_ids[ground_truth], -1)
+            # Against the unprojected vectors, the recall includes what the projection loses
+            _, indices = self.index.search(queries, k)
+            report[f"recall@{k}"] = round(recall_at_k(ground_truth, indices), 4)
+
+        report["rss_bytes"] = resident_memory_bytes()
+        return report
+
+    def index_parameters(self):
+        """ Index parameters of the "faiss" section of config.json, everything but dimension and index_type. """
+        return {key: value for key, value in self.config['faiss'].items()
+                if key not in ('dimension', 'index_type', 'id_map', 'shards', 'shard_workers', 'projection', 'projection_dimension')}
+
+    @property
+    def projection(self):
+        """ The PCA/OPQ projection in front of the index, None if it indexes the concatenated embeddings as they are. """
+        return index_projection(self.index)
+
+    @timed("insert_metadata")
     def insert_metadata(self):
         dimensions = self.dimension * self.dimensionality_calculation()
         data = {
-            'vector_id': range(len(self.vectors)),
+            # With an index keyed by track_id the id of a vector is its track_id
+            'vector_id': self.track_ids if self.id_map else range(len(self.vectors)),
             'track_id': self.track_ids,
             'vector_dimensions': [dimensions] * len(self.vectors),
             'faiss_index': [self.index_type] * len(self.vectors)
         }
         df = pd.DataFrame(data)
-        df.to_sql('vector_metadata', con=self.engine, if_exists='replace', index=False)
+        # Batched INSERTs in a single transaction, indexes are created once the rows are in
+        with self.engine.begin() as connection:
+            df.to_sql('vector_metadata', con=connection, if_exists='replace', index=False, chunksize=10000)
+        create_metadata_indexes(self.engine, ['vector_metadata'])
         logger.info("Metadata inserted into the database successfully.")
 
+    def load_track_vectors(self, track_ids):
+        """
+        Load the concatenated embeddings of some tracks, from the embedding stores when they
+        exist and from the per-track embedding files otherwise.
+
+        Returns:
+        numpy.array: The track_ids that have an embedding in every enabled modality.
+        numpy.array: Their (n, dimension * modalities) float32 vectors.
+        """
+        modalities = self.enabled_modalities()
+        track_ids = np.asarray(track_ids, dtype=np.int64).reshape(-1)
+        store_folder = self.config['paths'].get('embedding_store_folder')
+        stores = open_embedding_stores(self.get_full_path(store_folder), modalities) if store_folder else {}
+
+        if len(stores) == len(modalities):
+            rows = {key: stores[key].rows(track_ids) for key in modalities}
+            present = np.all([rows[key] >= 0 for key in modalities], axis=0)
+            vectors = np.hstack([stores[key].read(rows[key][present]) for key in modalities]).astype('float32', copy=False)
+            found = track_ids[present]
+        else:
+            folders = {key: self.get_full_path(self.vector_files[f"{key}_classification_embeddings"]) for key in modalities}
+            files = {key: self.list_embedding_files(folder) for key, folder in folders.items()}
+            found, rows = [], []
+            for track_id in track_ids:
+                if all(int(track_id) in files[key] for key in modalities):
+                    row = [np.load(os.path.join(folders[key], files[key][int(track_id)])).reshape(-1) for key in modalities]
+                    if all(len(embedding) == self.dimension for embedding in row):
+                        found.append(track_id)
+                        rows.append(np.concatenate(row))
+            found = np.asarray(found, dtype=np.int64)
+            vectors = np.vstack(rows).astype('float32') if rows else np.empty((0, self.dimension * len(modalities)), dtype='float32')
+
+        if len(found) < len(track_ids):
+            logger.warning(f"{len(track_ids) - len(found)} tracks have no embedding in every enabled modality and are skipped.")
+        return found, vectors
+
+    def _require_track_id_index(self):
+        if self.index is None:
+            self.load_index()
+        if self.index is None:
+            raise ValueError("No index to update, build one with create_vector_database.py first.")
+        if self.index_info.get("id_column") != "track_id":
+            raise ValueError("The index is keyed by vector position, rebuild it with \"id_map\": true to update it in place.")
+
+    @timed("add_tracks")
+    def add_tracks(self, track_ids, vectors=None):
+        """
+        Add tracks to the index, or replace their vectors if they are already in it, and
+        record them in vector_metadata. The index is then saved atomically.
+
+        Only the given tracks are read and written, the index is neither retrained nor rebuilt.
+        IVF indexes keep the coarse quantizer they were trained with, rebuild them once the
+        catalog has drifted a lot.
+
+        Args:
+        track_ids (list of int): Tracks to add.
+        vectors (numpy.array): Their concatenated embeddings, loaded with load_track_vectors if None.
+
+        Returns:
+        int: Number of tracks added.
+        """
+        self._require_track_id_index()
+        if vectors is None:
+            track_ids, vectors = self.load_track_vectors(track_ids)
+        track_ids = np.asarray(track_ids, dtype=np.int64).reshape(-1)
+        vectors = np.ascontiguousarray(vectors, dtype='float32').reshape(len(track_ids), -1)
+        if not len(track_ids):
+            return 0
+
+        # A projected index projects (and re-normalizes) the vectors itself
+        if self.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            faiss.normalize_L2(vectors)
+
+        # Adding a track twice replaces its vector
+        existing = track_ids[np.isin(track_ids, index_ids(self.index))]
+        if len(existing):
+            if not supports_removal(self.index):
+                raise ValueError(f"Tracks {existing.tolist()} are already indexed and HNSW indexes cannot replace vectors.")
+            self.index.remove_ids(faiss.IDSelectorBatch(existing))
+        self.index.add_with_ids(vectors, track_ids)
+
+        self.update_metadata(removed_track_ids=track_ids, added_track_ids=track_ids)
+        self.save_index()
+        logger.info(f"Added {len(track_ids)} tracks ({len(existing)} replaced), the index now holds {self.index.ntotal} vectors.")
+        return len(track_ids)
+
+    @timed("remove_tracks")
+    def remove_tracks(self, track_ids):
+        """
+        Remove tracks from the index and from vector_metadata, then save the index atomically.
+
+        Returns:
+        int: Number of vectors removed from the index.
+        """
+        self._require_track_id_index()
+        if not supports_removal(self.index):
+            raise ValueError("HNSW indexes do not support removing vectors, rebuild the index without these tracks.")
+        track_ids = np.asarray(track_ids, dtype=np.int64).reshape(-1)
+        removed = int(self.index.remove_ids(faiss.IDSelectorBatch(track_ids)))
+
+        self.update_metadata(removed_track_ids=track_ids)
+        self.save_index()
+        logger.info(f"Removed {removed} tracks, the index now holds {self.index.ntotal} vectors.")
+        return removed
+
+    def update_metadata(self, removed_track_ids=(), added_track_ids=()):
+        """ Delete and insert the vector_metadata rows of some tracks in one transaction, leaving the other rows untouched. """
+        removed_track_ids = [int(track_id) for track_id in removed_track_ids]
+        added_track_ids = [int(track_id) for track_id in added_track_ids]
+        table_exists = inspect(self.engine).has_table('vector_metadata')
+        with self.engine.begin() as connection:
+            if table_exists and removed_track_ids:
+                statement = text("DELETE FROM vector_metadata WHERE track_id IN :track_ids").bindparams(
+                    bindparam("track_ids", expanding=True))
+                connection.execute(statement, {"track_ids": removed_track_ids})
+            if added_track_ids:
+                df = pd.DataFrame({
+                    'vector_id': added_track_ids,
+                    'track_id': added_track_ids,
+                    'vector_dimensions': [self.index.d] * len(added_track_ids),
+                    'faiss_index': [self.index_info.get('index_type', self.index_type)] * len(added_track_ids)
+                })
+                df.to_sql('vector_metadata', con=connection, if_exists='append', index=False, chunksize=10000)
+        if not table_exists:
+            create_metadata_indexes(self.engine, ['vector_metadata'])
+
+    @staticmethod
+    def index_info_path(index_path):
+        return f"{index_path}.json"
+
+    @timed("save_index")
     def save_index(self):
+        """
+        Write the index and its description atomically: both are written to temporary files
+        that replace the previous ones, so readers never see a partially written index.
+
+        A sharded index is written as one <index_path>.shard<i> file per shard. The description
+        is written last in both cases, so readers only switch once the new index is in place.
+        A projection is part of the index (see projection.projected_index), so every file holds the
+        projection its vectors were made with.
+        """
         index_path = self.get_full_path(self.config['paths']['index_path'])
-        faiss.write_index(self.index, index_path)
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        info_path = self.index_info_path(index_path)
+        self.index_info["ntotal"] = int(self.index.ntotal)
+        def write_info():
+            with open(f"{info_path}.tmp", "w") as file:
+                json.dump(self.index_info, file, indent=4)
+            os.replace(f"{info_path}.tmp", info_path)
+
+        if isinstance(self.index, ShardedIndex):
+            for shard, index in enumerate(self.index.shards):
+                path = shard_path(index_path, shard)
+                faiss.write_index(index, f"{path}.tmp")
+                os.replace(f"{path}.tmp", path)
+            write_info()
+            logger.info(f"Index saved to {len(self.index.shards)} shards {shard_path(index_path, '*')}")
+            return
+
+        # Like the shards, the description is written last
+        faiss.write_index(self.index, f"{index_path}.tmp")
+        os.replace(f"{index_path}.tmp", index_path)
+        write_info()
         logger.info(f"Index saved to {index_path}")
 
-    def load_index(self):
+    def load_index(self, use_workers=False):
+        """
+        Load the index saved at the configured index_path.
+
+        Args:
+        use_workers (bool): Search a sharded index from "shard_workers" worker processes
+            (ShardSearchCoordinator) instead of in this process. The coordinator only searches,
+            add_tracks/remove_tracks need the in-process shards.
+        """
         index_path = self.get_full_path(self.config['paths']['index_path'])
-        if not os.path.exists(index_path):
-            logger.error(f"Error: Index file {index_path} not found.")
-            return
+        info_path = self.index_info_path(index_path)
         try:
-            self.index = faiss.read_index(index_path)
-            logger.info(f"Index: {index_path} successfully loaded.")
+            # Indexes saved without a description are the positional ones of earlier versions
+            index_info = {"id_column": "vector_id"}
+            if os.path.exists(info_path):
+                with open(info_path) as file:
+                    index_info = json.load(file)
+            n_shards = index_info.get("shards", 1)
+            paths = [shard_path(index_path, shard) for shard in range(n_shards)] if n_shards > 1 else [index_path]
+            missing = [path for path in paths if not os.path.exists(path)]
+            if missing:
+                logger.error(f"Error: Index file {missing[0]} not found.")
+                return
+
+            previous = self.index
+            if n_shards == 1:
+                index = faiss.read_index(index_path)
+            elif use_workers and self.shard_workers > 0:
+                index = ShardSearchCoordinator(paths, workers=self.shard_workers, search_params=self.index_parameters(),
+                                               metric_type=index_info.get("metric_type", faiss.METRIC_L2),
+                                               dimension=index_info.get("dimension"), ntotal=index_info.get("ntotal"))
+            else:
+                index = ShardedIndex([faiss.read_index(path) for path in paths])
+            # nprobe/efSearch set in config.json take precedence over the ones saved with the index
+            if not isinstance(index, ShardSearchCoordinator):
+                set_search_parameters(index, self.index_parameters())
+            self.index = index
+            self.index_info = index_info
+            # Stop the worker processes of the index being replaced once its searches in flight are done
+            if isinstance(previous, ShardSearchCoordinator):
+                previous.close_when_idle()
+            logger.info(f"Index: {index_path} successfully loaded ({n_shards} shard(s)).")
         except Exception as e:
             logger.error(f"An error occurred while loading the index: {e}")
     
     def dimensionality_calculation(self):
-        if self.combinator['genre'] and self.combinator['instrument'] and self.combinator['emotion']:
-            return 3
-        elif self.combinator['genre'] and self.combinator['instrument'] and not self.combinator['emotion']:
-            return 2
-        elif self.combinator['genre'] and not self.combinator['instrument'] and not self.combinator['emotion']:
-            return 1
+        """ Number of modalities concatenated into every vector. """
+        return len(self.enabled_modalities())
@@ -1,5 +1,5 @@
 # __init__.py
-from .utils import find_search_query_from_saved_embeddings
+from .utils import find_saved_embedding, find_search_query_from_saved_embeddings
 from .audio_utils import process_file, process_file_custom  # Example from audio_utils.py
 
-__all__ = ['find_search_query_from_saved_embeddings', 'process_file', 'process_file_custom']  # Ensure your method is included here
+__all__ = ['find_saved_embedding', 'find_search_query_from_saved_embeddings', 'process_file', 'process_file_custom']  # Ensure your method is included here
@@ -1,116 +1,322 @@
+import io
 import os
-from pydub import AudioSegment
+import librosa
 import numpy as np
-from deep_audio_features.bin import basic_test as btest
-from deep_audio_features.dataloading.dataloading import FeatureExtractorDataset
-from deep_audio_features.models.cnn import load_cnn
+import torch
+from PIL import Image
+from deep_audio_features.utils import sound_processing
 from deep_audio_features.utils.model_editing import drop_layers
-from deep_audio_features.lib.training import test
-from torch.utils.data import DataLoader
+from similarity_engine.instrumentation import count, span
+from utils.feature_cache import feature_cache_key, get_feature_cache, hash_audio
+from utils.model_registry import LAYERS_DROPPED, get_model_registry
 
-def process_file(file_path: str, model_path: str):
-    # Get the base path for the script's directory
-    script_directory = os.path.dirname(os.path.abspath(__file__))
+SEGMENT_DURATION = 10  # Duration for each segment in seconds
 
-    # Correctly build the absolute path to the model
-    # Assuming your script is inside a subdirectory of the root project folder
-    root_directory = os.path.dirname(script_directory)
-    
-      # Move one directory level up to the project root
-    absolute_model_path = os.path.join(root_directory, model_path)
+# Project root, relative audio and model paths are resolved against it
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-    # Ensure to construct the absolute path for the audio file similarly
-    absolute_file_path = os.path.join(root_directory, file_path)
 
-    # Load audio from the absolute file path
-    audio = AudioSegment.from_wav(absolute_file_path)
-    duration = 10000  # Duration for each segment in milliseconds
-    segments = [audio[:duration], audio[duration:duration*2], audio[duration*2:]]
-    embeddings = []
+def read_audio_bytes(audio):
+    """
+    Return the raw bytes of an audio file.
 
-    # Temporary directory for storing intermediate files, relative to the root directory
-    temp_dir = os.path.join(root_directory, 'temp_embs/')
-    os.makedirs(temp_dir, exist_ok=True)
+    Args:
+    audio (str | bytes | file-like): Path of the file relative to the project root, its bytes or a binary file-like object.
+    """
+    if isinstance(audio, (bytes, bytearray, memoryview)):
+        return bytes(audio)
+    if isinstance(audio, (str, os.PathLike)):
+        with open(os.path.join(ROOT_DIRECTORY, audio), "rb") as file:
+            return file.read()
+    return audio.read()
 
-    for i, segment in enumerate(segments):
-        temp_path = os.path.join(temp_dir, f"temp_emb_{i}.wav")
-        segment.export(temp_path, format="wav")
 
-        # Generate embedding using the model
-        _, embedding = btest.test_model(absolute_model_path, temp_path, layers_dropped=1, test_segmentation=False)
-        embeddings.append(embedding.reshape(-1))
+def load_audio(audio):
+    """
+    Decode a WAV once into a mono float32 signal.
 
-        # Remove the temporary file
-        os.remove(temp_path)
+    The signal is identical to the one deep_audio_features reads from a WAV file with
+    librosa.load(sr=None), so the features match the ones of the training pipeline.
 
-    concat_emb = np.concatenate(embeddings, axis=None)
-    return concat_emb
+    Args:
+    audio (str | bytes | file-like): Path of the WAV file relative to the project root,
+        the raw bytes of a WAV file (e.g. an upload) or a binary file-like object.
 
-def process_file_custom(file_path, models):
-    
-    # Get the base path for the script's directory
-    script_directory = os.path.dirname(os.path.abspath(__file__))
+    Returns:
+    numpy.array: The mono signal.
+    int: The sampling rate of the signal.
+    """
+    if isinstance(audio, (bytes, bytearray, memoryview)):
+        audio = io.BytesIO(audio)
+    elif isinstance(audio, (str, os.PathLike)):
+        audio = os.path.join(ROOT_DIRECTORY, audio)
+    signal, fs = librosa.load(audio, sr=None)
+    return signal, fs
 
-    # Correctly build the absolute path to the model
-    # Assuming your script is inside a subdirectory of the root project folder
-    root_directory = os.path.dirname(script_directory)
 
-    # Ensure to construct the absolute path for the audio file similarly
-    absolute_file_path = os.path.join(root_directory, file_path)
+def segment_signal(signal, fs, duration=SEGMENT_DURATION):
+    """
+    Split a signal into the first two segments of duration seconds and the remainder.
 
-    # Load audio from the absolute file path
-    audio = AudioSegment.from_wav(absolute_file_path)
-    duration = 10000  # Duration for each segment in milliseconds
-    segments = [audio[:duration], audio[duration:duration*2], audio[duration*2:]]
+    The segments are views into signal, no samples are copied.
 
-    # Temporary directory for storing intermediate files, relative to the root directory
-    temp_dir = os.path.join(root_directory, 'temp_embs/')
-    os.makedirs(temp_dir, exist_ok=True)
+    Returns:
+    list of numpy.array: The three segments.
+    """
+    segment_length = int(duration * fs)
+    return [signal[:segment_length], signal[segment_length:segment_length * 2], signal[segment_length * 2:]]
 
 
+def fit_spectrogram(feature, properties: dict):
+    """
+    Zero pad or resize a (time, n_mel) spectrogram to the input size the model was trained with,
+    the same way FeatureExtractorDataset does.
+    """
+    if properties["zero_pad"]:
+        max_length = properties["max_seq_length"]
+        if feature.shape[0] < max_length:
+            padding = np.zeros((max_length - feature.shape[0], feature.shape[1]), dtype=feature.dtype)
+            feature = np.concatenate((feature, padding), axis=0)
+        else:
+            # Instead of raising an error just truncate the file
+            feature = feature[:max_length]
+    else:
+        spec_size = properties["spec_size"]
+        if spec_size is None:
+            spec_size = (140 if properties["fuse"] else 128, feature.shape[0])
+        # Note: Image.resize takes as input a (width, height) tuple
+        feature = np.array(Image.fromarray(feature).resize(tuple(spec_size)))
+    return feature.astype(np.float32, copy=False)
+
+
+def compute_spectrogram(signal, fs, properties: dict):
+    """ Raw (time, n_mel) MEL_SPECTROGRAM of a signal with the parameters of a model. """
+    return sound_processing.get_melspectrogram(signal, fs=fs,
+                                               n_fft=int(properties["window_length"] * fs),
+                                               hop_length=int(properties["hop_length"] * fs),
+                                               fuse=properties["fuse"])
+
+
+def extract_features(signal, fs, properties: dict):
+    """
+    Compute the MEL_SPECTROGRAM features of a signal for a model.
+
+    Args:
+    signal (numpy.array): Mono audio signal.
+    fs (int): Sampling rate of the signal.
+    properties (dict): Model properties as returned by the ModelRegistry.
+
+    Returns:
+    numpy.array: The spectrogram, fitted to the input size of the model.
+    """
+    return fit_spectrogram(compute_spectrogram(signal, fs, properties), properties)
+
+
+def forward_features(features, properties: dict):
+    """
+    Forward a batch of spectrograms through an already truncated feature extraction model.
+
+    Args:
+    features (numpy.array | list of numpy.array): Spectrograms fitted to the input size of the model.
+    properties (dict): Model properties as returned by the ModelRegistry.
+
+    Returns:
+    numpy.array: (len(features), embedding_dimension) embeddings.
+    """
+    model = properties["model"]
+    device = next(model.parameters()).device
+    # Add a new axis for CNN filter features, [z-axis]
+    inputs = torch.from_numpy(np.stack(features)).to(device)[:, np.newaxis, :, :]
+    with torch.inference_mode():
+        outputs = model(inputs)
+    return outputs.cpu().numpy().reshape(len(features), -1)
+
+
+def ensure_feature_extractor(properties: dict):
+    """
+    Drop the classification layer of a model exactly once.
+
+    Models coming from the ModelRegistry are already truncated. Models loaded by hand are
+    truncated here and marked as such, so calling this again on every segment does not
+    keep removing layers.
+    """
+    if properties.get("layers_dropped", 0) == 0:
+        properties["model"] = drop_layers(properties["model"], LAYERS_DROPPED) # Drop the last layer, we are extracting features here.
+        properties["model"].eval()
+        properties["layers_dropped"] = LAYERS_DROPPED
+    return properties
+
+
+def spectrogram_parameters(properties: dict):
+    """ Parameters the raw mel spectrogram of a model depends on. """
+    return (properties["hop_length"], properties["window_length"], properties["fuse"])
+
+
+def input_parameters(properties: dict):
+    """ Parameters the fitted model input depends on, on top of the raw spectrogram. """
+    spec_size = properties["spec_size"]
+    return spectrogram_parameters(properties) + (properties["zero_pad"], properties["max_seq_length"],
+                                                 tuple(spec_size) if spec_size is not None else None)
+
+
+def compute_model_inputs(models: dict, load_signal, audio_hash=None, feature_cache=None):
+    """
+    Compute the input batch of every model, one row per segment of the signal.
+
+    The mel spectrogram of a segment is computed once and reused by every model with the
+    same hop_length/window_length/fuse, and the fitted input batch is reused by every model
+    that also shares zero_pad/max_seq_length/spec_size. When audio_hash and feature_cache
+    are given, input batches are looked up in the cache first and the audio is only
+    decoded if at least one of them is missing.
+
+    Args:
+    models (dict): {name: {"properties": properties}}, e.g. as returned by ModelRegistry.load_models.
+    load_signal (callable): Returns the (signal, fs) of the audio, called at most once.
+    audio_hash (str): Content hash of the audio, see utils.feature_cache.hash_audio.
+    feature_cache (FeatureCache): Cache of input batches keyed by audio content and extraction parameters.
+
+    Returns:
+    dict: input_parameters(properties) -> (n_segments, height, width) input batch.
+    """
+    spectrograms = {}
+    inputs = {}
+    decoded = []
+
+    for _, model_ in models.items():
+        properties = ensure_feature_extractor(model_["properties"])
+
+        input_key = input_parameters(properties)
+        if input_key in inputs:
+            continue
+
+        cache_key = None
+        if audio_hash is not None and feature_cache is not None:
+            cache_key = feature_cache_key(audio_hash, ("MEL_SPECTROGRAM", SEGMENT_DURATION) + input_key)
+            cached = feature_cache.get(cache_key)
+            count("songs_cache_hits_total" if cached is not None else "songs_cache_misses_total", cache="features")
+            if cached is not None:
+                inputs[input_key] = cached
+                continue
+
+        if not decoded:
+            with span("decode"):
+                decoded.append(load_signal())
+        signal, fs = decoded[0]
+
+        with span("spectrogram"):
+            spectrogram_key = spectrogram_parameters(properties)
+            if spectrogram_key not in spectrograms:
+                spectrograms[spectrogram_key] = [compute_spectrogram(segment, fs, properties) for segment in segment_signal(signal, fs)]
+            inputs[input_key] = np.stack([fit_spectrogram(spectrogram, properties)
+                                          for spectrogram in spectrograms[spectrogram_key]])
+
+        if cache_key is not None:
+            feature_cache.put(cache_key, inputs[input_key])
+
+    return inputs
+
+
+def embed_model_inputs(models: dict, inputs: dict):
+    """
+    Forward the input batch of every model, one forward pass per model.
+
+    Returns:
+    numpy.array: The segment embeddings of every model, concatenated model by model.
+    """
     embeddings_from_inference = []
-    for i, segment in enumerate(segments):
-        temp_path = os.path.join(temp_dir, f"temp_emb_{i}.wav")
-        segment.export(temp_path, format="wav")
-        
-        for _ , model_ in models.items():
-
-            model = model_["properties"]["model"]
-            model = drop_layers(model, 1) # Drop the last layer, we are extracting features here.
-            
-            # Create test set
-            test_set = FeatureExtractorDataset(X=[temp_path],
-                                            y=[0],
-                                            fe_method="MEL_SPECTROGRAM",
-                                            oversampling=False,
-                                            max_sequence_length=model_["properties"]["max_seq_length"],
-                                            zero_pad=model_["properties"]["zero_pad"],
-                                            forced_size=model_["properties"]["spec_size"],
-                                            fuse=model_["properties"]["fuse"], show_hist=False,
-                                            test_segmentation=False,
-                                            hop_length=model_["properties"]["hop_length"], window_length=model_["properties"]["window_length"],)
-            
-            # Create test dataloader
-            test_loader = DataLoader(dataset=test_set, batch_size=1,
-                                    num_workers=4, drop_last=False,
-                                    shuffle=False)
-            
-            # Forward a sample
-            posteriors, _, _ = test(model=model, dataloader=test_loader,
-                                        cnn=True, task="classification",
-                                        classifier=True if False # Temp workaround to not perform classification.
-                                        else False)
-            
-            
-            posteriors = np.array(posteriors)
-
-            embeddings_from_inference.append(posteriors.reshape(-1))
-
-            # Remove the temporary file
-        
-        os.remove(temp_path)
-            
-
-    concatenated_inference_embedding = np.concatenate(embeddings_from_inference, axis=None)
-    
+    for name, model_ in models.items():
+        properties = ensure_feature_extractor(model_["properties"])
+        with span(f"cnn_forward_{name}"):
+            embeddings_from_inference.append(forward_features(inputs[input_parameters(properties)], properties).reshape(-1))
+
+    return np.concatenate(embeddings_from_inference, axis=None)
+
+
+def embed_signal_with_models(signal, fs, models: dict):
+    """
+    Embed every segment of a signal with several models.
+
+    The segments of the signal are stacked into one batch per model, so each model runs a
+    single forward pass per query.
+
+    Args:
+    signal (numpy.array): Mono audio signal.
+    fs (int): Sampling rate of the signal.
+    models (dict): {name: {"properties": properties}}, e.g. as returned by ModelRegistry.load_models.
+
+    Returns:
+    numpy.array: The segment embeddings of every model, concatenated model by model.
+    """
+    return embed_model_inputs(models, compute_model_inputs(models, lambda: (signal, fs)))
+
+
+def embed_audio_with_models(audio, models: dict, feature_cache=None, batcher=None):
+    """
+    Embed an audio file with several models, reusing cached features of identical audio.
+
+    Args:
+    audio (str | bytes | file-like): WAV file path relative to the project root, the bytes of a WAV file or a binary file-like object.
+    models (dict): {name: {"properties": properties}}, e.g. as returned by ModelRegistry.load_models.
+    feature_cache (FeatureCache): Feature cache to use, the shared one of the process if None.
+    batcher (utils.batching.BatchingScheduler): Batches the forward passes with the ones of concurrent
+        requests, each request runs its own forward passes if None.
+
+    Returns:
+    numpy.array: The segment embeddings of every model, concatenated model by model.
+    """
+    with span("embedding", histogram="songs_embedding_latency_seconds"):
+        audio_bytes = read_audio_bytes(audio)
+        if feature_cache is None:
+            feature_cache = get_feature_cache()
+        inputs = compute_model_inputs(models, lambda: load_audio(audio_bytes), hash_audio(audio_bytes), feature_cache)
+        if batcher is not None:
+            return batcher.embed_model_inputs(models, inputs)
+        return embed_model_inputs(models, inputs)
+
+
+def embed_signal(signal, fs, properties: dict):
+    """
+    Embed every segment of a signal with one model and concatenate the segment embeddings.
+
+    Returns:
+    numpy.array: The flattened embedding of the signal.
+    """
+    return embed_signal_with_models(signal, fs, {"model": {"properties": properties}})
+
+
+def process_file(file_path, model_path: str, feature_cache=None):
+    """
+    Embed an audio file with the model stored at model_path.
+
+    Args:
+    file_path (str | bytes): WAV file path relative to the project root or the bytes of a WAV file.
+    model_path (str): Model path relative to the project root.
+    feature_cache (FeatureCache): Feature cache to use, the shared one of the process if None.
+
+    Returns:
+    numpy.array: The concatenated embedding of the three segments of the audio.
+    """
+    # The model is deserialized and truncated once per process, not once per segment
+    properties = get_model_registry().get(os.path.join(ROOT_DIRECTORY, model_path))
+
+    return embed_audio_with_models(file_path, {"model": {"properties": properties}}, feature_cache)
+
+def process_file_custom(file_path, models, feature_cache=None, batcher=None):
+    """
+    Embed an audio file with several already loaded models.
+
+    The audio is decoded at most once and shared between all models, and not at all
+    when the features of every model are already in the feature cache.
+
+    Args:
+    file_path (str | bytes): WAV file path relative to the project root or the bytes of a WAV file.
+    models (dict): {name: {"properties": properties}}, e.g. as returned by ModelRegistry.load_models.
+    feature_cache (FeatureCache): Feature cache to use, the shared one of the process if None.
+    batcher (utils.batching.BatchingScheduler): Micro-batches the forward passes of concurrent requests if given.
+
+    Returns:
+    numpy.array: The embeddings of every model, concatenated in the order of models.
+    """
+    concatenated_inference_embedding = embed_audio_with_models(file_path, models, feature_cache, batcher)
+
     return concatenated_inference_embedding
@@ -0,0 +1,163 @@
+import time
+import queue
+import threading
+import logging
+from concurrent.futures import Future
+import numpy as np
+from similarity_engine.instrumentation import count, span
+from utils.audio_utils import ensure_feature_extractor, forward_features, input_parameters
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Defaults of the scheduler, at most 64 segments per forward pass and 5 ms of added latency
+MAX_BATCH_SIZE = 64
+MAX_DELAY_SECONDS = 0.005
+
+
+class MicroBatcher:
+    """
+    Batches the forward passes of one model across concurrent requests.
+
+    Requests submit their (n_segments, height, width) input batch and get a Future. A worker
+    thread waits for the first pending request, then keeps collecting requests until
+    max_batch_size segments are pending or max_delay seconds have passed, runs a single
+    forward pass over all of them and hands every request its own rows of the output.
+    """
+
+    def __init__(self, properties, name="model", max_batch_size=MAX_BATCH_SIZE, max_delay=MAX_DELAY_SECONDS):
+        self.properties = ensure_feature_extractor(properties)
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._closed = False
+        # Orders submit against close, nothing is queued after the stop sentinel
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name=f"batcher-{name}", daemon=True)
+        self._worker.start()
+
+    def submit(self, features):
+        """ Queue an input batch, the Future resolves to its (len(features), embedding_dimension) embeddings. """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"The batcher of {self.name} is closed.")
+            self._queue.put((np.asarray(features), future))
+        return future
+
+    def _collect(self):
+        """ Block for the first request, then gather more until the batch is full or the delay is over. """
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        size = len(first[0])
+        deadline = time.perf_counter() + self.max_delay
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Serve what was collected, then stop
+                self._queue.put(None)
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+            # Requests of different input shapes (e.g. zero padded spectrograms) cannot share a pass
+            by_shape = {}
+            for features, future in batch:
+                by_shape.setdefault(features.shape[1:], []).append((features, future))
+            for group in by_shape.values():
+                self._forward(group)
+
+    def _forward(self, group):
+        try:
+            outputs = forward_features(np.concatenate([features for features, _ in group]), self.properties)
+        except Exception as e:
+            for _, future in group:
+                future.set_exception(e)
+            return
+        count("songs_batches_total", model=self.name)
+        count("songs_batched_segments_total", len(outputs), model=self.name)
+        start = 0
+        for features, future in group:
+            future.set_result(outputs[start:start + len(features)])
+            start += len(features)
+
+    def close(self):
+        """ Serve the requests already submitted, stop the worker and fail anything it left queued. """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._worker.join()
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None and not item[1].done():
+                item[1].set_exception(RuntimeError(f"The batcher of {self.name} was closed before serving the request."))
+
+
+class BatchingScheduler:
+    """
+    One MicroBatcher per model, in front of the feature extractors.
+
+    embed_model_inputs submits the input batch of every model before waiting for any of them,
+    so the models of one request are forwarded concurrently and every model batches the
+    segments of all concurrent requests.
+    """
+
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_delay=MAX_DELAY_SECONDS):
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._batchers = {}
+        self._lock = threading.Lock()
+
+    def batcher(self, name, properties):
+        # Keyed by the model object, the same model under two names shares its batches
+        key = id(properties["model"])
+        with self._lock:
+            batcher = self._batchers.get(key)
+            if batcher is None:
+                batcher = self._batchers[key] = MicroBatcher(properties, name, self.max_batch_size, self.max_delay)
+        return batcher
+
+    def embed_model_inputs(self, models: dict, inputs: dict):
+        """
+        Batched equivalent of utils.audio_utils.embed_model_inputs.
+
+        Returns:
+        numpy.array: The segment embeddings of every model, concatenated model by model.
+        """
+        futures = []
+        for name, model_ in models.items():
+            properties = model_["properties"]
+            futures.append((name, self.batcher(name, properties).submit(inputs[input_parameters(properties)])))
+
+        embeddings_from_inference = []
+        for name, future in futures:
+            # Includes the time spent waiting for the batch to fill
+            with span(f"cnn_forward_{name}"):
+                embeddings_from_inference.append(future.result().reshape(-1))
+        return np.concatenate(embeddings_from_inference, axis=None)
+
+    def close(self):
+        with self._lock:
+            batchers = list(self._batchers.values())
+            self._batchers.clear()
+        for batcher in batchers:
+            batcher.close()
@@ -1,31 +1,32 @@
-import numpy as np
 import os
+import sys
+import argparse
 
+# Make the project root importable when the script is run from within this folder
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
 
-embeddings_folder = "./embeddings/genre-classification/genre-classification/"
+from utils.utils import concatenate_segmented_embeddings
 
-embeddings_subfolders = os.listdir(embeddings_folder)
+# Folders of the segment embeddings written by deep_audio_features, one per downstream task
+MODALITY_FOLDERS = ["genre-classification", "instrument-classification", "emotion-classification"]
 
-#print(embeddings_folder)
 
-destination_folder = "./concatenated_embeddings/genre-classification/"
+def main():
+    parser = argparse.ArgumentParser(description="Concatenate the segment embeddings of every track, for every modality in one pass")
+    parser.add_argument("--embeddings-folder", type=str, default="./embeddings/",
+                        help="Folder holding <modality>/<modality>/<track>/ segment embeddings")
+    parser.add_argument("--destination-folder", type=str, default="./concatenated_embeddings/",
+                        help="Folder the <modality>/<track>.npy embeddings are written to")
+    parser.add_argument("--modalities", nargs="+", default=MODALITY_FOLDERS, help="Modality folders to process")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker threads")
+    parser.add_argument("--force", action="store_true", help="Rewrite the tracks that are already up to date")
+    args = parser.parse_args()
 
-for subfolder in embeddings_subfolders:
-    embeddings_files = os.listdir(embeddings_folder + subfolder)
+    concatenate_segmented_embeddings([os.path.join(args.embeddings_folder, modality, modality) for modality in args.modalities],
+                                     [os.path.join(args.destination_folder, modality) for modality in args.modalities],
+                                     workers=args.workers, force=args.force)
 
-    current_folder = embeddings_folder + subfolder + "/"
-
-    file_name = subfolder
-
-    list_ofembeddings = []
-    for file_ in embeddings_files:
-        embedding = np.load(current_folder + file_).astype('float32')
-        list_ofembeddings.append(embedding)
-    concatenated_embedding = np.concatenate(list_ofembeddings, axis=None)
-    #print(concatenated_embedding, concatenated_embedding.shape)
-    save_file_name = destination_folder + file_name + ".npy"
-    np.save(save_file_name, concatenated_embedding)
-    
-
-#self.vectors = np.load(self.vector_file).astype('float32')
 
+if __name__ == "__main__":
+    main()
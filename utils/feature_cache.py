@@ -0,0 +1,146 @@
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Project root, the default cache lives in it
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FEATURE_CACHE_DIR = os.path.join(ROOT_DIRECTORY, "feature_cache")
+FEATURE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+
+def hash_audio(audio_bytes):
+    """ Content hash of the raw bytes of an audio file. """
+    return hashlib.sha256(audio_bytes).hexdigest()
+
+
+def feature_cache_key(audio_hash, parameters):
+    """
+    Key of the features of an audio file extracted with the given parameters.
+
+    Args:
+    audio_hash (str): Content hash of the audio, see hash_audio.
+    parameters (tuple): Every parameter the features depend on.
+
+    Returns:
+    str: Hex digest identifying the features.
+    """
+    return hashlib.sha256(f"{audio_hash}:{parameters!r}".encode("utf-8")).hexdigest()
+
+
+class FeatureCache:
+    """
+    Disk-backed, content-addressed cache of extracted features.
+
+    Every entry is one .npy file named after its key. The total size of the cache is kept
+    under max_bytes by evicting the least recently used entries; recency survives restarts
+    because a hit also touches the modification time of the file.
+    """
+
+    def __init__(self, cache_dir=FEATURE_CACHE_DIR, max_bytes=FEATURE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._scan()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def _scan(self):
+        """ Rebuild the LRU order of the entries already on disk, oldest first. """
+        if not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".npy"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    def get(self, key):
+        """ Return the cached array for key, or None on a miss. """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+
+        path = self._path(key)
+        try:
+            features = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            # Evicted by another process or partially written, treat as a miss
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return features
+
+    def put(self, key, features):
+        """ Store features under key and evict the least recently used entries above the size cap. """
+        if self.max_bytes <= 0:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            np.save(file, features)
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = size
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted_key, _ = next(iter(self._entries.items()))
+                self._forget(evicted_key)
+                try:
+                    os.remove(self._path(evicted_key))
+                except OSError:
+                    pass
+
+    def _forget(self, key):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    @property
+    def size_bytes(self):
+        return self._total_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_FEATURE_CACHE = None
+_FEATURE_CACHE_LOCK = threading.Lock()
+
+
+def get_feature_cache():
+    """ Return the FeatureCache shared by the whole process. """
+    global _FEATURE_CACHE
+    with _FEATURE_CACHE_LOCK:
+        if _FEATURE_CACHE is None:
+            _FEATURE_CACHE = FeatureCache()
+    return _FEATURE_CACHE
@@ -0,0 +1,112 @@
+import os
+import hashlib
+import threading
+import logging
+import torch
+from deep_audio_features.models.cnn import load_cnn
+from deep_audio_features.utils.model_editing import drop_layers
+from similarity_engine.instrumentation import count, timed
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Number of final layers cut from the classifiers, we are extracting features
+LAYERS_DROPPED = 1
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of the feature extraction CNNs.
+
+    Every model is deserialized with load_cnn once, truncated with drop_layers once,
+    moved to the device and put in eval mode. Callers get the properties dict used by
+    process_file_custom, so the same resident model is shared by every request.
+    """
+
+    def __init__(self, device=None):
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_path, layers_dropped=LAYERS_DROPPED):
+        """
+        Return the properties of the model stored at model_path, loading it on first use.
+
+        Args:
+        model_path (str): Path of the .pt model saved by deep_audio_features.
+        layers_dropped (int): Number of final layers to drop from the classifier.
+
+        Returns:
+        dict: model, hop_length, window_length, max_seq_length, zero_pad, spec_size, fuse, layers_dropped
+        and version, the content hash of the model file.
+        """
+        key = (os.path.abspath(model_path), layers_dropped)
+        properties = self._models.get(key)
+        if properties is not None:
+            return properties
+
+        with self._lock:
+            # Another thread may have loaded the model while we were waiting for the lock
+            if key not in self._models:
+                self._models[key] = self._load(key[0], layers_dropped)
+            return self._models[key]
+
+    @timed("model_load")
+    def _load(self, model_path, layers_dropped):
+        count("songs_model_loads_total")
+        model, hop_length, window_length = load_cnn(model_path)
+        properties = {
+            "hop_length": hop_length,
+            "window_length": window_length,
+            "max_seq_length": model.max_sequence_length,
+            "zero_pad": model.zero_pad,
+            "spec_size": model.spec_size,
+            "fuse": model.fuse,
+            "layers_dropped": layers_dropped,
+            "version": self.model_version(model_path)
+        }
+        model = drop_layers(model, layers_dropped)
+        model = model.to(self.device)
+        model.eval()
+        properties["model"] = model
+        logger.info(f"Model {model_path} loaded with {layers_dropped} layer(s) dropped on {self.device}")
+        return properties
+
+    @staticmethod
+    def model_version(model_path):
+        """ Content hash of a model file, changes whenever the model is retrained. """
+        digest = hashlib.sha256()
+        with open(model_path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def load_models(self, model_paths, layers_dropped=LAYERS_DROPPED):
+        """
+        Load several models at once in the structure expected by process_file_custom.
+
+        Args:
+        model_paths (dict): Name of every model (e.g. "genre") mapped to its path.
+
+        Returns:
+        dict: {name: {"properties": properties}} for every model in model_paths.
+        """
+        return {name: {"properties": self.get(path, layers_dropped)} for name, path in model_paths.items()}
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+
+_MODEL_REGISTRY = None
+_MODEL_REGISTRY_LOCK = threading.Lock()
+
+
+def get_model_registry():
+    """ Return the ModelRegistry shared by the whole process. """
+    global _MODEL_REGISTRY
+    with _MODEL_REGISTRY_LOCK:
+        if _MODEL_REGISTRY is None:
+            _MODEL_REGISTRY = ModelRegistry()
+    return _MODEL_REGISTRY
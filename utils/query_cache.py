@@ -0,0 +1,118 @@
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+import numpy as np
+from similarity_engine.instrumentation import count
+from utils.feature_cache import ROOT_DIRECTORY, FeatureCache
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+QUERY_CACHE_DIR = os.path.join(ROOT_DIRECTORY, "query_cache")
+QUERY_CACHE_MAX_BYTES = 512 * 1024 ** 2
+QUERY_CACHE_MAX_ENTRIES = 1024
+
+
+def query_embedding_key(audio_hash, model_versions):
+    """
+    Key of the query embedding of an audio file computed with a given set of models.
+
+    Args:
+    audio_hash (str): Content hash of the audio, see utils.feature_cache.hash_audio.
+    model_versions (list of str): Version of every model, in concatenation order.
+    """
+    return hashlib.sha256(f"embedding:{audio_hash}:{':'.join(model_versions)}".encode("utf-8")).hexdigest()
+
+
+def query_results_key(embedding, index_signature, top_k):
+    """ Key of the top_k results of a query embedding against one version of the index. """
+    digest = hashlib.sha256(np.ascontiguousarray(embedding, dtype='float32').tobytes())
+    digest.update(f":{index_signature!r}:{top_k}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class QueryCache:
+    """
+    Two-tier cache of query embeddings and search results.
+
+    The first tier is an in-process LRU of at most max_entries values, the second a
+    size-capped FeatureCache on disk, so repeated uploads are answered without running
+    the models even after a restart.
+    """
+
+    def __init__(self, cache_dir=QUERY_CACHE_DIR, max_entries=QUERY_CACHE_MAX_ENTRIES, max_bytes=QUERY_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.disk = FeatureCache(cache_dir, max_bytes=max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_memory(self, key):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+            return value
+
+    def _put_memory(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _count(self, hit, cache):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        count("songs_cache_hits_total" if hit else "songs_cache_misses_total", cache=cache)
+
+    def get_embedding(self, key):
+        """ Return the cached query embedding for key, or None on a miss. """
+        embedding = self._get_memory(key)
+        if embedding is None:
+            embedding = self.disk.get(key)
+            if embedding is not None:
+                self._put_memory(key, embedding)
+        self._count(embedding is not None, "query_embedding")
+        return embedding
+
+    def put_embedding(self, key, embedding):
+        self._put_memory(key, embedding)
+        self.disk.put(key, embedding)
+
+    def get_results(self, key):
+        """ Return the cached (indices, distances) for key, or None on a miss. """
+        results = self._get_memory(key)
+        if results is None:
+            indices = self.disk.get(f"{key}i")
+            distances = self.disk.get(f"{key}d") if indices is not None else None
+            if distances is not None:
+                results = (indices, distances)
+                self._put_memory(key, results)
+        self._count(results is not None, "query_results")
+        return results
+
+    def put_results(self, key, indices, distances):
+        self._put_memory(key, (indices, distances))
+        self.disk.put(f"{key}i", indices)
+        self.disk.put(f"{key}d", distances)
+
+
+_QUERY_CACHE = None
+_QUERY_CACHE_LOCK = threading.Lock()
+
+
+def get_query_cache():
+    """ Return the QueryCache shared by the whole process. """
+    global _QUERY_CACHE
+    with _QUERY_CACHE_LOCK:
+        if _QUERY_CACHE is None:
+            _QUERY_CACHE = QueryCache()
+    return _QUERY_CACHE
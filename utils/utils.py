@@ -1,103 +1,281 @@
 import os
+import re
+import threading
 import numpy as np
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+from similarity_engine.embedding_store import MODALITIES, EmbeddingStore, open_embedding_stores
+from similarity_engine.similarity_search import load_config
+from similarity_engine.vector_database_setup import VectorDatabase
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def concatenate_segmented_embeddings(embeddings_folder: str, destination_folder: str) -> None:
+# Trailing _<index> of a segment file name, e.g. 000002_1.npy
+SEGMENT_INDEX_PATTERN = re.compile(r"_(\d+)\.npy$")
+
+
+def segment_sort_key(file_name: str):
+    """
+    Sort key of a segment embedding file: its segment index, then its name.
+
+    Segments written from segment_audio output are named <track>_<index>.npy, sorting them by
+    the integer index keeps _10 after _9 and gives the same order on every machine, whatever
+    order os.listdir returns them in.
+    """
+    match = SEGMENT_INDEX_PATTERN.search(file_name)
+    return (int(match.group(1)) if match else -1, file_name)
+
+
+def concatenate_track_segments(current_folder: str, save_file_name: str, force: bool = False) -> str:
+    """
+    Concatenate the segment embeddings of one track folder into save_file_name.
+
+    Args:
+    current_folder (str): Folder holding the .npy embedding of every segment of the track.
+    save_file_name (str): Output .npy file.
+    force (bool): Rewrite the output even if it is newer than every segment.
+
+    Returns:
+    str: "written", "skipped" when the output is up to date, or "empty" when the folder has no segments.
+    """
+    with os.scandir(current_folder) as entries:
+        segments = sorted((entry for entry in entries if entry.name.endswith('.npy') and entry.is_file()),
+                          key=lambda entry: segment_sort_key(entry.name))
+    if not segments:
+        return "empty"
+
+    if not force:
+        try:
+            output_mtime = os.stat(save_file_name).st_mtime_ns
+        except FileNotFoundError:
+            output_mtime = None
+        # The folder mtime changes when a segment is added or removed
+        newest_input = max([os.stat(current_folder).st_mtime_ns] + [entry.stat().st_mtime_ns for entry in segments])
+        if output_mtime is not None and output_mtime >= newest_input:
+            return "skipped"
+
+    concatenated_embedding = np.concatenate([np.load(entry.path).astype('float32') for entry in segments], axis=None)
+    # Written next to the output and renamed, so an interrupted run never leaves a truncated file
+    temp_file_name = f"{save_file_name}.tmp"
+    with open(temp_file_name, "wb") as file:
+        np.save(file, concatenated_embedding)
+    os.replace(temp_file_name, save_file_name)
+    return "written"
+
+
+def concatenate_segmented_embeddings(embeddings_folder, destination_folder, workers: int = None, force: bool = False) -> dict:
     """
     Reads embeddings from subfolders within a specified directory, concatenates them,
     and saves the concatenated embeddings into a new file in a destination directory.
-    
+
+    Segments are concatenated in the order of their segment index. Tracks whose output is
+    newer than all their segments are skipped, so re-running after adding tracks only
+    processes the new ones. Several modalities can be processed in one pass by passing lists
+    of folders, every track of every modality then goes through the same worker pool.
+
     Args:
-    embeddings_folder (str): The path to the folder containing subfolders of embeddings.
-    destination_folder (str): The path to the folder where concatenated embeddings will be saved.
-    """
-    # Ensure the destination directory exists, create if it doesn't
-    os.makedirs(destination_folder, exist_ok=True)
-
-    # List all subfolders in the specified embeddings directory
-    embeddings_subfolders = os.listdir(embeddings_folder)
-
-    # Iterate through each subfolder to process embeddings
-    for subfolder in embeddings_subfolders:
-        current_folder = os.path.join(embeddings_folder, subfolder)
-        
-        # Continue only if the current item is a directory
-        if not os.path.isdir(current_folder):
-            continue
-        
-        # List all files in the current subfolder
-        embeddings_files = os.listdir(current_folder)
-
-        list_of_embeddings = []
-
-        # Load each file, convert to float32, and collect all embeddings
-        for file_ in embeddings_files:
-            file_path = os.path.join(current_folder, file_)
+    embeddings_folder (str | list of str): The path to the folder containing subfolders of embeddings, one per track.
+    destination_folder (str | list of str): The path to the folder where concatenated embeddings will be saved,
+        one per embeddings_folder.
+    workers (int): Number of worker threads, loading and saving the .npy files is I/O bound.
+    force (bool): Rewrite every output even if it is up to date.
+
+    Returns:
+    dict: Number of tracks written, skipped because up to date, without segments and failed.
+    """
+    if isinstance(embeddings_folder, (str, os.PathLike)):
+        embeddings_folder, destination_folder = [embeddings_folder], [destination_folder]
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+
+    jobs = []
+    for source, destination in zip(embeddings_folder, destination_folder):
+        # Ensure the destination directory exists, create if it doesn't
+        os.makedirs(destination, exist_ok=True)
+        with os.scandir(source) as entries:
+            jobs += [(entry.path, os.path.join(destination, f"{entry.name}.npy"))
+                     for entry in entries if entry.is_dir()]
+
+    summary = {"written": 0, "skipped": 0, "empty": 0, "failed": 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(concatenate_track_segments, current_folder, save_file_name, force): current_folder
+                   for current_folder, save_file_name in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures)):
             try:
-                embedding = np.load(file_path).astype('float32')
-                list_of_embeddings.append(embedding)
+                status = future.result()
             except Exception as e:
-                logger.error(f"Failed to load {file_path}: {e}")
-
-        # Concatenate embeddings from the current subfolder, if any are available
-        if list_of_embeddings:
-            concatenated_embedding = np.concatenate(list_of_embeddings, axis=None)
-            save_file_name = os.path.join(destination_folder, f"{subfolder}.npy")
-            np.save(save_file_name, concatenated_embedding)
-            logger.info(f"Saved concatenated embeddings to {save_file_name}")
-        else:
-            logger.error(f"No embeddings files found in {current_folder}")
-
-
-def find_search_query_from_saved_embeddings(audio_file_name: str):
-
-    # Define the base path for saved embeddings
-    SAVED_EMBEDDINGS_PATH_GENRE = os.path.abspath("./concatenated_embeddings/genre-classification/")
-    SAVED_EMBEDDINGS_PATH_INSTRUMENT = os.path.abspath("./concatenated_embeddings/instrument-classification/")
-    SAVED_EMBEDDINGS_PATH_EMOTION = os.path.abspath("./concatenated_embeddings/emotion-classification/")
-
-    SAVED_EMBEDDINGS_PATHS = {
-        "genre": SAVED_EMBEDDINGS_PATH_GENRE,
-        "instrument": SAVED_EMBEDDINGS_PATH_INSTRUMENT,
-        "emotion": SAVED_EMBEDDINGS_PATH_EMOTION
-    }
-    
-    # print(f"EMBEDDINGS FOLDER: {SAVED_EMBEDDINGS_PATH}")
-    
-    # Extract the track_id from the audio file name
-    track_id_str = os.path.splitext(os.path.basename(audio_file_name))[0]
-    
+                logger.error(f"Failed to concatenate the embeddings of {futures[future]}: {e}")
+                status = "failed"
+            if status == "empty":
+                logger.error(f"No embeddings files found in {futures[future]}")
+            summary[status] += 1
+
+    logger.info(f"Concatenated embeddings of {len(jobs)} tracks: {summary}")
+    return summary
+
+
+# Embedding stores opened by find_search_query_in_embedding_store, keyed by store folder
+_EMBEDDING_STORES = {}
+
+# track_id -> .npy path of every per-track embedding folder, keyed by folder
+_EMBEDDING_FILES = {}
+
+# Saved embedding locations of the default config.json, resolved on first use
+_SAVED_EMBEDDINGS_LOCATIONS = {}
+
+_SAVED_EMBEDDINGS_LOCK = threading.Lock()
+
+
+def _store_signature(store_folder: str, modalities):
+    """ mtime of the header of every store, it is replaced whenever rows are appended. """
+    signature = []
+    for modality in modalities:
+        try:
+            signature.append(os.stat(os.path.join(store_folder, modality, EmbeddingStore.HEADER_FILE)).st_mtime_ns)
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def find_search_query_in_embedding_store(track_id, store_folder: str, modalities=MODALITIES):
+    """
+    Look up the concatenated embedding of track_id in the memory-mapped embedding stores.
+
+    The stores are opened once per process and reopened only when one of them has been
+    appended to, a lookup is then a binary search over the track ids plus a read of the rows.
+
+    Args:
+    track_id (int): Track id of the query.
+    store_folder (str): Folder containing one EmbeddingStore per modality.
+    modalities (list of str): Modalities to concatenate, in order.
+
+    Returns:
+    numpy.array: The concatenated query embedding, or None if a modality misses the track.
+    """
+    if not isinstance(track_id, (int, np.integer)):
+        return None
+    signature = _store_signature(store_folder, modalities)
+    with _SAVED_EMBEDDINGS_LOCK:
+        cached = _EMBEDDING_STORES.get(store_folder)
+        if cached is None or cached[0] != signature:
+            cached = (signature, open_embedding_stores(store_folder))
+            _EMBEDDING_STORES[store_folder] = cached
+    stores = cached[1]
+
+    list_of_embeddings = []
+    for modality in modalities:
+        if modality not in stores:
+            return None
+        embedding = stores[modality].get(int(track_id))
+        if embedding is None:
+            return None
+        list_of_embeddings.append(embedding)
+
+    return np.concatenate(list_of_embeddings, axis=None).astype('float32', copy=False)
+
+
+def embedding_files(folder: str):
+    """
+    Map the track_id of every <track_id>.npy file of folder to its path.
 
-    # Remove leading zeros from the track_id
-    track_id = None
+    The folder is listed once, and listed again only when its mtime changes (a file was
+    added or removed), so a lookup costs one stat instead of a listing of the catalog.
+
+    Returns:
+    dict: track_id -> path, empty if the folder does not exist.
+    """
     try:
-        track_id = int(track_id_str)
-    except Exception:
-        track_id = track_id_str
+        mtime = os.stat(folder).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with _SAVED_EMBEDDINGS_LOCK:
+        cached = _EMBEDDING_FILES.get(folder)
+    if cached is None or cached[0] != mtime:
+        files = {track_id: os.path.join(folder, file_) for track_id, file_ in VectorDatabase.list_embedding_files(folder).items()}
+        cached = (mtime, files)
+        with _SAVED_EMBEDDINGS_LOCK:
+            _EMBEDDING_FILES[folder] = cached
+    return cached[1]
+
+
+def saved_embeddings_locations(config=None):
+    """
+    Absolute locations of the saved embeddings configured in similarity_engine/config.json.
+
+    Args:
+    config (dict): Similarity engine configuration, the default config.json if None.
+
+    Returns:
+    str: Folder of the embedding stores, or None if none is configured.
+    dict: modality -> folder of its per-track embeddings, for every enabled modality in order.
+    """
+    if config is None:
+        with _SAVED_EMBEDDINGS_LOCK:
+            if not _SAVED_EMBEDDINGS_LOCATIONS:
+                _SAVED_EMBEDDINGS_LOCATIONS.update(zip(("store", "folders"), saved_embeddings_locations(load_config())))
+            return _SAVED_EMBEDDINGS_LOCATIONS["store"], _SAVED_EMBEDDINGS_LOCATIONS["folders"]
+
+    # Paths of config.json are relative to the similarity_engine folder
+    store_folder = config['paths'].get('embedding_store_folder')
+    store_folder = os.path.abspath(VectorDatabase.get_full_path(store_folder)) if store_folder else None
+    folders = {modality: os.path.abspath(VectorDatabase.get_full_path(config['paths']['embeddings_folder'][f"{modality}_classification_embeddings"]))
+               for modality in MODALITIES if config['combinator'][modality]}
+    return store_folder, folders
 
-    # Construct the .npy file name without leading zeros
-    npy_file_name = f"{track_id}.npy"
 
+def find_saved_embedding(track_id: int, config=None):
+    """
+    Concatenated saved embedding of a catalog track, without listing any folder.
 
+    The embedding stores are used when they exist, the per-track embedding files otherwise and
+    for tracks the stores do not hold yet (e.g. embedded after the stores were built).
+
+    Args:
+    track_id (int): Track id of the query.
+    config (dict): Similarity engine configuration, the default config.json if None.
+
+    Returns:
+    numpy.array: The concatenated embedding of the enabled modalities, or None if one of them misses the track.
+    """
+    store_folder, folders = saved_embeddings_locations(config)
+
+    # Prefer the consolidated embedding store when it has been created
+    if store_folder and os.path.isdir(store_folder):
+        embedding = find_search_query_in_embedding_store(track_id, store_folder, list(folders))
+        if embedding is not None:
+            return embedding
 
     list_of_embeddings = []
+    for path in folders.values():
+        npy_file_path = embedding_files(path).get(track_id)
+        if npy_file_path is None:
+            return None
+        try:
+            list_of_embeddings.append(np.load(npy_file_path).astype('float32'))
+        except Exception as e:
+            logger.error(f"ERROR: File: {npy_file_path} could not be loaded due to error: {e}")
+            return None
+
+    return np.concatenate(list_of_embeddings, axis=None)
 
-    # Iterate over each classification type
-    for _, path in SAVED_EMBEDDINGS_PATHS.items():
-        files = os.listdir(path)
-        if npy_file_name in files:
-            npy_file_path = os.path.join(path, npy_file_name)
-            try:
-                query = np.load(npy_file_path).astype('float32') 
-                list_of_embeddings.append(query)
-            except Exception as e:
-                logger.error(f"ERROR: File: {npy_file_path} could not be loaded due to error: {e}")
 
-    if len(list_of_embeddings) == 3:
-        return np.concatenate(list_of_embeddings, axis=None)
+def find_search_query_from_saved_embeddings(audio_file_name: str, config=None):
+    """
+    Saved embedding of the catalog track an audio file is named after (<track_id>.wav, leading zeros allowed).
+
+    Args:
+    audio_file_name (str): Path or name of the audio file.
+    config (dict): Similarity engine configuration, the default config.json if None.
 
-    return None
+    Returns:
+    numpy.array: The concatenated embedding, or None if the name is not a saved track_id.
+    """
+    # Extract the track_id from the audio file name, int() removes the leading zeros
+    track_id_str = os.path.splitext(os.path.basename(audio_file_name))[0]
+    try:
+        track_id = int(track_id_str)
+    except ValueError:
+        return None
 
+    return find_saved_embedding(track_id, config)